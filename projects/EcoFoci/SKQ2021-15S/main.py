@@ -1,6 +1,9 @@
-from utils.ctd_bottle_aggregator import CtdBottleAggregator
-import pandas as pd
+from pathlib import Path
+from utils.batch_runner import run_project, print_timing_summary
 
-ctd_bottle_aggregator = CtdBottleAggregator(config_yaml='/Users/zalmanek/Development/Ocean-Data-Aggregator/projects/EcoFoci/SKQ2021-15S/config.yaml')
-final_merge_df = ctd_bottle_aggregator.FINALmerge_quag_ctd_btl_nutrient_for_missing_btlNumbers()
-final_merge_df.to_csv('/Users/zalmanek/Development/OME-EcoFOCI/EcoFOCI/data/1_SampleCollection/2021_SikuliaqDBO_CruiseData/2021_SikuliaqDBO_CruiseData/Fixed_FinalOME_merge_SKQ21-15S.csv')
\ No newline at end of file
+# python -m projects.EcoFoci.SKQ2021-15S.main
+# The merge method and the output file are set in the run_info section of the config.yaml. The product keeps the
+# index column it was always written with (to_csv's default) through write_index: true.
+
+result = run_project(config_yaml=Path(__file__).with_name('config.yaml'))
+print_timing_summary([result])
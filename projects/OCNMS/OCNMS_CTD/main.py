@@ -1,19 +1,8 @@
-from utils.mooring_aggregator import MooringAggregator
-from utils.mat_file_processor import MatFileProcessor
-from utils.ros_processor import RosProcessor
-import pandas as pd
-from projects.OCNMS.fix_long_cruise_codes import fix_long_cruise_code, ocnms_short_long_cruises
+from pathlib import Path
+from utils.batch_runner import run_project, print_timing_summary
 
 # python -m projects.OCNMS.OCNMS_CTD.main
+# The merge method, the output file and the long cruise code fix (post_merge_transforms) are set in the config.yaml
 
-mooring_aggregator = MooringAggregator(config_yaml='/Users/zalmanek/Development/Ocean-Data-Aggregator/projects/OCNMS/OCNMS_CTD/config.yaml')
-
-df = mooring_aggregator.FINALmerge_quag_ctd_mooring_oceanmodel()
-
-# Update long cruise codes
-df['Cruise_ID_long'] = df.apply(fix_long_cruise_code, axis=1)
-
-df.to_csv('/Users/zalmanek/Development/PMEL-OME-OCNMS/Brynn_OCNMS_data_reorganized/FinalOME_Merge_OCNMS23to23CTD_fixed.csv', index=False)
-
-# ros_processor = RosProcessor(ros_file='/Users/zalmanek/Downloads/CAST_CE042_PPS.ros', sites = ['CE042'], day_convention='0 day')
-
+result = run_project(config_yaml=Path(__file__).with_name('config.yaml'))
+print_timing_summary([result])
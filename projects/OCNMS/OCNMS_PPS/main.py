@@ -1,18 +1,10 @@
-from utils.mooring_aggregator import MooringAggregator
-from utils.aggregator import Aggregator
+from pathlib import Path
+from utils.batch_runner import run_project, print_timing_summary
 
-from projects.OCNMS.OCNMS_CTD.main import fix_long_cruise_code
+# python -m projects.OCNMS.OCNMS_PPS.main
+# The merge method, the output file and the long cruise code fix (post_merge_transforms) are set in the config.yaml
 
 # E1857.OC0723, and E1858.OC0723 didn't merge with any pps data because there are non within 1 hour, or even 12 hours to 1 day, 
 # depending on the sample. 
-aggregator = MooringAggregator(config_yaml='/Users/zalmanek/Development/Ocean-Data-Aggregator/projects/OCNMS/OCNMS_PPS/config.yaml')
-
-final_df = aggregator.FINALmerge_quag_pps_mooring_oceanmodel()
-
-final_df['Cruise_ID_long'] = final_df.apply(fix_long_cruise_code, axis=1)
-
-final_df.to_csv("/Users/zalmanek/Development/PMEL-OME-OCNMS/Brynn_OCNMS_data_reorganized/FinalOME_Merge_OCNMS23to23PPS_fixed.csv", index=False)
-
-
-
-
+result = run_project(config_yaml=Path(__file__).with_name('config.yaml'))
+print_timing_summary([result])
@@ -1,13 +1,39 @@
+import copy
 import yaml
 import pandas as pd
 from pathlib import Path
 from utils.pps_txt_file_processor import PpsTextFileProcessor
 from utils.quagmire_creator import QuagmireCreator
+from utils.source_cache import SourceCache
+from utils.station_registry import StationRegistry
+from utils.post_merge_transformer import PostMergeTransformer
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # TODO: pps_txt_file_dir needs to be optional - not all merges will have PPS data
 
 
+# The aggregator whose merge is being run by station, when the workers are forked (inherited by the worker
+# processes, so the sources are shared with the workers instead of being pickled to each of them)
+_STATION_MERGE_AGGREGATOR = None
+
+
+def _run_station_merge(station: str, merge_method: str) -> pd.DataFrame:
+    """
+    Worker process function (forked workers): runs the merge method on the station's partition of the aggregator.
+    """
+    station_aggregator = _STATION_MERGE_AGGREGATOR.partition_by_station(station=station)
+    return getattr(station_aggregator, merge_method)()
+
+
+def _run_partition_merge(station_aggregator, merge_method: str) -> pd.DataFrame:
+    """
+    Worker process function (spawned workers): runs the merge method on a station partition pickled to the worker.
+    """
+    return getattr(station_aggregator, merge_method)()
+
+
 class Aggregator:
     
     PPS_LOCAL_START_DATE_COL = 'pps_sample_start_date' # the date column of the PPS df (this is created in the PpsTextFileProcessor)
@@ -16,16 +42,54 @@ class Aggregator:
     PPS_UTC_END_TIME_COL = 'pps_utc_end_time_col' # Created in Mooring Aggregator in FINALmerge_quag_pps_mooring_oceanmodel()
     PPS_STATION_ID_COL = 'pps_station_id' # The name of the station_id col in the pps data (create in the PpstextFileProcessor)
     PPS_EVENT_NUM_COL = 'pps_event_number' # The name of the pps event_number col (create in the PpstextFileProcessor)
+    SAMPLE_ORDER_COL = '_sample_order' # Temporary col holding the original order of the quagmire samples in station merges
+
+    ENGINES = ('fast', 'reference')
 
-    def __init__(self, config_yaml: str):
+    # The source data frame attributes that are partitioned by station for station merges, and their station col
+    STATION_PARTITIONED_SOURCES = {'pps_df': PPS_STATION_ID_COL}
+
+    def __init__(self, config_yaml: str, source_cache_dir: str = None):
 
         self.config_file = self.load_config(config_yaml)
+        self.config_dir = Path(config_yaml).parent
+
+        # Optional cache of parsed sources (shared between projects run together by the batch_runner, and between runs),
+        # with the least recently used entries evicted past source_cache_max_mb
+        source_cache_dir = source_cache_dir or self.config_file.get('source_cache_dir', None)
+        self.source_cache = SourceCache(cache_dir=source_cache_dir, max_size_mb=self.config_file.get('source_cache_max_mb', None)) if source_cache_dir else None
+
+        # Execution mode - 'in_memory' (default) loads all sources into data frames up front. 'streaming' streams the
+        # sources in chunks of about chunk_size rows at merge time, so memory is bounded by the chunk size (see utils/streaming_joiner.py)
+        execution_info = self.config_file.get('execution', None) or {}
+        self.execution_mode = execution_info.get('mode', 'in_memory')
+        self.stream_chunk_size = execution_info.get('chunk_size', 100000)
+        if self.execution_mode not in ('in_memory', 'streaming'):
+            raise ValueError(f"Invalid execution mode: {self.execution_mode}. Must be 'in_memory' or 'streaming'.")
+        # Number of worker processes to run the merge in, one station at a time (1 runs the merge as a whole)
+        self.station_workers = execution_info.get('station_workers', 1)
+        # How the station workers are started: None (default) is the platform's default (spawn on macOS and Windows,
+        # where forking after numpy/netCDF threads are started isn't safe). 'fork' shares the loaded sources with the
+        # workers instead of pickling each station's partition to them (Linux only).
+        self.station_start_method = execution_info.get('station_start_method', None)
+        if self.station_start_method not in (None, *multiprocessing.get_all_start_methods()):
+            raise ValueError(f"Invalid station_start_method: {self.station_start_method}. Must be one of {multiprocessing.get_all_start_methods()}.")
+        # 'fast' (default) uses the optimized readers and joins. 'reference' uses the original (slow) implementations,
+        # which the fast ones are checked against (see utils/engine_verifier.py)
+        self.engine = execution_info.get('engine', 'fast')
+        if self.engine not in self.ENGINES:
+            raise ValueError(f"Invalid engine: {self.engine}. Must be one of {self.ENGINES}.")
+
+        # Optional registry of station coordinates: samples and CTD casts are assigned to the nearest station by position
+        self.station_registry = StationRegistry.from_config(machine_readable_info=self.config_file['machine_readable_info'], config_dir=self.config_dir)
 
         # quagmire updated
         self.quagmire_creator = QuagmireCreator(machine_readable_files=self.config_file['machine_readable_info']['machine_readable_files'],
                                                 station_col=self.config_file['machine_readable_info']['station_col'],
                                                 lat_dir=self.config_file['machine_readable_info'].get('lat_dir', None),
-                                                lon_dir=self.config_file['machine_readable_info'].get('lon_dir', None))
+                                                lon_dir=self.config_file['machine_readable_info'].get('lon_dir', None),
+                                                source_cache=self.source_cache,
+                                                station_registry=self.station_registry)
         self.quagmire_df = self.quagmire_creator.quagmire_df
         self.quag_utc_date_time_col = self.quagmire_creator.NEW_UTC_DATE_COMBO_COL
         self.quag_local_date_time_col = self.quagmire_creator.NEW_LOCAL_DATE_COMBO_COL
@@ -53,21 +117,171 @@ class Aggregator:
         with open(config_path, 'r') as f:
             return yaml.safe_load(f)
 
+    def get_source_variables(self, section: str) -> list:
+        """
+        The variables a source section of the config.yaml asks for (its 'variables' list), which are pushed down to the
+        source's reader so the other variables are never read. None (keep all of them) if the section doesn't list any.
+        See utils/variable_selection.py.
+        """
+        return (self.config_file.get(section, None) or {}).get('variables', None)
+
+    def load_source(self, source_name: str, files: list, params: dict, create_func) -> pd.DataFrame:
+        """
+        Parses a source with create_func(). If a source cache is set up, the parsed data frame is taken
+        from (or stored in) the cache, keyed by the source files and the parser params.
+        """
+        if self.source_cache is None:
+            return create_func()
+        return self.source_cache.get_or_create(source_name=source_name, files=files, params=params, create_func=create_func)
+
+    def run_merge(self, merge_method: str) -> pd.DataFrame:
+        """
+        Runs a FINALmerge_* method. If station_workers > 1 (execution section of the config), the merge is run
+        separately for each station (see merge_by_station), otherwise for all the data at once.
+        """
+        if self.station_workers > 1:
+            return self.merge_by_station(merge_method=merge_method)
+        return getattr(self, merge_method)()
+
+    def merge_by_station(self, merge_method: str) -> pd.DataFrame:
+        """
+        Runs a FINALmerge_* method for each station in parallel worker processes. Every join is keyed by station,
+        so the quagmire and each source are partitioned by station, each station's merge chain runs on its own
+        partition, and the results are concatenated back in the original quagmire sample order. Each partition's
+        merge drops its own empty columns, so the columns are put back in merge chain order (see merge_column_orders).
+        """
+        global _STATION_MERGE_AGGREGATOR
+
+        self.quagmire_df[self.SAMPLE_ORDER_COL] = np.arange(len(self.quagmire_df))
+        # (samples with no station are merged together as their own 'nan' partition)
+        stations = self.quagmire_df[self.quag_site_col_name].astype(str).unique()
+
+        mp_context = multiprocessing.get_context(self.station_start_method)
+        is_forked = mp_context.get_start_method() == 'fork'
+        if is_forked:
+            # Forked workers share the loaded sources with this process
+            _STATION_MERGE_AGGREGATOR = self
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.station_workers, len(stations)), mp_context=mp_context) as executor:
+                if is_forked:
+                    station_dfs = list(executor.map(_run_station_merge, stations, [merge_method] * len(stations)))
+                else:
+                    station_aggregators = [self.partition_by_station(station=station) for station in stations]
+                    station_dfs = list(executor.map(_run_partition_merge, station_aggregators, [merge_method] * len(stations)))
+        finally:
+            _STATION_MERGE_AGGREGATOR = None
+            self.quagmire_df.drop(columns=self.SAMPLE_ORDER_COL, inplace=True)
+
+        merged_df = pd.concat(station_dfs, ignore_index=True).reindex(columns=self.merge_column_orders(dfs=station_dfs))
+        merged_df = merged_df.sort_values(self.SAMPLE_ORDER_COL, kind='stable').drop(columns=self.SAMPLE_ORDER_COL)
+
+        # remove any columns that are entirely empty (across all stations)
+        return merged_df.dropna(axis=1, how='all').reset_index(drop=True)
+
+    @staticmethod
+    def merge_column_orders(dfs: list) -> list:
+        """
+        The union of the columns of the dfs, in the order of the first df, with the columns it doesn't have put
+        after the column they follow in the other dfs (so the union is in the order of the unpartitioned merge,
+        whose columns each station's result has a subset of).
+        """
+        columns = []
+        for df in dfs:
+            position = 0
+            for col in df.columns:
+                if col in columns:
+                    position = columns.index(col) + 1
+                else:
+                    columns.insert(position, col)
+                    position += 1
+        return columns
+
+    def partition_by_station(self, station: str):
+        """
+        Returns a shallow copy of the aggregator whose quagmire and source data frames (STATION_PARTITIONED_SOURCES)
+        only hold the rows of the station.
+        """
+        station_aggregator = copy.copy(self)
+        station_aggregator.quagmire_df = self.quagmire_df[self.quagmire_df[self.quag_site_col_name].astype(str) == station]
+        for source_attr, station_col in self.STATION_PARTITIONED_SOURCES.items():
+            source_df = getattr(self, source_attr, None)
+            if source_df is not None:
+                setattr(station_aggregator, source_attr, source_df[source_df[station_col].astype(str) == station])
+        station_aggregator.quag_station_sites = [station]
+
+        return station_aggregator
+
+    @staticmethod
+    def prefix_columns(df: pd.DataFrame, prefix: str) -> pd.DataFrame:
+        """
+        Adds the prefix to the column names of the df by renaming in place (add_prefix copies the whole df).
+        Returns the same df.
+        """
+        df.rename(columns=lambda col: f"{prefix}{col}", inplace=True)
+        return df
+
+    @staticmethod
+    def drop_empty_columns(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drops the columns of the df that are entirely empty, in place. Returns the same df.
+        """
+        df.drop(columns=df.columns[df.isna().all()], inplace=True)
+        return df
+
+    def get_source_sizes_mb(self) -> dict:
+        """
+        Returns the in memory size (MB) of the quagmire and each loaded source data frame (used to compare
+        the peak memory of a merge to the size of its inputs).
+        """
+        return {attr: value.memory_usage(deep=True).sum() / 1e6
+                for attr, value in vars(self).items() if isinstance(value, pd.DataFrame)}
+
+    def get_source_provenance(self) -> dict:
+        """
+        Returns column prefix: description of the input files of that source, for the provenance attributes of
+        NetCDF output (see utils/netcdf_writer.py)
+        """
+        provenance = {'': f"quagmire from {', '.join(str(f) for f in self.config_file['machine_readable_info']['machine_readable_files'])}"}
+        if self.config_file.get('pps_data', None):
+            provenance['pps_'] = f"PPS .txt files in {self.pps_txt_file_dir}"
+        return provenance
+
+    def apply_post_merge_transforms(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Applies the post_merge_transforms section of the config.yaml (column mappings from lookup tables, renames,
+        derived columns and drops) to a merged df. Returns the df as is if there is no post_merge_transforms section.
+        """
+        transforms_info = self.config_file.get('post_merge_transforms', None)
+        if not transforms_info:
+            return df
+
+        transformer = PostMergeTransformer(transforms_info=transforms_info, config_dir=self.config_dir)
+        return transformer.transform(df=df)
+
     def get_pps_df(self):
         """
         Get a single data frame for all the applicable PPS data
         """
-        pps_dfs = []
         # Get all .txt files with PPS in the name form the directory
-        for file in self.pps_txt_file_dir.rglob('*PPS*.txt'):
-            pps_processor = PpsTextFileProcessor(
-                pps_txt_file=file, sites=self.quag_station_sites)
-            pps_df = pps_processor.convert_pps_txt_to_df()
-            pps_dfs.append(pps_df)
+        pps_files = sorted(self.pps_txt_file_dir.rglob('*PPS*.txt'))
+
+        def parse_pps_files():
+            pps_dfs = []
+            for file in pps_files:
+                pps_processor = PpsTextFileProcessor(
+                    pps_txt_file=file, sites=self.quag_station_sites)
+                if self.engine == 'reference':
+                    pps_df = pps_processor.reference_convert_pps_txt_to_df()
+                else:
+                    pps_df = pps_processor.convert_pps_txt_to_df()
+                pps_dfs.append(pps_df)
+            return pd.concat(pps_dfs, ignore_index=True)
 
-        df = pd.concat(pps_dfs, ignore_index=True)
+        df = self.load_source(source_name='pps', files=pps_files,
+                              params={'sites': sorted(self.quag_station_sites), 'engine': self.engine},
+                              create_func=parse_pps_files)
 
-        df = df.add_prefix('pps_')
+        df = self.prefix_columns(df=df, prefix='pps_')
         df.to_csv('pps.csv', index=False)
 
         return df
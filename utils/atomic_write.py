@@ -0,0 +1,24 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Yields a temporary path (next to path, unique to the process) to write to. When the block finishes it is moved
+    over path in one step, so readers (and other processes) never see a partially written file. If the block
+    raises, the temporary file is removed and path is left as it was.
+
+    with atomic_write(cache_file) as tmp_path:
+        df.to_parquet(tmp_path)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
@@ -0,0 +1,170 @@
+import argparse
+import contextlib
+import importlib
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import yaml
+from utils.memory_tracker import MemoryTracker
+
+# Runs one or more projects from their config.yaml files. Each config needs a run_info section like:
+#
+# run_info:
+#   aggregator: MooringAggregator # MooringAggregator or CtdBottleAggregator
+#   merge_method: FINALmerge_quag_ctd_mooring_oceanmodel # The FINALmerge_* method of the aggregator to run
+#   output_file: /path/to/FinalOME_Merge.csv # or .nc for chunked, compressed CF-NetCDF (see utils/netcdf_writer.py)
+#   write_index: false # optional (default false). Set to true to write the data frame index as the first column of a .csv
+#
+# Example (rebuild all OCNMS and EcoFOCI products):
+# python -m utils.batch_runner projects/OCNMS/*/config.yaml projects/EcoFoci/*/config.yaml --jobs 4
+
+AGGREGATOR_MODULES = {
+    'MooringAggregator': 'utils.mooring_aggregator',
+    'CtdBottleAggregator': 'utils.ctd_bottle_aggregator',
+}
+
+
+def run_project(config_yaml: str, source_cache_dir: str = None, track_memory: bool = False) -> dict:
+    """
+    Runs a single project: instantiates the aggregator named in the config's run_info, runs the
+    merge method and the post merge transforms and saves the output. Returns a dictionary with
+    the timing summary of the run. If track_memory, the peak memory of the load and merge phases and
+    the size of the largest source are added to the summary.
+    """
+    config_yaml = Path(config_yaml)
+    with open(config_yaml, 'r') as f:
+        run_info = yaml.safe_load(f).get('run_info', None)
+    if not run_info:
+        raise ValueError(f"No run_info section in {config_yaml}. Please add the aggregator, merge_method and output_file.")
+
+    aggregator_name = run_info['aggregator']
+    if aggregator_name not in AGGREGATOR_MODULES:
+        raise ValueError(f"Unknown aggregator {aggregator_name} in {config_yaml}. Must be one of {list(AGGREGATOR_MODULES)}")
+
+    memory_tracker = MemoryTracker() if track_memory else None
+    with memory_tracker or contextlib.nullcontext():
+        start = time.perf_counter()
+        aggregator_module = importlib.import_module(AGGREGATOR_MODULES[aggregator_name])
+        aggregator = getattr(aggregator_module, aggregator_name)(config_yaml=str(config_yaml), source_cache_dir=source_cache_dir)
+        load_seconds = time.perf_counter() - start
+        if memory_tracker:
+            memory_tracker.mark('load')
+
+        final_df = aggregator.run_merge(merge_method=run_info['merge_method'])
+        final_df = aggregator.apply_post_merge_transforms(df=final_df)
+        merge_seconds = time.perf_counter() - start - load_seconds
+        if memory_tracker:
+            memory_tracker.mark('merge')
+
+        if Path(run_info['output_file']).suffix == '.nc':
+            from utils.netcdf_writer import NetcdfWriter # deferred (only needed for .nc output)
+
+            NetcdfWriter(df=final_df, source_provenance=aggregator.get_source_provenance()).write(nc_file=run_info['output_file'])
+        else:
+            final_df.to_csv(run_info['output_file'], index=run_info.get('write_index', False))
+
+    result = {
+        'project': config_yaml.parent.name,
+        'rows': len(final_df),
+        'load_seconds': load_seconds,
+        'merge_seconds': merge_seconds,
+        'total_seconds': time.perf_counter() - start,
+        'output_file': run_info['output_file'],
+    }
+    if memory_tracker:
+        result['peak_load_mb'] = memory_tracker.peaks_mb['load']
+        result['peak_merge_mb'] = memory_tracker.peaks_mb['merge']
+        result['largest_source_mb'] = max(aggregator.get_source_sizes_mb().values(), default=0.0)
+
+    return result
+
+
+def run_projects(config_yamls: list, jobs: int = 1, source_cache_dir: str = None, track_memory: bool = False) -> list:
+    """
+    Runs the projects of all config_yamls, in parallel processes if jobs > 1 (one after the other in this process
+    otherwise, so a failing project prints its full traceback). Sources parsed by one project are shared with the
+    others through a source cache. If no source_cache_dir is given a temporary one is used for the run and removed
+    at the end.
+    """
+    tmp_cache_dir = None
+    if source_cache_dir is None:
+        tmp_cache_dir = tempfile.mkdtemp(prefix='ocean_data_aggregator_cache_')
+        source_cache_dir = tmp_cache_dir
+
+    results = []
+    try:
+        if jobs <= 1:
+            for config_yaml in config_yamls:
+                try:
+                    results.append(run_project(config_yaml, source_cache_dir, track_memory))
+                except Exception as e:
+                    traceback.print_exc()
+                    print(f"Project {config_yaml} failed: {e!r}")
+                    results.append({'project': Path(config_yaml).parent.name, 'error': repr(e)})
+            return results
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run_project, config_yaml, source_cache_dir, track_memory): config_yaml for config_yaml in config_yamls}
+            for future in as_completed(futures):
+                config_yaml = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"Project {config_yaml} failed: {e!r}")
+                    results.append({'project': Path(config_yaml).parent.name, 'error': repr(e)})
+    finally:
+        if tmp_cache_dir:
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+
+    return results
+
+
+def print_timing_summary(results: list):
+    """
+    Prints the per project timing summary
+    """
+    print(f"\n{'project':<25}{'rows':>8}{'load (s)':>12}{'merge (s)':>12}{'total (s)':>12}  output")
+    for result in sorted(results, key=lambda r: r['project']):
+        if 'error' in result:
+            print(f"{result['project']:<25}  FAILED: {result['error']}")
+        else:
+            print(f"{result['project']:<25}{result['rows']:>8}{result['load_seconds']:>12.1f}"
+                  f"{result['merge_seconds']:>12.1f}{result['total_seconds']:>12.1f}  {result['output_file']}")
+
+    memory_results = [result for result in results if 'peak_merge_mb' in result]
+    if memory_results:
+        # The merge peak should stay within about 2x the largest source
+        print(f"\n{'project':<25}{'largest source (MB)':>21}{'peak load (MB)':>16}{'peak merge (MB)':>17}{'merge/source':>14}")
+        for result in sorted(memory_results, key=lambda r: r['project']):
+            ratio = result['peak_merge_mb'] / result['largest_source_mb'] if result['largest_source_mb'] else float('nan')
+            print(f"{result['project']:<25}{result['largest_source_mb']:>21.1f}{result['peak_load_mb']:>16.1f}"
+                  f"{result['peak_merge_mb']:>17.1f}{ratio:>13.1f}x")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Run the merges of one or more project config.yaml files.')
+    parser.add_argument('config_yamls', nargs='+', help='The config.yaml files of the projects to run')
+    parser.add_argument('--jobs', type=int, default=1, help='The number of projects to run in parallel processes')
+    parser.add_argument('--cache-dir', default=None, help='Directory to keep parsed sources in between runs (default: temporary for this run)')
+    parser.add_argument('--track-memory', action='store_true', help='Track the peak memory of the load and merge of each project (slower)')
+    parser.add_argument('--plan', action='store_true', help='Only print the estimated rows, memory and runtime of each stage (see utils/run_planner.py), without running')
+    parser.add_argument('--memory-budget-mb', type=float, default=4000, help='With --plan, flag the stages estimated to need more memory than this')
+    args = parser.parse_args(argv)
+
+    if args.plan:
+        from utils.run_planner import plan_projects # deferred (only needed for --plan)
+
+        return 0 if plan_projects(config_yamls=args.config_yamls, memory_budget_mb=args.memory_budget_mb) else 1
+
+    results = run_projects(config_yamls=args.config_yamls, jobs=args.jobs, source_cache_dir=args.cache_dir, track_memory=args.track_memory)
+    print_timing_summary(results)
+
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
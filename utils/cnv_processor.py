@@ -1,26 +1,40 @@
-import ctd
 import pandas as pd
 import re
 from datetime import datetime
+from utils.station_registry import parse_nmea_lat_lon
+from utils.variable_selection import is_selected
 
 # TODO: Add time zone conversion in check_time_zone. Right now it just makes sure local time == utc which means they are the same
 
 class CnvProcessor:
-    def __init__(self, cnv_file: str, sites: list, day_convention: str):
+
+    REQUIRED_COLS = ['timeJ_Julian_Days'] # columns always kept (the time column is made from it)
+
+    def __init__(self, cnv_file: str, sites: list, day_convention: str, variables: list = None, station_registry=None):
 
         self.cnv_file = cnv_file
         self.sites = sites
         self.day_convention = day_convention # specifies julian day 0 or 1. 
+        self.variables = variables # optional list of the columns to keep (original or long names). All of them if None
+        self.station_registry = station_registry # optional StationRegistry to assign the cast to a station by its NMEA position
         self.start_time = self.get_the_start_time()
         self.system_times = self.get_system_time()
         self.cnv_df = self.convert_cnv_to_df()
 
     def convert_cnv_to_df(self) -> pd.DataFrame:
 
+        import ctd # deferred (slow to import)
+
         df = ctd.from_cnv(self.cnv_file)
 
         self.units_dict = self.get_units_from_cnv_file()
 
+        # Only keep the selected columns (by their original or their long name)
+        if self.variables is not None:
+            df = df[[col for col in df.columns
+                     if is_selected(name=col, variables=self.variables)
+                     or is_selected(name=self.units_dict.get(col), variables=self.variables, required=self.REQUIRED_COLS)]]
+
         # Change column names to include longer name and units
         df.columns = [self.units_dict.get(col) for col in df.columns]
 
@@ -122,8 +136,18 @@ class CnvProcessor:
 
     def get_site(self, cnv_df: pd.DataFrame) -> pd.DataFrame:
         """
-        Add the site to the df
+        Add the site to the df. With a station registry the cast is assigned to the station nearest to the NMEA
+        position in its header (if it has one and a station is close enough), otherwise the file is searched for the site names.
         """
+        if self.station_registry is not None:
+            with open(self.cnv_file, 'r') as header_file:
+                lat, lon = parse_nmea_lat_lon(header_lines=header_file)
+            if lat is not None and lon is not None:
+                stations, _ = self.station_registry.assign(lats=[lat], lons=[lon])
+                if stations[0] is not None:
+                    cnv_df['station_id'] = stations[0]
+                    return cnv_df
+
         with open(self.cnv_file, 'r') as cnv_file:
             file_content = cnv_file.read()
 
@@ -1,4 +1,5 @@
 import pandas as pd
+from utils.variable_selection import is_selected
 
 class CsvProcessor:
     """
@@ -7,7 +8,7 @@ class CsvProcessor:
 
     def __init__(self, csv_file_path, header: int, cast_num_col_name: str = None, 
                  cast_val_str_to_remove: str = None, unit_row: int = None, 
-                 cols_to_group_and_avg: list = None):
+                 cols_to_group_and_avg: list = None, variables: list = None, key_cols: list = None):
         """
         csv_file_path: path to the csv file
         header: the row number of the column names
@@ -17,6 +18,9 @@ class CsvProcessor:
         cols_to_group_and_avg: optional list of column in the csv that need to be grouped 
             by and averages of other columns calculated. Only if desired (e.g. for 
             the SKQ2115S cruise)
+        variables: optional list of the columns to read (by their name in the header row). All of them if None
+        key_cols: columns read along with the variables (e.g. the pressure column merged on). The cast column and
+            the columns to group by are always read
         """
         self.csv_file_path = csv_file_path
         self.header = header
@@ -24,6 +28,8 @@ class CsvProcessor:
         self.cast_num_col_name = cast_num_col_name
         self.cast_val_strs_to_remove = cast_val_str_to_remove
         self.cols_to_group_and_avg = cols_to_group_and_avg
+        self.variables = variables
+        self.required_cols = [col for col in [cast_num_col_name] + (cols_to_group_and_avg or []) + (key_cols or []) if col]
         self.df = self.process_csv()
 
     def process_csv(self):
@@ -49,12 +55,19 @@ class CsvProcessor:
     def load_csv_as_df(self):
         """
         Loads csv file as a data frame. Adding units to column names, if the
-        units exist in a seperate row
+        units exist in a seperate row. Only the selected variables are parsed.
         """
         
         # If unit row is included, get the units and append to column names
         if self.unit_row:
-            df = pd.read_csv(self.csv_file_path, header=None)
+            data_start_row = max(self.header, self.unit_row) + 1
+            usecols = None
+            if self.variables is not None:
+                # Positions of the selected columns, from the header row
+                header_rows = pd.read_csv(self.csv_file_path, header=None, nrows=data_start_row)
+                usecols = [i for i, h in enumerate(header_rows.iloc[self.header].values)
+                           if is_selected(name=h, variables=self.variables, required=self.required_cols)]
+            df = pd.read_csv(self.csv_file_path, header=None, usecols=usecols)
             headers = df.iloc[self.header].values
             units = df.iloc[self.unit_row].values
 
@@ -65,13 +78,15 @@ class CsvProcessor:
             if self.cast_num_col_name:
                 self.cast_num_col_name = self.update_cast_col_name(combined_header_unit_cols=combined_header_unit_cols)
 
-            data_start_row = max(self.header, self.unit_row) + 1
             df_data = df.iloc[data_start_row:].reset_index(drop=True)
             df_data.columns = combined_header_unit_cols
 
             return df_data
         else:
-            return pd.read_csv(self.csv_file_path, header=self.header)
+            usecols = None
+            if self.variables is not None:
+                usecols = lambda col: is_selected(name=col, variables=self.variables, required=self.required_cols)
+            return pd.read_csv(self.csv_file_path, header=self.header, usecols=usecols)
 
     def group_and_avg_rows(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -5,14 +5,17 @@ import pandas as pd
 
 class CtdBottleAggregator(Aggregator):
 
-    def __init__(self, config_yaml: str):
-        super().__init__(config_yaml)
+    def __init__(self, config_yaml: str, source_cache_dir: str = None):
+        super().__init__(config_yaml, source_cache_dir=source_cache_dir)
 
         # CTD data
         if 'ctd_data' in self.config_file:
             self.ctd_file_info = self.config_file.get('ctd_data', None)
             self.ctd_cast_col_name = self.ctd_file_info.get('cast_num_col_name', None)
             self.ctd_pressure_col_name = self.ctd_file_info.get('pressure_col_name', None)
+            # If set, each bottle is matched to the ctd record of its cast with the nearest pressure (within this many dbar)
+            # instead of on rounded pressure, so duplicate ctd pressures don't need to be averaged first (group_by_cols_to_average)
+            self.ctd_pressure_tolerance = self.ctd_file_info.get('pressure_tolerance', None)
             self.ctd_df = self.get_ctd_df_from_csv()
 
         # Bottle data
@@ -67,19 +70,34 @@ class CtdBottleAggregator(Aggregator):
 
         return final_df
     
+    def get_source_provenance(self) -> dict:
+        """
+        Adds the ctd, bottle and nutrient csv files to the provenance of the Aggregator
+        """
+        provenance = super().get_source_provenance()
+        if 'ctd_data' in self.config_file:
+            provenance['ctd_'] = f"CTD csv {self.ctd_file_info.get('ctd_csv')}"
+        if 'bottle_data' in self.config_file:
+            provenance['btl_'] = f"bottle csv {self.btl_file_info.get('bottle_csv')}"
+        if 'nutrient_data' in self.config_file:
+            provenance['nutr_'] = f"nutrient csv {self.nutr_file_info.get('nutrient_csv')}"
+        return provenance
+
     def get_ctd_df_from_csv(self) -> pd.DataFrame:
         """
         Get the ctd df and prepend columns with ctd_
         """
         if self.ctd_file_info:
-            ctd_csv_processor = CsvProcessor(csv_file_path=self.ctd_file_info.get('ctd_csv'),
-                                             header=self.ctd_file_info.get('header_row'),
-                                             cast_num_col_name=self.ctd_cast_col_name, 
-                                             cast_val_str_to_remove=self.ctd_file_info.get('cast_val_str_to_remove', None),
-                                             unit_row=self.ctd_file_info.get('unit_row', None),
-                                             cols_to_group_and_avg=self.ctd_file_info.get('group_by_cols_to_average', None))
+            ctd_df = self.load_csv_source(source_name='ctd_csv', csv_file_path=self.ctd_file_info.get('ctd_csv'),
+                                          header=self.ctd_file_info.get('header_row'),
+                                          cast_num_col_name=self.ctd_cast_col_name,
+                                          cast_val_str_to_remove=self.ctd_file_info.get('cast_val_str_to_remove', None),
+                                          unit_row=self.ctd_file_info.get('unit_row', None),
+                                          cols_to_group_and_avg=self.ctd_file_info.get('group_by_cols_to_average', None),
+                                          variables=self.get_source_variables(section='ctd_data'),
+                                          key_cols=[self.ctd_pressure_col_name])
             
-            df = ctd_csv_processor.df.add_prefix('ctd_')
+            df = self.prefix_columns(df=ctd_df, prefix='ctd_')
             return df
         else:
             return None
@@ -89,14 +107,16 @@ class CtdBottleAggregator(Aggregator):
         Get the bottle df and prepend columns with btl_
         """
         if self.btl_file_info:
-            btl_csv_processor = CsvProcessor(csv_file_path=self.btl_file_info.get('bottle_csv'),
-                                             header = self.btl_file_info.get('header_row'),
-                                             cast_num_col_name=self.btl_cast_col_name, 
-                                             cast_val_str_to_remove=self.btl_file_info.get('cast_val_str_to_remove', None),
-                                             unit_row=self.btl_file_info.get('unit_row', None),
-                                             cols_to_group_and_avg=self.btl_file_info.get('group_by_cols_to_average', None))
+            btl_df = self.load_csv_source(source_name='bottle_csv', csv_file_path=self.btl_file_info.get('bottle_csv'),
+                                          header=self.btl_file_info.get('header_row'),
+                                          cast_num_col_name=self.btl_cast_col_name,
+                                          cast_val_str_to_remove=self.btl_file_info.get('cast_val_str_to_remove', None),
+                                          unit_row=self.btl_file_info.get('unit_row', None),
+                                          cols_to_group_and_avg=self.btl_file_info.get('group_by_cols_to_average', None),
+                                          variables=self.get_source_variables(section='bottle_data'),
+                                          key_cols=[self.btl_pressure_col_name, self.btl_bottle_col_name])
             
-            df = btl_csv_processor.df.add_prefix('btl_')
+            df = self.prefix_columns(df=btl_df, prefix='btl_')
             return df
         else:
             return None
@@ -106,18 +126,28 @@ class CtdBottleAggregator(Aggregator):
         Get the nutrient df from a csv and prepend columns with nutr_
         """
         if self.nutr_file_info:
-            nutr_csv_processor = CsvProcessor(csv_file_path=self.nutr_file_info.get('nutrient_csv'),
-                                              header=self.nutr_file_info.get('header_row'),
-                                              cast_num_col_name=self.nutr_cast_col_name, 
-                                              cast_val_str_to_remove=self.btl_file_info.get('cast_val_str_to_remove', None),
-                                              unit_row= self.nutr_file_info.get('unit_row', None),
-                                              cols_to_group_and_avg=self.nutr_file_info.get('group_by_cols_to_average', None))
+            nutr_df = self.load_csv_source(source_name='nutrient_csv', csv_file_path=self.nutr_file_info.get('nutrient_csv'),
+                                           header=self.nutr_file_info.get('header_row'),
+                                           cast_num_col_name=self.nutr_cast_col_name,
+                                           cast_val_str_to_remove=self.btl_file_info.get('cast_val_str_to_remove', None),
+                                           unit_row=self.nutr_file_info.get('unit_row', None),
+                                           cols_to_group_and_avg=self.nutr_file_info.get('group_by_cols_to_average', None),
+                                           variables=self.get_source_variables(section='nutrient_data'),
+                                           key_cols=[self.nutr_pressure_col_name])
             
-            df = nutr_csv_processor.df.add_prefix('nutr_')
+            df = self.prefix_columns(df=nutr_df, prefix='nutr_')
             return df
         else:
             return None
 
+    def load_csv_source(self, source_name: str, csv_file_path: str, **csv_params) -> pd.DataFrame:
+        """
+        Loads a csv with the CsvProcessor (through the source cache, keyed by the csv file and the CsvProcessor
+        params, e.g. header and unit rows)
+        """
+        return self.load_source(source_name=source_name, files=[csv_file_path], params=csv_params,
+                                create_func=lambda: CsvProcessor(csv_file_path=csv_file_path, **csv_params).df)
+
     def update_attribute_cols(self):
         """
         Column names that are also attributes as part of this class will need to be updated 
@@ -178,8 +208,11 @@ class CtdBottleAggregator(Aggregator):
         """
         Merges teh bottle file with the ctd file based on pressure and
         cast. The pressure is rounded. This assumes its step 1 of a merge 
-        process as it takes the bottle df and ctd df as are.
+        process as it takes the bottle df and ctd df as are. If the ctd_data
+        pressure_tolerance is set, the nearest pressure merge is used instead.
         """
+        if self.ctd_pressure_tolerance is not None:
+            return self.merge_bottle_ctd_on_cast_nearest_pressure(tolerance=float(self.ctd_pressure_tolerance))
 
         # round pressure columns in btl and ctd
         self.btl_df['btl_pressure_rounded'] = pd.to_numeric(self.btl_df[self.btl_pressure_col_name],
@@ -196,6 +229,41 @@ class CtdBottleAggregator(Aggregator):
         )
 
         return ctd_btl_combined
+
+    def merge_bottle_ctd_on_cast_nearest_pressure(self, tolerance: float) -> pd.DataFrame:
+        """
+        Merges the bottle file with the ctd file on cast and nearest pressure (within tolerance dbar).
+        Every bottle gets exactly one ctd record (or none if there is no ctd record of the cast within
+        the tolerance), so duplicate ctd pressures don't fan out into extra rows. Adds a
+        ctd_btl_pressure_difference column (ctd - bottle pressure). Keeps the bottle row order.
+        """
+        btl_df = self.btl_df.copy()
+        btl_df['btl_pressure_numeric'] = pd.to_numeric(btl_df[self.btl_pressure_col_name], errors='coerce')
+        btl_df['_btl_row'] = range(len(btl_df))
+        ctd_df = self.ctd_df.copy()
+        ctd_df['ctd_pressure_numeric'] = pd.to_numeric(ctd_df[self.ctd_pressure_col_name], errors='coerce')
+
+        # merge_asof can't match missing pressures or casts, so those bottles are added back unmatched
+        btl_matchable = btl_df[self.btl_cast_col_name].notna() & btl_df['btl_pressure_numeric'].notna()
+        btl_with_pressure = btl_df[btl_matchable].sort_values('btl_pressure_numeric')
+        ctd_with_pressure = ctd_df.dropna(subset=[self.ctd_cast_col_name, 'ctd_pressure_numeric']).sort_values('ctd_pressure_numeric')
+
+        ctd_btl_combined = pd.merge_asof(
+            btl_with_pressure,
+            ctd_with_pressure,
+            left_on='btl_pressure_numeric',
+            right_on='ctd_pressure_numeric',
+            left_by=self.btl_cast_col_name,
+            right_by=self.ctd_cast_col_name,
+            direction='nearest',
+            tolerance=tolerance
+        )
+        ctd_btl_combined['ctd_btl_pressure_difference'] = ctd_btl_combined['ctd_pressure_numeric'] - ctd_btl_combined['btl_pressure_numeric']
+
+        ctd_btl_combined = pd.concat([ctd_btl_combined, btl_df[~btl_matchable]], ignore_index=True)
+        ctd_btl_combined = ctd_btl_combined.sort_values('_btl_row').drop(columns=['_btl_row', 'btl_pressure_numeric', 'ctd_pressure_numeric'])
+
+        return ctd_btl_combined.reset_index(drop=True)
     
     def merge_quag_OtherBottleDf_on_cast_rosette(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+from utils.streaming_joiner import NAT_NS, from_utc_ns, group_moments, std_devs_from_moments, to_utc_ns
+
+# Optional vertical binning of the raw CTD casts (.cnv/.ros scans) as they are read, declared in the ctd_data section
+# of the config.yaml:
+#
+# ctd_data:
+#   profile_binning:
+#     bin_size: 1 # in the units of the vertical column (db or m)
+#     vertical_col: Pressure,_Digiquartz_[db] # optional (default: the pressure index of a .cnv, or the first Pressure/Depth column)
+#     downcast_only: true # optional (default true). Set to false for .ros files, whose bottles are fired on the upcast
+#     remove_soak: true # optional (default true)
+#
+# Each cast becomes one row per bin, so ctd_df (and every merge after it) holds bins instead of every scan.
+# CTD NetCDF files are already binned profiles and are read as they are.
+
+
+class CtdProfileBinner:
+    """
+    Bins the scans of a CTD cast vertically: the mean, {col}_std_dev and scan count of each bin, computed for all bins
+    at once with bincounts (the standard deviations from a second pass over the offsets from the bin means). Before
+    binning, the soak at the start of the cast and, with downcast_only, the upcast and the pressure reversals of the
+    downcast (ship heave) are removed.
+    """
+
+    VERTICAL_COL_PREFIXES = ('Pressure', 'Depth')
+    COUNT_COL = 'bin_scan_count'
+
+    def __init__(self, bin_size: float, vertical_col: str = None, downcast_only: bool = True, remove_soak: bool = True):
+        if not bin_size or float(bin_size) <= 0:
+            raise ValueError(f"Invalid CTD profile bin size: {bin_size}. Must be positive.")
+        self.bin_size = float(bin_size)
+        self.vertical_col = vertical_col
+        self.downcast_only = downcast_only
+        self.remove_soak = remove_soak
+
+    @classmethod
+    def from_config(cls, ctd_data: dict):
+        """
+        The binner declared in the profile_binning of the ctd_data section of a config.yaml, or None if there isn't one
+        """
+        binning = ctd_data.get('profile_binning', None)
+        if not binning:
+            return None
+        return cls(bin_size=binning.get('bin_size', None),
+                   vertical_col=binning.get('vertical_col', None),
+                   downcast_only=binning.get('downcast_only', True),
+                   remove_soak=binning.get('remove_soak', True))
+
+    def to_params(self) -> dict:
+        """
+        The binning as source cache parameters
+        """
+        return {'bin_size': self.bin_size, 'vertical_col': self.vertical_col,
+                'downcast_only': self.downcast_only, 'remove_soak': self.remove_soak}
+
+    def get_vertical_values(self, cast_df: pd.DataFrame) -> tuple:
+        """
+        (values, name, is_index) of the vertical coordinate of the cast. python-ctd reads the pressure of a .cnv into
+        the index, .ros pressures are a column.
+        """
+        index_name = str(cast_df.index.name) if cast_df.index.name is not None else ''
+        if self.vertical_col is not None:
+            if self.vertical_col in cast_df.columns:
+                return pd.to_numeric(cast_df[self.vertical_col], errors='coerce').to_numpy(dtype=float), self.vertical_col, False
+            if index_name == self.vertical_col:
+                return pd.to_numeric(cast_df.index.to_series(), errors='coerce').to_numpy(dtype=float), index_name, True
+            raise ValueError(f"CTD profile binning column {self.vertical_col} not found (if ctd_data variables are set, it must be one of them)")
+
+        if index_name.startswith(self.VERTICAL_COL_PREFIXES):
+            return pd.to_numeric(cast_df.index.to_series(), errors='coerce').to_numpy(dtype=float), index_name, True
+        for prefix in self.VERTICAL_COL_PREFIXES:
+            for col in cast_df.columns:
+                if str(col).startswith(prefix):
+                    return pd.to_numeric(cast_df[col], errors='coerce').to_numpy(dtype=float), col, False
+        raise ValueError(f"No Pressure or Depth column to bin the CTD cast by (columns: {list(cast_df.columns)}). Set profile_binning vertical_col.")
+
+    def select_scans(self, vertical: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of the scans to bin. The soak ends at the shallowest scan before the bottom of the cast (where
+        the CTD is brought back up to the surface before the downcast). The downcast is from there to the bottom,
+        keeping only the scans deeper than every scan before them.
+        """
+        valid = ~np.isnan(vertical)
+        if not valid.any():
+            return valid
+        positions = np.arange(len(vertical))
+        bottom = int(np.nanargmax(vertical))
+        keep = valid.copy()
+
+        if self.remove_soak:
+            before_bottom = np.where(valid[:bottom + 1], vertical[:bottom + 1], np.inf)
+            keep &= positions >= np.flatnonzero(before_bottom == before_bottom.min())[-1]
+
+        if self.downcast_only:
+            keep &= positions <= bottom
+            # Running max of the scans kept so far (pressure reversals from ship heave are dropped)
+            running_max = np.maximum.accumulate(np.where(keep, vertical, -np.inf))
+            keep &= np.concatenate(([True], vertical[1:] > running_max[:-1]))
+
+        return keep
+
+    def bin_cast(self, cast_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        One row per vertical bin of the cast (in depth order): the bin centre in the vertical column (or index), the
+        mean of the numeric and time columns and the first value of the other columns (e.g. the station), then a
+        {col}_std_dev column for each numeric column and the number of scans in the bin. None (no cast) stays None.
+        """
+        if cast_df is None or cast_df.empty:
+            return cast_df
+        vertical, vertical_name, is_index = self.get_vertical_values(cast_df=cast_df)
+        kept_rows = np.flatnonzero(self.select_scans(vertical=vertical))
+        cast_df = cast_df.iloc[kept_rows]
+
+        bin_codes, bin_numbers = pd.factorize(np.floor(vertical[kept_rows] / self.bin_size).astype(np.int64), sort=True)
+        n_bins = len(bin_numbers)
+        bin_centres = (np.asarray(bin_numbers) + 0.5) * self.bin_size
+        first_rows = np.unique(bin_codes, return_index=True)[1]
+
+        result = {}
+        std_devs = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for col in cast_df.columns:
+                values = cast_df[col]
+                if col == vertical_name and not is_index:
+                    result[col] = bin_centres
+                elif pd.api.types.is_datetime64_any_dtype(values):
+                    times_ns = to_utc_ns(values)
+                    is_valid = times_ns != NAT_NS
+                    # Mean offset from the first time of the cast (nanoseconds since the epoch are too large for float sums)
+                    start_ns = times_ns[is_valid].min() if is_valid.any() else 0
+                    counts = np.bincount(bin_codes[is_valid], minlength=n_bins)
+                    sums = np.bincount(bin_codes[is_valid], weights=(times_ns[is_valid] - start_ns).astype(float), minlength=n_bins)
+                    mean_times = from_utc_ns(np.where(counts > 0, start_ns + np.round(sums / counts).astype(np.int64), NAT_NS))
+                    result[col] = mean_times if values.dt.tz is not None else mean_times.tz_localize(None)
+                else:
+                    numeric = values if pd.api.types.is_numeric_dtype(values) else pd.to_numeric(values, errors='coerce')
+                    if numeric.notna().sum() < values.notna().sum():
+                        # Not numeric (e.g. the station id), the same for the whole cast
+                        result[col] = values.to_numpy()[first_rows]
+                        continue
+                    # The means, then the squared offsets from them (e.g. the pressures of a deep bin have a small
+                    # spread around a large mean, which a plain sum of squares loses)
+                    counts, means, m2 = group_moments(group_ids=bin_codes, values=numeric.to_numpy(dtype=float, na_value=np.nan), n_groups=n_bins)
+                    result[col] = means
+                    std_devs[f'{col}_std_dev'] = std_devs_from_moments(counts=counts, m2=m2)
+        result.update(std_devs)
+        result[self.COUNT_COL] = np.bincount(bin_codes, minlength=n_bins)
+
+        binned_df = pd.DataFrame(result)
+        if is_index:
+            binned_df.index = pd.Index(bin_centres, name=vertical_name)
+        return binned_df
@@ -0,0 +1,180 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import yaml
+from utils.streaming_joiner import to_utc_ns
+
+# Runs the optimized stages of a project with both engines (execution engine 'reference' and 'fast') on the same
+# inputs, and reports the speedup of each stage and the columns whose values differ beyond the tolerances. Exits
+# with 1 if any stage differs or fails with either engine. E.g.:
+# python -m utils.engine_verifier projects/OCNMS/OCNMS_PPS/config.yaml --rtol 1e-9 --atol 1e-9
+
+
+class EngineVerifier:
+    """
+    Checks the fast engine of an aggregator against its reference engine, stage by stage. The source cache is
+    turned off so both engines really parse the sources.
+    """
+
+    def __init__(self, config_yaml: str, rtol: float = 1e-9, atol: float = 1e-9):
+        config_yaml = Path(config_yaml)
+        with open(config_yaml, 'r') as f:
+            aggregator_name = (yaml.safe_load(f).get('run_info', None) or {}).get('aggregator', 'MooringAggregator')
+        if aggregator_name == 'CtdBottleAggregator':
+            from utils.ctd_bottle_aggregator import CtdBottleAggregator as aggregator_class
+        else:
+            from utils.mooring_aggregator import MooringAggregator as aggregator_class
+
+        self.aggregator = aggregator_class(config_yaml=str(config_yaml))
+        self.aggregator.source_cache = None
+        self.rtol = rtol
+        self.atol = atol
+
+    def get_stages(self) -> dict:
+        """
+        The stages of the aggregator that have a reference and a fast engine: {stage name: function returning the
+        stage output}. Stages whose sources aren't used by the config (or are read differently, e.g. from the mooring
+        store) are left out.
+        """
+        aggregator = self.aggregator
+        stages = {}
+        if hasattr(aggregator, 'pps_df'):
+            stages['pps reader'] = aggregator.get_pps_df
+        if getattr(aggregator, 'ctd_file_type', None) == 'nc':
+            stages['ctd nc reader'] = aggregator.convert_ctd_nc_files_to_df
+        if hasattr(aggregator, 'ctd_df') and hasattr(aggregator, 'ocean_model_extraction'):
+            stages['ctd mooring model join'] = aggregator.FINALmerge_quag_ctd_mooring_oceanmodel
+        if not hasattr(aggregator, 'pps_df') or not hasattr(aggregator, 'add_pps_utc_times'):
+            return stages
+
+        # The pps samples merged with the quagmire (the same input for both engines)
+        quag_pps_df = aggregator.merge_pps_quag_on_station_rosette_localtime(quag_df=aggregator.quagmire_df)
+        stages['pps utc times'] = lambda: aggregator.add_pps_utc_times(quag_pps_df=quag_pps_df.copy())
+
+        aggregator.engine = 'fast'
+        pps_utc_df = aggregator.add_pps_utc_times(quag_pps_df=quag_pps_df.copy())
+        if hasattr(aggregator, aggregator.get_mooring_df_attr(merge='pps_windows')):
+            stages['pps mooring windows'] = lambda: aggregator.merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=pps_utc_df.copy())
+        if hasattr(aggregator, 'ocean_model_df'):
+            stages['pps ocean model windows'] = lambda: aggregator.merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=pps_utc_df.copy())
+        return stages
+
+    def verify(self) -> list:
+        """
+        Runs each stage with both engines. Returns a list of {stage, reference_seconds, fast_seconds, speedup,
+        differences} where differences is the output of compare_frames. A stage that raises with either engine is
+        recorded as {stage, errors: {engine: error}} and the remaining stages still run.
+        """
+        results = []
+        for stage, run_stage in self.get_stages().items():
+            outputs = {}
+            seconds = {}
+            errors = {}
+            for engine in ('reference', 'fast'):
+                self.aggregator.engine = engine
+                start = time.perf_counter()
+                try:
+                    outputs[engine] = run_stage()
+                except Exception as e:
+                    print(f"Stage {stage} failed with the {engine} engine: {e!r}")
+                    errors[engine] = repr(e)
+                seconds[engine] = time.perf_counter() - start
+            self.aggregator.engine = 'fast'
+
+            if errors:
+                results.append({'stage': stage, 'errors': errors})
+                continue
+            results.append({
+                'stage': stage,
+                'reference_seconds': seconds['reference'],
+                'fast_seconds': seconds['fast'],
+                'speedup': seconds['reference'] / seconds['fast'] if seconds['fast'] else float('inf'),
+                'differences': compare_frames(reference_df=outputs['reference'], fast_df=outputs['fast'], rtol=self.rtol, atol=self.atol),
+            })
+        return results
+
+
+def compare_frames(reference_df: pd.DataFrame, fast_df: pd.DataFrame, rtol: float, atol: float) -> list:
+    """
+    Column level differences between two outputs of a stage (rows compared in order). Numeric columns are compared
+    with the tolerances (NaN == NaN), time columns as UTC nanoseconds, and other columns as strings (missing ==
+    missing). Returns a list of {column, issue, mismatches, max_abs_diff, first_row} (empty if they match).
+    """
+    differences = []
+    reference_df = reference_df.reset_index(drop=True)
+    fast_df = fast_df.reset_index(drop=True)
+
+    for col in reference_df.columns.difference(fast_df.columns, sort=False):
+        differences.append({'column': str(col), 'issue': 'only in reference'})
+    for col in fast_df.columns.difference(reference_df.columns, sort=False):
+        differences.append({'column': str(col), 'issue': 'only in fast'})
+    if len(reference_df) != len(fast_df):
+        differences.append({'column': '', 'issue': f"{len(reference_df)} reference rows, {len(fast_df)} fast rows"})
+        return differences
+
+    for col in reference_df.columns.intersection(fast_df.columns, sort=False):
+        reference_values = reference_df[col]
+        fast_values = fast_df[col]
+        max_abs_diff = None
+        if pd.api.types.is_datetime64_any_dtype(reference_values) or pd.api.types.is_datetime64_any_dtype(fast_values):
+            reference_ns = to_utc_ns(reference_values).astype(float)
+            fast_ns = to_utc_ns(fast_values).astype(float)
+            reference_ns[reference_values.isna().to_numpy()] = np.nan
+            fast_ns[fast_values.isna().to_numpy()] = np.nan
+            matches = (reference_ns == fast_ns) | (np.isnan(reference_ns) & np.isnan(fast_ns))
+        elif pd.api.types.is_numeric_dtype(reference_values) and pd.api.types.is_numeric_dtype(fast_values):
+            reference_floats = reference_values.to_numpy(dtype=float, na_value=np.nan)
+            fast_floats = fast_values.to_numpy(dtype=float, na_value=np.nan)
+            matches = np.isclose(reference_floats, fast_floats, rtol=rtol, atol=atol, equal_nan=True)
+            if not matches.all():
+                max_abs_diff = float(np.nanmax(np.abs(reference_floats - fast_floats)[~matches], initial=np.nan))
+        else:
+            both_missing = (reference_values.isna() & fast_values.isna()).to_numpy()
+            matches = both_missing | (reference_values.astype(str) == fast_values.astype(str)).to_numpy()
+
+        if not matches.all():
+            differences.append({'column': str(col), 'issue': 'values differ', 'mismatches': int((~matches).sum()),
+                                'max_abs_diff': max_abs_diff, 'first_row': int(np.flatnonzero(~matches)[0])})
+    return differences
+
+
+def print_verification(results: list):
+    """
+    Prints the speedup and the differences of each stage
+    """
+    print(f"\n{'stage':<26}{'reference (s)':>15}{'fast (s)':>10}{'speedup':>9}  result")
+    for result in results:
+        if 'errors' in result:
+            print(f"{result['stage']:<26}  FAILED")
+            for engine, error in result['errors'].items():
+                print(f"    {engine}: {error}")
+            continue
+        status = 'OK' if not result['differences'] else f"{len(result['differences'])} columns differ"
+        print(f"{result['stage']:<26}{result['reference_seconds']:>15.2f}{result['fast_seconds']:>10.2f}{result['speedup']:>8.1f}x  {status}")
+        for difference in result['differences']:
+            details = ''
+            if 'mismatches' in difference:
+                details = f": {difference['mismatches']} rows (first row {difference['first_row']})"
+                if difference['max_abs_diff'] is not None:
+                    details += f", max abs diff {difference['max_abs_diff']:.3g}"
+            print(f"    {difference['column']} {difference['issue']}{details}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Check the fast engine against the reference engine, stage by stage.')
+    parser.add_argument('config_yaml', help='The config.yaml of the project to verify')
+    parser.add_argument('--rtol', type=float, default=1e-9, help='Relative tolerance of numeric values')
+    parser.add_argument('--atol', type=float, default=1e-9, help='Absolute tolerance of numeric values')
+    args = parser.parse_args(argv)
+
+    results = EngineVerifier(config_yaml=args.config_yaml, rtol=args.rtol, atol=args.atol).verify()
+    print_verification(results=results)
+
+    return 1 if any('errors' in result or result['differences'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
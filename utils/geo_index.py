@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import pickle
+import warnings
+from pathlib import Path
+import numpy as np
+from utils.atomic_write import atomic_write
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def lat_lon_to_xyz(lats, lons) -> np.ndarray:
+    """
+    Converts latitudes/longitudes (decimal degrees) to points on the unit sphere, so nearest neighbours by
+    straight line distance are also the nearest by great circle distance (and longitudes wrap correctly).
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+
+
+def chord_to_km(chord_distances) -> np.ndarray:
+    """
+    Converts straight line distances between points on the unit sphere to great circle distances in km
+    """
+    chord_distances = np.asarray(chord_distances, dtype=float)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord_distances / 2, 0, 1))
+
+
+class GeoIndex:
+    """
+    KD-tree over a set of latitude/longitude points for nearest point lookups.
+    """
+
+    def __init__(self, lats, lons):
+        from scipy.spatial import cKDTree # deferred (slow to import)
+
+        self.tree = cKDTree(lat_lon_to_xyz(lats=lats, lons=lons))
+
+    def nearest(self, lats, lons) -> tuple:
+        """
+        Returns the positions of the indexed points nearest to each lat/lon and their distances in km
+        """
+        chord_distances, positions = self.tree.query(lat_lon_to_xyz(lats=lats, lons=lons))
+        return positions, chord_to_km(chord_distances)
+
+
+class RomsGridLocator:
+    """
+    Finds the nearest wet (mask_rho == 1) rho grid cell of a full-domain ROMS file to latitudes/longitudes, within
+    max_distance_km (a position outside the grid or a bad position isn't snapped to a cell across the domain). The
+    KD-tree over the wet cells is built once per grid and cached on disk (keyed by the grid file's path, size and
+    modification time), so later runs don't read lat_rho/lon_rho again.
+    """
+
+    LAT_VAR = 'lat_rho'
+    LON_VAR = 'lon_rho'
+    MASK_VAR = 'mask_rho'
+    ETA_DIM = 'eta_rho'
+    XI_DIM = 'xi_rho'
+    DEFAULT_MAX_DISTANCE_KM = 5.0
+
+    def __init__(self, grid_nc_file: str, cache_dir: str = None, max_distance_km: float = None):
+        """
+        grid_nc_file: a ROMS file with the lat_rho/lon_rho (and optionally mask_rho) of the grid
+        cache_dir: where to keep the KD-tree of the grid (default: a .grid_index directory next to the grid file)
+        max_distance_km: the furthest a position can be from its wet cell (default DEFAULT_MAX_DISTANCE_KM)
+        """
+        self.grid_nc_file = Path(grid_nc_file)
+        self.max_distance_km = float(max_distance_km) if max_distance_km is not None else self.DEFAULT_MAX_DISTANCE_KM
+        self.cache_dir = Path(cache_dir) if cache_dir else self.grid_nc_file.parent / '.grid_index'
+        self.geo_index, self.wet_etas, self.wet_xis = self.load_or_build_index()
+
+    def locate(self, lats, lons) -> list:
+        """
+        Returns a list of ({eta_rho: i, xi_rho: j}, distance in km) of the nearest wet cell to each lat/lon. The
+        cell is None (with a warning) where the nearest wet cell is further than max_distance_km.
+        """
+        positions, distances_km = self.geo_index.nearest(lats=lats, lons=lons)
+        located = []
+        for lat, lon, position, distance_km in zip(np.asarray(lats), np.asarray(lons), positions, distances_km):
+            if not distance_km <= self.max_distance_km:
+                warnings.warn(f"{lat}, {lon} is {distance_km:.1f} km from the nearest wet cell of {self.grid_nc_file.name} "
+                              f"(more than {self.max_distance_km} km): outside the grid or a bad position, no cell used")
+                located.append((None, float(distance_km)))
+                continue
+            located.append(({self.ETA_DIM: int(self.wet_etas[position]), self.XI_DIM: int(self.wet_xis[position])}, float(distance_km)))
+        return located
+
+    def load_or_build_index(self) -> tuple:
+        """
+        Loads the cached KD-tree of the grid, or builds (and caches) it from the wet cells of the grid file.
+        Returns the GeoIndex and the eta/xi indices of the wet cells (in GeoIndex order).
+        """
+        stat = os.stat(self.grid_nc_file)
+        key_str = json.dumps([str(self.grid_nc_file.resolve()), stat.st_size, stat.st_mtime_ns])
+        cache_file = self.cache_dir / f"{self.grid_nc_file.stem}_{hashlib.sha256(key_str.encode('utf-8')).hexdigest()[:16]}.pkl"
+
+        if cache_file.exists():
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+
+        import xarray as xr # deferred (slow to import)
+
+        with xr.open_dataset(self.grid_nc_file) as ds:
+            lats = ds[self.LAT_VAR].values
+            lons = ds[self.LON_VAR].values
+            wet = ds[self.MASK_VAR].values == 1 if self.MASK_VAR in ds else np.ones(lats.shape, dtype=bool)
+
+        wet_etas, wet_xis = np.nonzero(wet)
+        index = (GeoIndex(lats=lats[wet], lons=lons[wet]), wet_etas, wet_xis)
+
+        with atomic_write(cache_file) as tmp_file:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(index, f)
+
+        return index
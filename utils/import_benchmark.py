@@ -0,0 +1,78 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Times how long the utils modules take to import, each in a fresh interpreter (like a short CLI run or a worker
+# process in a pool), and checks that the heavy dependencies are only imported when the processor that needs
+# them runs. Exits with 1 if a module goes over the budget or imports a heavy dependency at import time.
+#
+# Example:
+# python -m utils.import_benchmark --budget-ms 1500
+
+MODULES = [
+    'utils.mooring_aggregator',
+    'utils.ctd_bottle_aggregator',
+    'utils.batch_runner',
+    'utils.mooring_store',
+]
+
+# Only imported where they are used (see the deferred imports in the processors). pytz is deferred too, but
+# isn't checked because pandas 2 imports it anyway.
+HEAVY_MODULES = [
+    'xarray',
+    'netCDF4',
+    'scipy.io',
+    'scipy.spatial',
+    'ctd',
+    'timezonefinder',
+]
+
+_MEASURE_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module: str, repeats: int = 3) -> dict:
+    """
+    Imports the module in a fresh interpreter repeats times. Returns the best import time in ms and the heavy
+    modules that the import pulled in.
+    """
+    results = []
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-c', _MEASURE_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                                   capture_output=True, text=True, check=True)
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    return {
+        'module': module,
+        'ms': min(result['seconds'] for result in results) * 1000,
+        'heavy': results[0]['heavy'],
+    }
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the utils modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='The modules to import (default: the aggregators, batch_runner and mooring_store)')
+    parser.add_argument('--budget-ms', type=float, default=1500, help='The import time budget of each module in ms')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of fresh interpreters per module (the best time is kept)')
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f"{'module':<32}{'import (ms)':>12}  heavy modules imported")
+    for module in args.modules:
+        result = measure_import(module=module, repeats=args.repeats)
+        over_budget = result['ms'] > args.budget_ms
+        failed = failed or over_budget or bool(result['heavy'])
+        flag = '  OVER BUDGET' if over_budget else ''
+        print(f"{module:<32}{result['ms']:>12.0f}  {', '.join(result['heavy']) or '-'}{flag}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,9 @@
-import scipy.io as sio
-from scipy.io import loadmat
 import pandas as pd
 import re
 import numpy as np
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
+from utils.variable_selection import is_selected
 
 
 class MatFileProcessor:
@@ -13,7 +12,10 @@ class MatFileProcessor:
     Designed for OCNMS data structure but may work with similar formats.
     """
 
-    def __init__(self, sites: list, mat_file: str, sensors: list):
+    REQUIRED_FIELDS = ['time'] # data fields always read (the datetime column is made from time)
+    SERIES_FIELDS = ('data', 'lpdata') # the raw and the low-passed series of each variable
+
+    def __init__(self, sites: list, mat_file: str, sensors: list, variables: list = None, series: str = 'data'):
         """
         Initialize the processor.
 
@@ -21,23 +23,50 @@ class MatFileProcessor:
             sites: List of site IDs to process (should match variable names in .mat file)
             mat_file: Path to the .mat file
             sensors: List of sensor names for which to grab data from
+            variables: Optional list of the data fields to keep (e.g. temperature, salinity). All fields if None
+            series: The field of each variable to read, 'data' (the raw series) or 'lpdata' (the low-passed series)
         """
+        if series not in self.SERIES_FIELDS:
+            raise ValueError(f"Invalid mooring series: {series}. Must be one of {self.SERIES_FIELDS}.")
         self.sites = sites
         self.mat_file = mat_file
         self.sensors = sensors
+        self.variables = variables
+        self.series = series
 
     def get_ocnms_df_from_mat_file(self):
         """
         For OCNMS data - assumes a structure like data.keys() are variables
         which include the sensor_station_recoveryDate_?. Within each variable:
         data[var_name].dtype.names = ('file', 'data', 'db', 'lpdata'). Data is in 
-        the 'data' field which includes a shape of (1, 1). Assumes the times are in
-        UTC. TODO: May need to update to specify the timezone.
+        the 'data' field (or the low-passed 'lpdata' field, see self.series) which includes
+        a shape of (1, 1). Assumes the times are in UTC. TODO: May need to update to specify the timezone.
+        """
+        final_df = pd.concat(self.iter_ocnms_dfs_from_mat_file(), ignore_index=True)
+
+        return final_df
+
+    def iter_ocnms_dfs_from_mat_file(self):
+        """
+        Yields a data frame for each variable (sensor_station_recoveryDate_?) of the
+        .mat file that matches the sites and sensors. See get_ocnms_df_from_mat_file
+        for the expected structure. Used to stream the mooring data one variable at a time.
+        """
+        for mat_variable in self.iter_ocnms_variables_from_mat_file():
+            yield mat_variable['df']
+
+    def iter_ocnms_variables_from_mat_file(self):
+        """
+        Yields a dictionary for each variable (sensor_station_recoveryDate_?) of the .mat file that
+        matches the sites and sensors, with the variable name, site, sensor, the 'file' field of the
+        variable (the deployment's original data file) and the data frame of the 'data' (or 'lpdata') field.
         """
-        data = loadmat(self.mat_file)
+        from scipy.io import loadmat # deferred (slow to import)
+
+        # Only the variables of the sites and sensors are decoded
+        data = loadmat(self.mat_file, variable_names=self.get_matching_mat_variable_names())
         variable_structure = ['file', 'data', 'db', 'lpdata']
 
-        data_frames = []
         for var_name in data.keys():
             if not var_name.startswith('_'):
 
@@ -56,11 +85,17 @@ class MatFileProcessor:
                                     if sorted(var_struct) == sorted(variable_structure):
                         
                                         # Check if data has the expected shape
-                                        if data[var_name]['data'].shape == (1, 1):
+                                        if data[var_name][self.series].shape == (1, 1):
                                             # Create data frame
-                                            data_struct = data[var_name][0,0]['data'][0,0]
+                                            data_struct = data[var_name][0,0][self.series][0,0]
+                                            if data_struct.dtype.names is None:
+                                                # e.g. an empty lpdata for a deployment that wasn't low-passed
+                                                print(f"variable: {var_name} has no '{self.series}' series in {self.mat_file}, skipped")
+                                                continue
                                             data_dict = {}
                                             for field_name in data_struct.dtype.names:
+                                                if not is_selected(name=field_name, variables=self.variables, required=self.REQUIRED_FIELDS):
+                                                    continue
                                                 field_data = data_struct[field_name]
 
                                                 # Check it its an array or scalar
@@ -78,7 +113,16 @@ class MatFileProcessor:
 
                                             df = pd.DataFrame(data_dict)
                                             df['station_id'] = the_site
-                                            data_frames.append(df)
+
+                                            # Convert times to datetimes
+                                            df['datetime'] = df['time'].apply(self._matlab_datenum_to_datetime).dt.tz_localize('UTC')
+                                            yield {
+                                                'var_name': var_name,
+                                                'site': the_site,
+                                                'sensor': sensor,
+                                                'file': self._get_mat_string(data[var_name][0,0]['file']),
+                                                'df': df,
+                                            }
                                     
 
                                     # If variables structure does not have the expected field names (file, data, db, and lpdata)
@@ -88,12 +132,29 @@ class MatFileProcessor:
                                 else:
                                     raise ValueError(f"variable: {var_name} does not have a 1,1 shape!")
 
-        final_df = pd.concat(data_frames, ignore_index=True)
+    def get_matching_mat_variable_names(self) -> list:
+        """
+        The names of the variables of the .mat file (read from its header with whosmat) that have one of the sites
+        and one of the sensors in their name
+        """
+        from scipy.io import whosmat # deferred (slow to import)
 
-        # Convert times to datetimes
-        final_df['datetime'] = final_df['time'].apply(self._matlab_datenum_to_datetime).dt.tz_localize('UTC')
+        return [var_name for var_name, _, _ in whosmat(self.mat_file)
+                if not var_name.startswith('_')
+                and any(site in var_name for site in self.sites)
+                and any(sensor in var_name for sensor in self.sensors)]
 
-        return final_df
+    @staticmethod
+    def _get_mat_string(mat_value) -> str:
+        """
+        Gets a string out of a (possibly nested) MATLAB char array field. Returns None if it isn't one.
+        """
+        value = np.squeeze(mat_value)
+        while value.dtype == object and value.size == 1:
+            value = np.squeeze(value.item())
+        if value.dtype.kind in ('U', 'S') and value.size == 1:
+            return str(value.item())
+        return None
 
     @staticmethod
     def _matlab_datenum_to_datetime(datenum: float) -> pd.Timestamp:
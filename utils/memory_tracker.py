@@ -0,0 +1,51 @@
+import tracemalloc
+
+
+class MemoryTracker:
+    """
+    Tracks the peak memory of the phases of a run with tracemalloc (numpy, and so pandas, allocations are
+    traced too). Each mark() records the peak since the previous mark (or the start):
+
+    with MemoryTracker() as tracker:
+        aggregator = MooringAggregator(config_yaml=config_yaml)
+        tracker.mark('load')
+        final_df = aggregator.FINALmerge_quag_pps_mooring_oceanmodel()
+        tracker.mark('merge')
+    tracker.peaks_mb # {'load': ..., 'merge': ...}
+
+    Tracing slows allocations down, so it is only turned on when asked for (e.g. batch_runner --track-memory).
+    Memory used by worker processes (execution station_workers) is not included.
+    """
+
+    def __init__(self):
+        self.peaks_mb = {}
+        self._started = False
+
+    def __enter__(self):
+        # Leave tracing on if something else already started it
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._started:
+            tracemalloc.stop()
+        return False
+
+    def mark(self, phase: str) -> float:
+        """
+        Records (and returns) the peak traced memory in MB since the previous mark as the peak of the phase
+        """
+        _, peak = tracemalloc.get_traced_memory()
+        self.peaks_mb[phase] = peak / 1e6
+        tracemalloc.reset_peak()
+        return self.peaks_mb[phase]
+
+    @property
+    def peak_mb(self) -> float:
+        """
+        The highest peak of all the phases
+        """
+        return max(self.peaks_mb.values(), default=0.0)
@@ -3,11 +3,16 @@ from utils.mat_file_processor import MatFileProcessor
 from utils.netcdf_processor import NetcdfProcessor
 from utils.cnv_processor import CnvProcessor
 from utils.ros_processor import RosProcessor
+from utils.ctd_profile_binner import CtdProfileBinner
+from utils.streaming_joiner import NAT_NS, SampleTimeIndex, StreamingJoiner, to_utc_ns
+from utils.multiway_asof import MultiwayAsofJoin
+from utils.variable_selection import select_names
+from utils.mooring_store import MooringStore
+from utils.geo_index import RomsGridLocator
+from utils.ocean_model_file_index import OceanModelFileIndex, expand_file_patterns
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from timezonefinder import TimezoneFinder
-import pytz
 import datetime
 
 # TODO: update the merge_ctd_with_quag function to have a tolerance of '1H' (check with Zack) after running the OCNMS code (needs to be adjustable for the code)
@@ -21,34 +26,85 @@ class MooringAggregator(Aggregator):
     CTD_DATE_COL = 'ctd_time' # from the netcdfProcessor and/or cnvProcessor (must be the same)
     MOORING_DATE_COL = 'moor_datetime'  #mooring time is assumed to be UTC
 
-    def __init__(self, config_yaml: str):
-        super().__init__(config_yaml)
+    OCEAN_MODEL_EXTRACTIONS = ('frame', 'point_query', 'depth_resolved')
+    MOORING_MERGES = ('nearest', 'pps_windows') # the merges that can each use the raw or the low-passed mooring series
+    STATION_PARTITIONED_SOURCES = {**Aggregator.STATION_PARTITIONED_SOURCES,
+                                   'mooring_df': MOORING_STATION_ID_COL,
+                                   'mooring_lowpass_df': MOORING_STATION_ID_COL,
+                                   'ctd_df': CTD_STATION_COL,
+                                   'ocean_model_df': OCEAN_MODEL_STATION_COL}
+
+    def __init__(self, config_yaml: str, source_cache_dir: str = None):
+        super().__init__(config_yaml, source_cache_dir=source_cache_dir)
 
         # For Mooring data derived from .mat files
         self.mooring_mat_dir = Path(self.config_file['mooring_info']['mooring_data_dir'])
         self.moor_sensors = self.config_file['mooring_info'].get('sensors', None) # The name of the sensors to grab data
-        self.mooring_df = self.convert_mat_files_to_df()
+        # Optional variables of each source to read (pushed down to the readers, see utils/variable_selection.py)
+        self.moor_variables = self.get_source_variables(section='mooring_info')
+        self.ctd_variables = self.get_source_variables(section='ctd_data')
+        self.ocean_model_variables = self.get_source_variables(section='ocean_model_data')
+        # The .mat field each mooring merge reads: 'data' (raw, default) or 'lpdata' (the low-passed series, a fraction of the rows)
+        self.moor_series = self.get_mooring_series()
+        # Optional memory-mapped columnar store of the mooring data (built from the .mat files if missing or out of date).
+        # If used, merges query the store directly instead of loading self.mooring_df.
+        self.mooring_store_dir = self.config_file['mooring_info'].get('store_dir', None)
+        uses_raw_mooring = 'data' in self.moor_series.values()
+        if self.mooring_store_dir and uses_raw_mooring:
+            self.mooring_store = MooringStore.open_or_create(store_dir=self.mooring_store_dir,
+                                                             mat_files=sorted(self.mooring_mat_dir.rglob('*.mat')),
+                                                             sites=self.quag_station_sites,
+                                                             sensors=self.moor_sensors)
+        elif self.execution_mode == 'in_memory' and uses_raw_mooring:
+            self.mooring_df = self.convert_mat_files_to_df()
+        # The low-passed series is small, so it is loaded up front in both execution modes (the store only holds the raw series)
+        if 'lpdata' in self.moor_series.values():
+            self.mooring_lowpass_df = self.convert_mat_files_to_df(series='lpdata')
         
         # For CTD data derived (can be .NC or .CNV)
         if self.config_file.get('ctd_data', None):
             self.ctd_quag_merge_tolerance = self.config_file['ctd_data'].get('ctd_quag_merge_tolerance', None)
+            # Optional vertical binning of each .cnv/.ros cast as it is read (see utils/ctd_profile_binner.py)
+            self.ctd_profile_binner = CtdProfileBinner.from_config(ctd_data=self.config_file['ctd_data'])
             if self.config_file['ctd_data'].get('net_cdf_dir', None):
+                self.ctd_file_type = 'nc'
                 self.ctd_nc_file_directory = Path(self.config_file['ctd_data']['net_cdf_dir'])
-                self.ctd_df = self.convert_ctd_nc_files_to_df()
+                if self.execution_mode == 'in_memory':
+                    self.ctd_df = self.convert_ctd_nc_files_to_df()
             elif self.config_file['ctd_data'].get('cnv_dir', None):
+                self.ctd_file_type = 'cnv'
                 self.ctd_cnv_file_directory = Path(self.config_file['ctd_data']['cnv_dir'])
                 self.ctd_day_convention = self.config_file['ctd_data']['julian_day_convention']
-                self.ctd_df = self.convert_ctd_cnv_files_to_df()
+                if self.execution_mode == 'in_memory':
+                    self.ctd_df = self.convert_ctd_cnv_files_to_df()
             elif self.config_file['ctd_data'].get('ros_dir', None):
+                self.ctd_file_type = 'ros'
                 self.ctd_ros_file_directory = Path(self.config_file['ctd_data']['ros_dir'])
                 self.ctd_day_convention = self.config_file['ctd_data']['julian_day_convention']
-                self.ctd_df = self.convert_ctd_ros_files_to_df()
+                if self.execution_mode == 'in_memory':
+                    self.ctd_df = self.convert_ctd_ros_files_to_df()
 
         # For Ocean model data (.NC file)
-        self.model_data_files = self.config_file['ocean_model_data']['model_nc_files']
+        # Pre-extracted per station (station in the file name). Globs are expanded, and the files of a station (e.g. daily
+        # LiveOcean files) are read as one time series, opening only the files that overlap the times needed
+        self.model_data_files = self.get_ocean_model_data_files()
+        self.model_time_index_cache_dir = self.config_file['ocean_model_data'].get('time_index_cache_dir', None)
+        self.model_time_index = None # time range of each model_nc_file, built on first use (get_ocean_model_time_index)
+        # Full-domain ROMS files: each station's nearest wet grid cell is found with a KD-tree (cached in grid_cache_dir) and only its water column is read
+        self.model_grid_files = self.config_file['ocean_model_data'].get('grid_nc_files', None) or []
+        self.model_grid_cache_dir = self.config_file['ocean_model_data'].get('grid_cache_dir', None)
+        self.model_grid_max_distance_km = self.config_file['ocean_model_data'].get('grid_max_distance_km', None)
+        self.model_grid_cells = None # {grid file: {station: grid cell}}, found on first use (get_ocean_model_grid_cells)
         self.ocean_model_depth_var = self.config_file['ocean_model_data']['depth_variable_name']
         self.ocean_model_time_dim_name = self.config_file['ocean_model_data']['time_dim_name']
-        self.ocean_model_df = self.convert_ocean_model_nc_to_df()
+        # 'frame' (default) builds self.ocean_model_df for the whole quagmire date range up front. 'point_query' reads
+        # only the model time steps nearest to the samples (or inside the pps windows) at merge time. 'depth_resolved' is
+        # 'point_query' with the nearest matches interpolated to each sample's depth instead of depth averaged.
+        self.ocean_model_extraction = self.config_file['ocean_model_data'].get('extraction', 'frame')
+        if self.ocean_model_extraction not in self.OCEAN_MODEL_EXTRACTIONS:
+            raise ValueError(f"Invalid ocean model extraction: {self.ocean_model_extraction}. Must be one of {self.OCEAN_MODEL_EXTRACTIONS}.")
+        if self.execution_mode == 'in_memory' and self.ocean_model_extraction == 'frame':
+            self.ocean_model_df = self.convert_ocean_model_nc_to_df()
 
     def FINALmerge_quag_pps_mooring_oceanmodel(self):
         """
@@ -61,12 +117,14 @@ class MooringAggregator(Aggregator):
 
         # Since pps data does not have timezone info, but times are in local need to get timezone info from quagmire and create start/end utc times for pps
         # important for merging pps data with ocean_model data (which is in UTC). 
-        quag_pps_merged[self.PPS_UTC_START_TIME_COL] = quag_pps_merged.apply(lambda row: self.convert_local_time_to_utc(local_dt=row[self.PPS_LOCAL_START_DATE_COL], timezone=row[self.quag_local_time_zone_col], sample_name=row[self.quag_sample_name_col]), axis=1)
-        quag_pps_merged[self.PPS_UTC_END_TIME_COL] = quag_pps_merged.apply(lambda row: self.convert_local_time_to_utc(local_dt=row[self.PPS_LOCAL_END_DATE_COL], timezone=row[self.quag_local_time_zone_col], sample_name=row[self.quag_sample_name_col]), axis=1)
-        
+        quag_pps_merged = self.add_pps_utc_times(quag_pps_df=quag_pps_merged)
         
-        quag_pps_mooring_merged = self.merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=quag_pps_merged)
-        quag_pps_mooring_ocean_model_merged = self.merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=quag_pps_mooring_merged)
+        if self.execution_mode == 'streaming':
+            quag_pps_mooring_merged = self.stream_merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=quag_pps_merged)
+            quag_pps_mooring_ocean_model_merged = self.stream_merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=quag_pps_mooring_merged)
+        else:
+            quag_pps_mooring_merged = self.merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=quag_pps_merged)
+            quag_pps_mooring_ocean_model_merged = self.merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=quag_pps_mooring_merged)
 
         # remove any columns that are entirely empty
         final_df = quag_pps_mooring_ocean_model_merged.dropna(axis=1, how='all')
@@ -77,10 +135,15 @@ class MooringAggregator(Aggregator):
         """
         Merges the Quagmire, CTD, mooring, and ocean model data together.
         """
-        
-        quag_ctd_df = self.merge_ctd_quag_on_station_utctime(quag_df=self.quagmire_df)
-        quag_ctd_mooring_df = self.merge_moor_quag_on_station_utctime(quag_df=quag_ctd_df)
-        quag_ctd_mooring_ocean_df = self.merge_oceanmodel_quag_on_station_utctime(quag_df=quag_ctd_mooring_df)
+        if self.execution_mode == 'streaming':
+            return self.stream_merge_quag_ctd_mooring_oceanmodel()
+
+        if self.engine == 'reference':
+            quag_ctd_df = self.merge_ctd_quag_on_station_utctime(quag_df=self.quagmire_df)
+            quag_ctd_mooring_df = self.merge_moor_quag_on_station_utctime(quag_df=quag_ctd_df)
+            quag_ctd_mooring_ocean_df = self.merge_oceanmodel_quag_on_station_utctime(quag_df=quag_ctd_mooring_df)
+        else:
+            quag_ctd_mooring_ocean_df = self.multiway_merge_quag_ctd_mooring_oceanmodel()
         
         # remove any columns that are entirely empty
         final_df = quag_ctd_mooring_ocean_df.dropna(axis=1, how='all')
@@ -88,116 +151,370 @@ class MooringAggregator(Aggregator):
 
         return final_df
     
-    def convert_mat_files_to_df(self) -> pd.DataFrame:
+    def get_source_provenance(self) -> dict:
+        """
+        Adds the mooring, CTD and ocean model input files to the provenance of the Aggregator
+        """
+        provenance = super().get_source_provenance()
+        provenance['moor_'] = f"mooring .mat files in {self.mooring_mat_dir} (sensors: {self.moor_sensors or 'all'}, series: {', '.join(f'{merge} {field}' for merge, field in self.moor_series.items())})"
+        if self.config_file.get('ctd_data', None):
+            ctd_dir = {'nc': getattr(self, 'ctd_nc_file_directory', None),
+                       'cnv': getattr(self, 'ctd_cnv_file_directory', None),
+                       'ros': getattr(self, 'ctd_ros_file_directory', None)}[self.ctd_file_type]
+            provenance['ctd_'] = f"CTD .{self.ctd_file_type} files in {ctd_dir}"
+        provenance['model_'] = f"ocean model files {', '.join(str(f) for f in [*self.model_data_files, *self.model_grid_files])} (depth averaged over {self.ocean_model_depth_var})"
+        return provenance
+
+    def get_mooring_series(self) -> dict:
+        """
+        {merge: .mat field} of the mooring merges, from the optional series of the mooring_info section, e.g.
+        series: {pps_windows: lpdata}. Merges that aren't listed read the raw 'data' field.
+        """
+        series = self.config_file['mooring_info'].get('series', None) or {}
+        for merge, field in series.items():
+            if merge not in self.MOORING_MERGES:
+                raise ValueError(f"Invalid mooring merge: {merge}. Must be one of {self.MOORING_MERGES}.")
+            if field not in MatFileProcessor.SERIES_FIELDS:
+                raise ValueError(f"Invalid mooring series for {merge}: {field}. Must be one of {MatFileProcessor.SERIES_FIELDS}.")
+        return {merge: series.get(merge, 'data') for merge in self.MOORING_MERGES}
+
+    def get_mooring_df_attr(self, merge: str) -> str:
+        """
+        The attribute of the in memory mooring data frame the merge uses ('mooring_lowpass_df' or 'mooring_df')
+        """
+        return 'mooring_lowpass_df' if self.moor_series[merge] == 'lpdata' else 'mooring_df'
+
+    def get_mooring_df(self, merge: str) -> pd.DataFrame:
+        """
+        The in memory mooring data frame the merge uses (self.mooring_lowpass_df or self.mooring_df)
+        """
+        return getattr(self, self.get_mooring_df_attr(merge=merge))
+
+    def uses_mooring_store(self, merge: str) -> bool:
+        """
+        True if the merge reads the mooring store (which only holds the raw series)
+        """
+        return bool(self.mooring_store_dir) and self.moor_series[merge] == 'data'
+
+    def convert_mat_files_to_df(self, series: str = 'data') -> pd.DataFrame:
         # TODO: upate hardcoded sites in the convert_mat_files_to_dfs to not be hardcoded (take from Quagmire sites)
         """
         Converts the mooring .mat files associated with the Aggregator to pandas
-        data frame (concats all .mat dfs together)
+        data frame (concats all .mat dfs together). series is the .mat field read, 'data'
+        (raw) or 'lpdata' (low-passed).
         """
 
-        all_mat_files = list(self.mooring_mat_dir.rglob('*.mat'))
-        mooring_dfs = []
-        for mat_file in all_mat_files:
-            mat_processor = MatFileProcessor(
-                sites=self.quag_station_sites, mat_file=mat_file, sensors=self.moor_sensors)
+        all_mat_files = sorted(self.mooring_mat_dir.rglob('*.mat'))
 
-            mooring_df = mat_processor.get_ocnms_df_from_mat_file()
-            mooring_dfs.append(mooring_df)
+        def parse_mat_files():
+            mooring_dfs = []
+            for mat_file in all_mat_files:
+                mat_processor = MatFileProcessor(
+                    sites=self.quag_station_sites, mat_file=mat_file, sensors=self.moor_sensors, variables=self.moor_variables, series=series)
 
-        df = pd.concat(mooring_dfs, ignore_index=True)
+                mooring_df = mat_processor.get_ocnms_df_from_mat_file()
+                mooring_dfs.append(mooring_df)
+            return pd.concat(mooring_dfs, ignore_index=True)
 
-        df = df.add_prefix('moor_')
-        df_cleaned = df.dropna(axis=1, how='all')
+        df = self.load_source(source_name='mooring' if series == 'data' else 'mooring_lowpass', files=all_mat_files,
+                              params={'sites': sorted(self.quag_station_sites), 'sensors': self.moor_sensors, 'variables': self.moor_variables},
+                              create_func=parse_mat_files)
 
-        return df_cleaned
+        df = self.prefix_columns(df=df, prefix='moor_')
+        df = self.drop_empty_columns(df=df)
+        self.prepare_merge_source(df=df, time_col=self.MOORING_DATE_COL, station_col=self.MOORING_STATION_ID_COL)
+
+        return df
     
     def convert_ctd_nc_files_to_df(self) -> pd.DataFrame:
         """
         Converts all the associated .nc files in the config.yaml into a data frame. Concats them all
         together to return one dataframe. Assumes that ctd files are all in the same directory.
+        The files are read in one batch (see NetcdfProcessor.convert_ctd_nc_files_to_df), or one at a time
+        with the reference engine.
+        """
+        nc_files_needed = self.get_ctd_nc_files_needed()
+
+        def parse_nc_files():
+            if self.engine == 'reference':
+                return pd.concat([NetcdfProcessor(nc_file=nc_file, variables=self.ctd_variables).convert_ctd_nc_to_df() for nc_file in nc_files_needed], ignore_index=True)
+            return NetcdfProcessor.convert_ctd_nc_files_to_df(nc_files=nc_files_needed, variables=self.ctd_variables)
+
+        df = self.load_source(source_name='ctd_nc', files=nc_files_needed, params={'engine': self.engine, 'variables': self.ctd_variables},
+                              create_func=parse_nc_files)
+        df = self.prefix_columns(df=df, prefix='ctd_')
+        df = self.assign_ctd_stations_by_position(df=df)
+        df = self.drop_empty_columns(df=df)
+        self.prepare_merge_source(df=df, time_col=self.CTD_DATE_COL, station_col=self.CTD_STATION_COL)
+
+        return df
+
+    def assign_ctd_stations_by_position(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        With a station registry, the CTD records that have a position (ctd_latitude/ctd_longitude columns, units
+        appended or not) are assigned to the nearest station, all rows at once, instead of the station in the file name
+        """
+        if self.station_registry is None:
+            return df
+        lat_cols = select_names(names=df.columns, variables=['ctd_latitude'])
+        lon_cols = select_names(names=df.columns, variables=['ctd_longitude'])
+        if not lat_cols or not lon_cols:
+            return df
+        return self.station_registry.assign_station_col(df=df, station_col=self.CTD_STATION_COL, lat_col=lat_cols[0], lon_col=lon_cols[0])
+
+    def get_ctd_nc_files_needed(self) -> list:
+        """
+        Gets the ctd .nc files (recursively) in the ctd net_cdf_dir that have one of the quagmire station_ids
+        in their path.
         """
         # Recurseivly find all .nc files in the directory
-        all_nc_files = list(self.ctd_nc_file_directory.rglob('*.nc'))
+        all_nc_files = sorted(self.ctd_nc_file_directory.rglob('*.nc'))
 
         # Filter the list of all_nc_files based on the station_ids
         nc_files_needed = [
             f for f in all_nc_files if any(station_id in str(f) for station_id in self.quag_station_sites)
         ]
+        return nc_files_needed
 
-        nc_dfs = []
-        for nc_file in nc_files_needed:
-            nc_processor = NetcdfProcessor(nc_file=nc_file)
-            nc_df = nc_processor.convert_ctd_nc_to_df()
-            nc_dfs.append(nc_df)
+    def get_ocean_model_file_station(self, nc_file: str) -> str:
+        """
+        Find first quagmire station in the ocean model file name (or None if no match)
+        """
+        return next(
+            (station for station in self.quag_station_sites if station in nc_file),
+            None
+        )
 
-        df = pd.concat(nc_dfs, ignore_index=True)
-        df = df.add_prefix('ctd_')
-        df_cleaned = df.dropna(axis=1, how='all')
+    def get_ocean_model_data_files(self) -> list:
+        """
+        The model_nc_files of the config, with the globs expanded (see utils/ocean_model_file_index.py)
+        """
+        return expand_file_patterns(patterns=self.config_file['ocean_model_data'].get('model_nc_files', None))
 
-        return df_cleaned
+    def get_ocean_model_time_index(self) -> OceanModelFileIndex:
+        """
+        The time range of each model_nc_file that has a quagmire station in its name (see
+        utils/ocean_model_file_index.py), read from the files once and cached on disk
+        """
+        if self.model_time_index is None:
+            station_files = [f for f in self.model_data_files if self.get_ocean_model_file_station(nc_file=f)]
+            self.model_time_index = OceanModelFileIndex(nc_files=station_files,
+                                                        time_dim_name=self.ocean_model_time_dim_name,
+                                                        cache_dir=self.model_time_index_cache_dir)
+        return self.model_time_index
+
+    def iter_ocean_model_files(self, overlaps_func=None):
+        """
+        Yields (nc_file, station, grid_cell) for each station's ocean model data: the pre-extracted model_nc_files that
+        have a quagmire station in their name (grid_cell None), and each station's grid cell in the full-domain
+        grid_nc_files. The model_nc_files of a station are yielded in time order (files without time steps are skipped),
+        and if overlaps_func(station, first_ns, last_ns) is given, only those whose time range (UTC ns) it returns True for.
+        """
+        station_files = {}
+        for nc_file in self.model_data_files:
+            matching_station = self.get_ocean_model_file_station(nc_file=nc_file)
+            if matching_station:
+                station_files.setdefault(matching_station, []).append(nc_file)
+
+        time_index = self.get_ocean_model_time_index() if station_files else None
+        for matching_station, nc_files in station_files.items():
+            for nc_file in time_index.sort_by_time(nc_files=nc_files):
+                first_ns, last_ns = time_index.time_range(nc_file=nc_file)
+                if first_ns is None or (overlaps_func is not None and not overlaps_func(matching_station, first_ns, last_ns)):
+                    continue
+                yield nc_file, matching_station, None
+
+        for grid_file, station_cells in self.get_ocean_model_grid_cells().items():
+            for station, grid_cell in station_cells.items():
+                yield grid_file, station, grid_cell
+
+    def get_ocean_model_grid_cells(self) -> dict:
+        """
+        Finds the nearest wet rho grid cell of each full-domain ocean model file to each station (at the mean
+        latitude/longitude of the station's quagmire samples). Returns {grid file: {station: {eta_rho: i, xi_rho: j}}}.
+        Stations further than grid_max_distance_km from every wet cell of a grid get no model data from it.
+        """
+        if self.model_grid_cells is not None:
+            return self.model_grid_cells
+
+        self.model_grid_cells = {}
+        if not self.model_grid_files:
+            return self.model_grid_cells
+
+        station_coords = (self.quagmire_df
+                          .groupby(self.quagmire_df[self.quag_site_col_name].astype(str))[[self.quagmire_creator.NEW_LAT_DEC_DEG_COL, self.quagmire_creator.NEW_LON_DEC_DEG_COL]]
+                          .mean()
+                          .dropna())
+        station_coords = station_coords[station_coords.index.isin([str(station) for station in self.quag_station_sites])]
+
+        for grid_file in self.model_grid_files:
+            grid_locator = RomsGridLocator(grid_nc_file=grid_file, cache_dir=self.model_grid_cache_dir,
+                                           max_distance_km=self.model_grid_max_distance_km)
+            located = grid_locator.locate(lats=station_coords[self.quagmire_creator.NEW_LAT_DEC_DEG_COL],
+                                          lons=station_coords[self.quagmire_creator.NEW_LON_DEC_DEG_COL])
+            self.model_grid_cells[grid_file] = {}
+            for station, (grid_cell, distance_km) in zip(station_coords.index, located):
+                if grid_cell is None:
+                    continue
+                print(f"Station {station}: ocean model grid cell {grid_cell} of {grid_file} ({distance_km:.2f} km away)")
+                self.model_grid_cells[grid_file][station] = grid_cell
+
+        return self.model_grid_cells
 
     def convert_ocean_model_nc_to_df(self) -> pd.DataFrame:
 
         nc_dfs = []
-    
-        for nc_file in self.model_data_files:
-            # Find first matching station  (or None if no match)
-            matching_station = next(
-                (station for station in self.quag_station_sites if station in nc_file),
-                None
-            )
-            if matching_station:
-                nc_processor = NetcdfProcessor(nc_file=nc_file)
-                nc_df = nc_processor.convert_rom_ocean_model_to_df(min_depth=self.quag_min_depth,
-                                                                max_depth=self.quag_max_depth,
-                                                                depth_var_name=self.ocean_model_depth_var,
-                                                                time_dim_name=self.ocean_model_time_dim_name,
-                                                                start_time=self.quag_min_date,
-                                                                end_time=self.quag_max_date, 
-                                                                station=matching_station)
-                nc_dfs.append(nc_df)
+
+        # Only the model files with time steps in the quagmire date range (the whole max date is included)
+        start_ns = OceanModelFileIndex.to_ns(self.quag_min_date)
+        end_ns = OceanModelFileIndex.to_ns(self.quag_max_date) + pd.Timedelta('1D').value - 1
+        overlaps_quag_dates = lambda station, first_ns, last_ns: first_ns <= end_ns and last_ns >= start_ns
+
+        for nc_file, matching_station, grid_cell in self.iter_ocean_model_files(overlaps_func=overlaps_quag_dates):
+            nc_processor = NetcdfProcessor(nc_file=nc_file, variables=self.ocean_model_variables)
+            model_params = {'min_depth': self.quag_min_depth,
+                            'max_depth': self.quag_max_depth,
+                            'depth_var_name': self.ocean_model_depth_var,
+                            'time_dim_name': self.ocean_model_time_dim_name,
+                            'start_time': self.quag_min_date,
+                            'end_time': self.quag_max_date,
+                            'station': matching_station,
+                            'grid_cell': grid_cell}
+            nc_df = self.load_source(source_name='ocean_model', files=[nc_file], params={**model_params, 'variables': self.ocean_model_variables},
+                                     create_func=lambda: nc_processor.convert_rom_ocean_model_to_df(**model_params))
+            nc_dfs.append(nc_df)
         df = pd.concat(nc_dfs, ignore_index=True)
-        df = df.add_prefix('model_')
-        df_cleaned = df.dropna(axis=1, how='all')
-        print(f"stations: {df_cleaned['model_station'].unique()}")
-        return df_cleaned
+        # Consecutive files of a station can share a time step (e.g. daily files that include midnight at both ends)
+        df = df.drop_duplicates(subset=[self.ocean_model_time_dim_name, 'station'], keep='first').reset_index(drop=True)
+        df = self.prefix_columns(df=df, prefix='model_')
+        df = self.drop_empty_columns(df=df)
+        # Ocean model times are UTC, made time zone aware here once for all the merges
+        self.prepare_merge_source(df=df, time_col=f"model_{self.ocean_model_time_dim_name}", station_col=self.OCEAN_MODEL_STATION_COL, utc=True)
+        print(f"stations: {df['model_station'].unique()}")
+        return df
+
+    def bin_ctd_cast(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        The cast binned vertically if the config has profile_binning in ctd_data, otherwise as it is. None (a file
+        that matches no quagmire site) stays None, so it is dropped by the concat like before.
+        """
+        if self.ctd_profile_binner is None or df is None:
+            return df
+        return self.ctd_profile_binner.bin_cast(cast_df=df)
 
     def convert_ctd_cnv_files_to_df(self) -> pd.DataFrame:
         """
         Converts all the associated .cnv files in the config.yaml into a data frame. Concats them all
         together to return one dataframe. Assumes the ctd files are all in the same directory
         """
-        all_cnv_files = list(self.ctd_cnv_file_directory.rglob('*.cnv'))
-
-        cnv_dfs = []
-        for cnv_file in all_cnv_files:
-            cnv_processor = CnvProcessor(cnv_file=cnv_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention)
-            cnv_df = cnv_processor.cnv_df
-            cnv_dfs.append(cnv_df)
-        
-        df = pd.concat(cnv_dfs, ignore_index=False)
-        df = df.add_prefix('ctd_')
-        df_cleaned = df.dropna(axis=1, how='all')
-        return df_cleaned
+        all_cnv_files = sorted(self.ctd_cnv_file_directory.rglob('*.cnv'))
+
+        def parse_cnv_files():
+            cnv_dfs = []
+            for cnv_file in all_cnv_files:
+                cnv_processor = CnvProcessor(cnv_file=cnv_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention, variables=self.ctd_variables,
+                                             station_registry=self.station_registry)
+                cnv_df = self.bin_ctd_cast(df=cnv_processor.cnv_df)
+                cnv_dfs.append(cnv_df)
+            return pd.concat(cnv_dfs, ignore_index=False)
+
+        df = self.load_source(source_name='ctd_cnv', files=all_cnv_files,
+                              params={'sites': sorted(self.quag_station_sites), 'day_convention': self.ctd_day_convention, 'variables': self.ctd_variables,
+                                      'station_registry': self.station_registry.to_params() if self.station_registry else None,
+                                      'profile_binning': self.ctd_profile_binner.to_params() if self.ctd_profile_binner else None},
+                              create_func=parse_cnv_files)
+        df = self.prefix_columns(df=df, prefix='ctd_')
+        df = self.drop_empty_columns(df=df)
+        self.prepare_merge_source(df=df, time_col=self.CTD_DATE_COL, station_col=self.CTD_STATION_COL)
+        return df
     
     def convert_ctd_ros_files_to_df(self) -> pd.DataFrame:
         """
         Converts all the associated .ros files in the config.yaml into a data frame. Concats them all
         together to return one dataframe. Assumes the ctd files are all in the same directory
         """
-        all_ros_files = list(self.ctd_ros_file_directory.rglob('*.ros'))
-
-        ros_dfs = []
-        for ros_file in all_ros_files:
-            ros_processor = RosProcessor(ros_file=ros_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention)
-            ros_df = ros_processor.ros_df
-            ros_dfs.append(ros_df)
-        
-        df = pd.concat(ros_dfs, ignore_index=False)
-        df = df.add_prefix('ctd_')
-        df_cleaned = df.dropna(axis=1, how='all')
-        return df_cleaned
+        all_ros_files = sorted(self.ctd_ros_file_directory.rglob('*.ros'))
+
+        def parse_ros_files():
+            ros_dfs = []
+            for ros_file in all_ros_files:
+                ros_processor = RosProcessor(ros_file=ros_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention, variables=self.ctd_variables,
+                                             station_registry=self.station_registry)
+                ros_df = self.bin_ctd_cast(df=ros_processor.ros_df)
+                ros_dfs.append(ros_df)
+            return pd.concat(ros_dfs, ignore_index=False)
+
+        df = self.load_source(source_name='ctd_ros', files=all_ros_files,
+                              params={'sites': sorted(self.quag_station_sites), 'day_convention': self.ctd_day_convention, 'variables': self.ctd_variables,
+                                      'station_registry': self.station_registry.to_params() if self.station_registry else None,
+                                      'profile_binning': self.ctd_profile_binner.to_params() if self.ctd_profile_binner else None},
+                              create_func=parse_ros_files)
+        df = self.prefix_columns(df=df, prefix='ctd_')
+        df = self.drop_empty_columns(df=df)
+        self.prepare_merge_source(df=df, time_col=self.CTD_DATE_COL, station_col=self.CTD_STATION_COL)
+        return df
     
+    def prepare_merge_source(self, df: pd.DataFrame, time_col: str, station_col: str, utc: bool = False):
+        """
+        Converts the time and station columns of a loaded source to the types the merges use and sorts it by
+        time then station. Done once, in place, at load time so the merges can use the source as is instead of
+        sorting and converting a copy of it every time.
+        """
+        df[time_col] = pd.to_datetime(df[time_col], utc=utc)
+        df[station_col] = df[station_col].astype(str)
+        df.sort_values([time_col, station_col], inplace=True, ignore_index=True)
+
+    def sort_quag_for_utc_merge(self, quag_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Returns the quag_df sorted by the 'on' key first which is utc time, then the 'by' key which is station,
+        with the types the merges use. The output of a previous merge in the chain is already sorted and converted,
+        so it is returned as is instead of being copied again.
+        """
+        quag_times = quag_df[self.quag_utc_date_time_col]
+        quag_stations = quag_df[self.quag_site_col_name]
+        if (pd.api.types.is_datetime64_any_dtype(quag_times) and pd.api.types.is_string_dtype(quag_stations)
+                and pd.MultiIndex.from_arrays([quag_times, quag_stations]).is_monotonic_increasing):
+            return quag_df
+
+        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name])
+        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
+        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
+        return quag_df_sorted
+
+    def multiway_merge_quag_ctd_mooring_oceanmodel(self) -> pd.DataFrame:
+        """
+        Same output as the merge_ctd_quag_on_station_utctime -> merge_moor_quag_on_station_utctime ->
+        merge_oceanmodel_quag_on_station_utctime chain (same tolerances, columns and row order), but the quagmire
+        is sorted once and each source's nearest records are gathered separately and concatenated once (see
+        utils/multiway_asof.py).
+        """
+        ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
+        joiner = MultiwayAsofJoin(sample_df=self.quagmire_df, time_col=self.quag_utc_date_time_col, station_col=self.quag_site_col_name)
+        quag_df_sorted = joiner.sample_df
+
+        # CTD
+        ctd_matches = joiner.nearest(source_df=self.ctd_df, time_col=self.CTD_DATE_COL, station_col=self.CTD_STATION_COL,
+                                     tolerance=self.ctd_quag_merge_tolerance or '1h')
+        ctd_matches['ctd_quag_time_difference'] = abs(quag_df_sorted[self.quag_utc_date_time_col] - ctd_matches[self.CTD_DATE_COL])
+
+        # Mooring
+        if self.uses_mooring_store(merge='nearest'):
+            moor_matches = self.stream_mooring_matches(quag_df_sorted=quag_df_sorted)
+        else:
+            moor_matches = joiner.nearest(source_df=self.get_mooring_df(merge='nearest'), time_col=self.MOORING_DATE_COL,
+                                          station_col=self.MOORING_STATION_ID_COL, tolerance='1h')
+
+        # Ocean model
+        if self.ocean_model_extraction != 'frame':
+            model_matches = self.point_query_ocean_model_at_quag_times(quag_df_sorted=quag_df_sorted, tolerance='1h')
+            if ocean_model_time_col in model_matches:
+                model_matches[ocean_model_time_col] = pd.to_datetime(model_matches[ocean_model_time_col], utc=True)
+        else:
+            model_matches = joiner.nearest(source_df=self.ocean_model_df, time_col=ocean_model_time_col,
+                                           station_col=self.OCEAN_MODEL_STATION_COL, tolerance='1h')
+
+        return joiner.join(match_dfs=[ctd_matches, moor_matches, model_matches])
+
     def merge_ctd_quag_on_station_utctime(self, quag_df: pd.DataFrame, tolerance: str = '1h') -> pd.DataFrame:
         """
         Merges quagmire dataframe with ctd data frame on utc time by station. The CnvProcessor 
@@ -207,15 +524,8 @@ class MooringAggregator(Aggregator):
         has already been merged with other data if desired. Otherwise just use self.quagmire_df.
         tolerance is default 1 hour, but can change this in yaml file.
         """
-        # Sort quag_df and mooring_df by the 'on' key first which is time, then the 'by' key which is station
-        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name])
-        ctd_sorted = self.ctd_df.sort_values([self.CTD_DATE_COL, self.CTD_STATION_COL])
-
-        # Convert columns to the same types
-        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
-        ctd_sorted[self.CTD_DATE_COL] = pd.to_datetime(ctd_sorted[self.CTD_DATE_COL])
-        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
-        ctd_sorted[self.CTD_STATION_COL] = ctd_sorted[self.CTD_STATION_COL].astype(str)
+        # The ctd_df is sorted and converted at load time (prepare_merge_source)
+        quag_df_sorted = self.sort_quag_for_utc_merge(quag_df=quag_df)
 
         # If the ctd_quag_merge_tolerance is provided in the config.yaml file, update the tolerance, otherwise 
         # use default of 1 hour.
@@ -225,7 +535,7 @@ class MooringAggregator(Aggregator):
     
         result = pd.merge_asof(
             quag_df_sorted,
-            ctd_sorted,
+            self.ctd_df,
             left_on = self.quag_utc_date_time_col,
             right_on = self.CTD_DATE_COL,
             left_by = self.quag_site_col_name,
@@ -247,19 +557,15 @@ class MooringAggregator(Aggregator):
         Takes quag_df as an input because quag_df could be the self.quagmire_df already
         merged with another data type
         """
-        # Sort quag_df and mooring_df by the 'on' key first which is time, then the 'by' key which is station
-        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name])
-        moor_df_sorted = self.mooring_df.sort_values([self.MOORING_DATE_COL, self.MOORING_STATION_ID_COL])
+        if self.uses_mooring_store(merge='nearest'):
+            return self.stream_merge_moor_quag_on_station_utctime(quag_df=quag_df)
 
-        # Convert columns to the same types
-        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
-        moor_df_sorted[self.MOORING_DATE_COL] = pd.to_datetime(moor_df_sorted[self.MOORING_DATE_COL])
-        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
-        moor_df_sorted[self.MOORING_STATION_ID_COL] = moor_df_sorted[self.MOORING_STATION_ID_COL].astype(str)
+        # The mooring_df is sorted and converted at load time (prepare_merge_source)
+        quag_df_sorted = self.sort_quag_for_utc_merge(quag_df=quag_df)
     
         result = pd.merge_asof(
             quag_df_sorted,
-            moor_df_sorted,
+            self.get_mooring_df(merge='nearest'),
             left_on = self.quag_utc_date_time_col,
             right_on = self.MOORING_DATE_COL,
             left_by = self.quag_site_col_name,
@@ -278,21 +584,17 @@ class MooringAggregator(Aggregator):
         Ocean model data is filtered to be in range of min/max depth of quag (to the nearest 5).
         Assumes Ocean Model data is in UTC time.
         """
+        if self.ocean_model_extraction != 'frame':
+            return self.point_query_merge_oceanmodel_quag_on_station_utctime(quag_df=quag_df)
+
         ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
        
-        # Sort quag_df and mooring_df by the 'on' key first which is time, then the 'by' key which is station
-        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name])
-        ocean_model_df_sorted = self.ocean_model_df.sort_values([ocean_model_time_col, self.OCEAN_MODEL_STATION_COL])
-
-        # Convert columns to the same types
-        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
-        ocean_model_df_sorted[ocean_model_time_col] = pd.to_datetime(ocean_model_df_sorted[ocean_model_time_col], utc=True) # Updates time zone aware of ocean model to True
-        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
-        ocean_model_df_sorted[self.OCEAN_MODEL_STATION_COL] = ocean_model_df_sorted[self.OCEAN_MODEL_STATION_COL].astype(str)
+        # The ocean_model_df is sorted and converted (time zone aware UTC) at load time (prepare_merge_source)
+        quag_df_sorted = self.sort_quag_for_utc_merge(quag_df=quag_df)
     
         result = pd.merge_asof(
             quag_df_sorted,
-            ocean_model_df_sorted,
+            self.ocean_model_df,
             left_on = self.quag_utc_date_time_col,
             right_on = ocean_model_time_col,
             left_by = self.quag_site_col_name,
@@ -308,9 +610,363 @@ class MooringAggregator(Aggregator):
         Merges the PPS dataframe with the mooring df by averaging all columns 
         that fall between the start and end time (in UTC) plus half the average time interval for
         pps recordings. Merges also by station. pps_df is an input because the pps may 
-        have already been merged with other data
+        have already been merged with other data. The window means/std devs are computed for all
+        pps rows at once from index ranges into the sorted mooring_df (no per row copies), the std devs from the
+        offsets of each window's values from its mean like pandas' .std() (so they match the reference engine
+        for large valued columns like the datenum moor_time).
         """
-        moor_df = self.mooring_df.copy()
+        if self.uses_mooring_store(merge='pps_windows'):
+            return self.stream_merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=pps_df)
+        if self.engine == 'reference':
+            return self.reference_merge_pps_mooring_by_utc_timeframe_average_and_station(pps_df=pps_df)
+
+        # The whole mooring_df (raw or low-passed) is a single (already sorted) chunk
+        return self.average_pps_mooring_windows(pps_df=pps_df, iter_mooring_chunks=lambda sample_index: [self.get_mooring_df(merge='pps_windows')])
+
+    def merge_pps_ocean_model_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merges the PPS dataframe with the ocean model df by averaging all columns 
+        that fall between the start and end time plus half the average time interval for
+        pps recordings. Merges also by station. pps_df is an input because the pps may 
+        have already been merged with other data. This uses utc time because ocean model
+        data is in UTC time. The window means/std devs are computed for all pps rows at once
+        from index ranges into the sorted ocean_model_df (no per row copies), the std devs from the offsets
+        of each window's values from its mean like pandas' .std().
+        """
+        if self.ocean_model_extraction != 'frame':
+            return self.stream_merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=pps_df)
+        if self.engine == 'reference':
+            return self.reference_merge_pps_ocean_model_by_utc_timeframe_average_and_station(pps_df=pps_df)
+
+        # The whole ocean_model_df is a single (already sorted) chunk
+        return self.average_pps_ocean_model_windows(pps_df=pps_df, iter_ocean_model_chunks=lambda sample_index: [self.ocean_model_df])
+
+    def iter_mooring_chunks(self, sample_index: SampleTimeIndex, series: str = 'data'):
+        """
+        Streams the mooring data with the same columns as self.mooring_df. From the mooring store (if used) only the
+        records in the windows of the sample_index are read, in chunks. Otherwise the .mat files are streamed one
+        variable (one sensor deployment at a station) at a time. A .mat file has to be loaded whole by scipy, so
+        memory is then bounded by the largest .mat file rather than by all of them. The low-passed series ('lpdata')
+        is already loaded (self.mooring_lowpass_df) and is a single chunk.
+        """
+        if series == 'lpdata':
+            yield self.mooring_lowpass_df
+            return
+        if self.mooring_store_dir:
+            for mooring_df in self.mooring_store.iter_window_chunks(sample_index=sample_index, chunk_size=self.stream_chunk_size, variables=self.moor_variables):
+                yield self.prefix_columns(df=mooring_df, prefix='moor_')
+            return
+
+        for mat_file in sorted(self.mooring_mat_dir.rglob('*.mat')):
+            mat_processor = MatFileProcessor(
+                sites=self.quag_station_sites, mat_file=mat_file, sensors=self.moor_sensors, variables=self.moor_variables)
+            for mooring_df in mat_processor.iter_ocnms_dfs_from_mat_file():
+                yield self.prefix_columns(df=mooring_df, prefix='moor_')
+
+    def iter_ctd_chunks(self):
+        """
+        Streams the ctd data one file (cast) at a time, with the same columns as self.ctd_df. Files that match no
+        quagmire site (None) or have no records are skipped, like the concat of the in memory load drops them.
+        """
+        for ctd_df in self.iter_ctd_file_dfs():
+            if ctd_df is None or ctd_df.empty:
+                continue
+            yield self.prefix_columns(df=ctd_df, prefix='ctd_')
+
+    def iter_ctd_file_dfs(self):
+        """
+        The (unprefixed) data frame of each ctd file, None for a .cnv/.ros file that matches no quagmire site
+        """
+        if self.ctd_file_type == 'nc':
+            for nc_file in self.get_ctd_nc_files_needed():
+                yield NetcdfProcessor(nc_file=nc_file, variables=self.ctd_variables).convert_ctd_nc_to_df()
+        elif self.ctd_file_type == 'cnv':
+            for cnv_file in sorted(self.ctd_cnv_file_directory.rglob('*.cnv')):
+                cnv_processor = CnvProcessor(cnv_file=cnv_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention, variables=self.ctd_variables,
+                                             station_registry=self.station_registry)
+                yield self.bin_ctd_cast(df=cnv_processor.cnv_df)
+        elif self.ctd_file_type == 'ros':
+            for ros_file in sorted(self.ctd_ros_file_directory.rglob('*.ros')):
+                ros_processor = RosProcessor(ros_file=ros_file, sites=self.quag_station_sites, day_convention=self.ctd_day_convention, variables=self.ctd_variables,
+                                             station_registry=self.station_registry)
+                yield self.bin_ctd_cast(df=ros_processor.ros_df)
+
+    def iter_ocean_model_chunks(self, sample_index: SampleTimeIndex):
+        """
+        Streams the depth-averaged ocean model data in time ordered chunks (same columns as self.ocean_model_df). Only
+        the model time steps that fall in the window of at least one sample in the sample_index are read (and only the
+        model files that have such time steps are opened).
+        """
+        overlaps_samples = lambda station, first_ns, last_ns: len(sample_index.overlapping(station=station, start_ns=first_ns, end_ns=last_ns)) > 0
+        # Last time step read of each station's model_nc_files, so a time step shared by consecutive files is read once
+        read_until = {}
+        for nc_file, matching_station, grid_cell in self.iter_ocean_model_files(overlaps_func=overlaps_samples):
+            after_ns = read_until.get(matching_station, NAT_NS) if grid_cell is None else NAT_NS
+            nc_processor = NetcdfProcessor(nc_file=nc_file, variables=self.ocean_model_variables)
+            model_chunks = nc_processor.iter_rom_ocean_model_chunks(min_depth=self.quag_min_depth,
+                                                                    max_depth=self.quag_max_depth,
+                                                                    depth_var_name=self.ocean_model_depth_var,
+                                                                    time_dim_name=self.ocean_model_time_dim_name,
+                                                                    station=matching_station,
+                                                                    time_mask_func=lambda times, station=matching_station, after_ns=after_ns: sample_index.covers(station=station, times_ns=times) & (times > after_ns),
+                                                                    chunk_size=self.stream_chunk_size,
+                                                                    grid_cell=grid_cell)
+            for model_df in model_chunks:
+                yield self.prefix_columns(df=model_df, prefix='model_')
+            if grid_cell is None:
+                read_until[matching_station] = max(after_ns, self.get_ocean_model_time_index().time_range(nc_file=nc_file)[1])
+
+    def stream_merge_quag_ctd_mooring_oceanmodel(self) -> pd.DataFrame:
+        """
+        Streaming version of FINALmerge_quag_ctd_mooring_oceanmodel (execution mode 'streaming'). Instead of loading
+        the CTD, mooring and ocean model data frames, each source is streamed in chunks and only the nearest record
+        (within the tolerance) for each quagmire sample is kept. Same tolerances and output columns as the in
+        memory merges.
+        """
+        ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
+
+        # Same order as the merge_asof chain output (sorted by utc time then station)
+        quag_df = self.quagmire_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name]).reset_index(drop=True)
+        quag_df[self.quag_utc_date_time_col] = pd.to_datetime(quag_df[self.quag_utc_date_time_col])
+        quag_df[self.quag_site_col_name] = quag_df[self.quag_site_col_name].astype(str)
+        quag_times = quag_df[self.quag_utc_date_time_col]
+        quag_stations = quag_df[self.quag_site_col_name]
+
+        # CTD
+        ctd_tolerance = self.ctd_quag_merge_tolerance or '1h'
+        ctd_index = SampleTimeIndex.from_target_times(stations=quag_stations, times=quag_times, tolerance=ctd_tolerance)
+        ctd_matches = StreamingJoiner(sample_index=ctd_index).nearest(chunks=self.iter_ctd_chunks(), time_col=self.CTD_DATE_COL, station_col=self.CTD_STATION_COL)
+        if self.CTD_DATE_COL in ctd_matches:
+            ctd_matches['ctd_quag_time_difference'] = abs(quag_times - ctd_matches[self.CTD_DATE_COL])
+
+        # Mooring
+        moor_index = SampleTimeIndex.from_target_times(stations=quag_stations, times=quag_times, tolerance='1h')
+        moor_matches = StreamingJoiner(sample_index=moor_index).nearest(chunks=self.iter_mooring_chunks(sample_index=moor_index, series=self.moor_series['nearest']), time_col=self.MOORING_DATE_COL, station_col=self.MOORING_STATION_ID_COL)
+
+        # Ocean model
+        if self.ocean_model_extraction != 'frame':
+            model_matches = self.point_query_ocean_model_at_quag_times(quag_df_sorted=quag_df, tolerance='1h')
+        else:
+            model_index = SampleTimeIndex.from_target_times(stations=quag_stations, times=quag_times, tolerance='1h')
+            model_matches = StreamingJoiner(sample_index=model_index).nearest(chunks=self.iter_ocean_model_chunks(sample_index=model_index), time_col=ocean_model_time_col, station_col=self.OCEAN_MODEL_STATION_COL)
+
+        quag_ctd_mooring_ocean_df = pd.concat([quag_df, ctd_matches, moor_matches, model_matches], axis=1)
+
+        # remove any columns that are entirely empty
+        final_df = quag_ctd_mooring_ocean_df.dropna(axis=1, how='all')
+        print("Mooring, CTD, and Ocean Model data merged to QAQC (streamed)!")
+
+        return final_df
+
+    def point_query_merge_oceanmodel_quag_on_station_utctime(self, quag_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Same as merge_oceanmodel_quag_on_station_utctime (nearest model time step by station within one hour), but
+        queries the model .nc files at the quagmire sample times instead of using self.ocean_model_df. Only the
+        matched model time steps are read from disk. With the depth_resolved extraction the model values are
+        interpolated to the depth of each sample.
+        """
+        ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
+
+        # Same order as the merge_asof output (sorted by utc time then station)
+        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name]).reset_index(drop=True)
+        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
+        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
+
+        model_matches = self.point_query_ocean_model_at_quag_times(quag_df_sorted=quag_df_sorted, tolerance='1h')
+        if ocean_model_time_col in model_matches:
+            model_matches[ocean_model_time_col] = pd.to_datetime(model_matches[ocean_model_time_col], utc=True) # Updates time zone aware of ocean model to True
+
+        return pd.concat([quag_df_sorted, model_matches], axis=1)
+
+    def point_query_ocean_model_at_quag_times(self, quag_df_sorted: pd.DataFrame, tolerance: str) -> pd.DataFrame:
+        """
+        Queries each station's model .nc file at the utc times of that station's samples (and at their depths with the
+        depth_resolved extraction). Returns a df of the (model_ prefixed) model values aligned to the rows of
+        quag_df_sorted (NaN where there was no match). A station's model_nc_files are only opened for the samples
+        within the tolerance of their time range.
+        """
+        tolerance_ns = pd.Timedelta(tolerance).value
+        match_dfs = []
+        match_ranks = [] # (full-domain file, time difference) of each match, to pick one match per sample
+        for nc_file, matching_station, grid_cell in self.iter_ocean_model_files():
+            station_rows = quag_df_sorted.index[quag_df_sorted[self.quag_site_col_name] == matching_station]
+            if grid_cell is None:
+                first_ns, last_ns = self.get_ocean_model_time_index().time_range(nc_file=nc_file)
+                sample_ns = to_utc_ns(quag_df_sorted.loc[station_rows, self.quag_utc_date_time_col])
+                station_rows = station_rows[(sample_ns >= first_ns - tolerance_ns) & (sample_ns <= last_ns + tolerance_ns)]
+            if len(station_rows) == 0:
+                continue
+
+            nc_processor = NetcdfProcessor(nc_file=nc_file, variables=self.ocean_model_variables)
+            if self.ocean_model_extraction == 'depth_resolved':
+                model_df = nc_processor.select_rom_ocean_model_at_times_and_depths(times=quag_df_sorted.loc[station_rows, self.quag_utc_date_time_col],
+                                                                                   depths=pd.to_numeric(quag_df_sorted.loc[station_rows, self.quag_depth_col], errors='coerce'),
+                                                                                   tolerance=tolerance,
+                                                                                   depth_var_name=self.ocean_model_depth_var,
+                                                                                   time_dim_name=self.ocean_model_time_dim_name,
+                                                                                   grid_cell=grid_cell)
+            else:
+                model_df = nc_processor.select_rom_ocean_model_at_times(times=quag_df_sorted.loc[station_rows, self.quag_utc_date_time_col],
+                                                                        tolerance=tolerance,
+                                                                        min_depth=self.quag_min_depth,
+                                                                        max_depth=self.quag_max_depth,
+                                                                        depth_var_name=self.ocean_model_depth_var,
+                                                                        time_dim_name=self.ocean_model_time_dim_name,
+                                                                        grid_cell=grid_cell)
+            if model_df.empty:
+                continue
+            model_df['station'] = matching_station
+            model_df.index = station_rows
+            # Only keep the matched samples
+            model_df = model_df[model_df[self.ocean_model_time_dim_name].notna()]
+            time_diffs = np.abs(to_utc_ns(model_df[self.ocean_model_time_dim_name]) - to_utc_ns(quag_df_sorted.loc[model_df.index, self.quag_utc_date_time_col]))
+            match_ranks.append(pd.DataFrame({'full_domain': grid_cell is not None, 'time_diff': time_diffs}, index=model_df.index))
+            match_dfs.append(self.prefix_columns(df=model_df, prefix='model_'))
+
+        if not match_dfs:
+            return pd.DataFrame(index=quag_df_sorted.index)
+
+        # If more than one file has a match for a sample, the station's model_nc_files win over the full-domain files, and
+        # between consecutive files of a station the nearest time step wins (the earlier one on a tie, like merge_asof)
+        model_matches = pd.concat(match_dfs)
+        match_ranks = pd.concat(match_ranks)
+        model_matches = model_matches.iloc[np.lexsort((match_ranks['time_diff'].to_numpy(), match_ranks['full_domain'].to_numpy()))]
+        model_matches = model_matches[~model_matches.index.duplicated(keep='first')]
+        return model_matches.reindex(quag_df_sorted.index)
+
+    def stream_merge_moor_quag_on_station_utctime(self, quag_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Same as merge_moor_quag_on_station_utctime (nearest mooring record by station within one hour), but streams
+        the mooring records (only those within an hour of a sample, when reading from the mooring store) instead of
+        using self.mooring_df.
+        """
+        # Same order as the merge_asof output (sorted by utc time then station)
+        quag_df_sorted = quag_df.sort_values([self.quag_utc_date_time_col, self.quag_site_col_name]).reset_index(drop=True)
+        quag_df_sorted[self.quag_utc_date_time_col] = pd.to_datetime(quag_df_sorted[self.quag_utc_date_time_col])
+        quag_df_sorted[self.quag_site_col_name] = quag_df_sorted[self.quag_site_col_name].astype(str)
+
+        moor_matches = self.stream_mooring_matches(quag_df_sorted=quag_df_sorted)
+
+        return pd.concat([quag_df_sorted, moor_matches], axis=1)
+
+    def stream_mooring_matches(self, quag_df_sorted: pd.DataFrame) -> pd.DataFrame:
+        """
+        The nearest mooring record (by station within one hour) of each row of quag_df_sorted, streamed from the
+        mooring store (or self.mooring_df). Aligned to the rows of quag_df_sorted (NaN where there was no match).
+        """
+        moor_index = SampleTimeIndex.from_target_times(stations=quag_df_sorted[self.quag_site_col_name],
+                                                       times=quag_df_sorted[self.quag_utc_date_time_col],
+                                                       tolerance='1h')
+        moor_matches = StreamingJoiner(sample_index=moor_index).nearest(chunks=self.iter_mooring_chunks(sample_index=moor_index, series=self.moor_series['nearest']),
+                                                                        time_col=self.MOORING_DATE_COL,
+                                                                        station_col=self.MOORING_STATION_ID_COL)
+        return moor_matches.set_axis(quag_df_sorted.index)
+
+    def stream_merge_pps_mooring_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Streaming version of merge_pps_mooring_by_utc_timeframe_average_and_station. The mooring data is streamed in
+        chunks and the means, standard deviations and counts of the records in each pps window are accumulated
+        chunk by chunk.
+        """
+        return self.average_pps_mooring_windows(pps_df=pps_df, iter_mooring_chunks=lambda sample_index: self.iter_mooring_chunks(sample_index=sample_index, series=self.moor_series['pps_windows']))
+
+    def average_pps_mooring_windows(self, pps_df: pd.DataFrame, iter_mooring_chunks) -> pd.DataFrame:
+        """
+        Means, standard deviations, counts and min/max dates of the mooring records in the expanded utc window of each
+        pps row, by station. iter_mooring_chunks(sample_index) returns the mooring data (as one or more chunks).
+        """
+        pps_df = pps_df.reset_index(drop=True)
+
+        # Find half of pps time interval and conver tto time delta
+        pps_time_buffer = pd.Timedelta(self.pps_time_interval/2)
+
+        pps_df[self.PPS_UTC_START_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_START_TIME_COL])
+        pps_df[self.PPS_UTC_END_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_END_TIME_COL])
+
+        # Calculate the expanded time window for mooring data
+        pps_df['pps_expanded_start'] = pps_df[self.PPS_UTC_START_TIME_COL] - pps_time_buffer
+        pps_df['pps_expanded_end'] = pps_df[self.PPS_UTC_END_TIME_COL] + pps_time_buffer
+
+        pps_index = SampleTimeIndex.from_windows(stations=pps_df[self.PPS_STATION_ID_COL],
+                                                 window_starts=pps_df['pps_expanded_start'],
+                                                 window_ends=pps_df['pps_expanded_end'])
+        if self.uses_mooring_store(merge='pps_windows'):
+            # Pre-aggregated blocks of the mooring store's pyramids (raw records are only read at the window edges)
+            window_stats = self.mooring_store.window_stats(sample_index=pps_index,
+                                                           column_prefix='moor_',
+                                                           count_col='moor_count_avg',
+                                                           min_date_col='moor_min_date',
+                                                           max_date_col='moor_max_date',
+                                                           variables=self.moor_variables)
+        else:
+            window_stats = StreamingJoiner(sample_index=pps_index).window_stats(chunks=iter_mooring_chunks(sample_index=pps_index),
+                                                                                time_col=self.MOORING_DATE_COL,
+                                                                                station_col=self.MOORING_STATION_ID_COL,
+                                                                                count_col='moor_count_avg',
+                                                                                min_date_col='moor_min_date',
+                                                                                max_date_col='moor_max_date')
+
+        # Add the moor_station id column back in for the matched rows (the pps and moor station cols were matched)
+        window_stats.insert(window_stats.columns.get_loc('moor_count_avg'), self.MOORING_STATION_ID_COL,
+                            pps_df[self.PPS_STATION_ID_COL].where(window_stats['moor_count_avg'] > 0))
+
+        return pd.concat([pps_df, window_stats], axis=1)
+
+    def stream_merge_pps_ocean_model_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Streaming version of merge_pps_ocean_model_by_utc_timeframe_average_and_station. Like the in memory merge the
+        windows are whole (UTC) days from the date of the expanded start to the date of the expanded end. Only
+        the model time steps in those windows are read, in chunks.
+        """
+        return self.average_pps_ocean_model_windows(pps_df=pps_df, iter_ocean_model_chunks=self.iter_ocean_model_chunks)
+
+    def average_pps_ocean_model_windows(self, pps_df: pd.DataFrame, iter_ocean_model_chunks) -> pd.DataFrame:
+        """
+        Means, standard deviations, counts and min/max dates of the ocean model time steps in the (whole UTC day)
+        windows of each pps row, by station. iter_ocean_model_chunks(sample_index) returns the ocean model data
+        (as one or more chunks).
+        """
+        ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
+        pps_df = pps_df.reset_index(drop=True)
+
+        # Find half of pps time interval and conver tto time delta
+        pps_time_buffer = pd.Timedelta(self.pps_time_interval/2)
+
+        pps_df[self.PPS_UTC_START_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_START_TIME_COL])
+        pps_df[self.PPS_UTC_END_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_END_TIME_COL])
+
+        # Calculate the expanded time window for mooring data
+        pps_df['pps_expanded_start'] = pd.to_datetime(pps_df[self.PPS_UTC_START_TIME_COL] - pps_time_buffer)
+        pps_df['pps_expanded_end'] = pd.to_datetime(pps_df[self.PPS_UTC_END_TIME_COL] + pps_time_buffer)
+        pps_df['pps_expanded_start_date'] = pps_df['pps_expanded_start'].dt.date
+        pps_df['pps_expanded_end_date'] = pps_df['pps_expanded_end'].dt.date
+
+        # Whole day windows
+        window_starts = pps_df['pps_expanded_start'].dt.floor('D')
+        window_ends = pps_df['pps_expanded_end'].dt.floor('D') + pd.Timedelta(days=1) - pd.Timedelta(1, unit='ns')
+        pps_index = SampleTimeIndex.from_windows(stations=pps_df[self.PPS_STATION_ID_COL],
+                                                 window_starts=window_starts,
+                                                 window_ends=window_ends)
+        window_stats = StreamingJoiner(sample_index=pps_index).window_stats(chunks=iter_ocean_model_chunks(sample_index=pps_index),
+                                                                            time_col=ocean_model_time_col,
+                                                                            station_col=self.OCEAN_MODEL_STATION_COL,
+                                                                            count_col='ocean_model_count_avg',
+                                                                            min_date_col='ocean_model_min_date',
+                                                                            max_date_col='ocean_model_max_date')
+
+        # Add the model station column back in for the matched rows
+        window_stats.insert(window_stats.columns.get_loc('ocean_model_count_avg'), self.OCEAN_MODEL_STATION_COL,
+                            pps_df[self.PPS_STATION_ID_COL].where(window_stats['ocean_model_count_avg'] > 0))
+
+        return pd.concat([pps_df, window_stats], axis=1)
+
+    def reference_merge_pps_mooring_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        The original (reference engine) pps/mooring window merge: for each pps row, filters the mooring_df to the
+        station and expanded utc window and averages the matched rows. Kept to check the fast engine against
+        (see utils/engine_verifier.py).
+        """
+        moor_df = self.get_mooring_df(merge='pps_windows').copy()
         pps_df = pps_df.copy()
 
         # Find half of pps time interval and conver tto time delta
@@ -343,7 +999,7 @@ class MooringAggregator(Aggregator):
                 averaged_data = time_match[numeric_cols].mean()
 
                 # Calculate standard deviations for numeric columns
-                std_dev_data = time_match[numeric_cols].std() # <-- NEW LINE
+                std_dev_data = time_match[numeric_cols].std()
 
                 # Create result row
                 result_row = pps_row.copy()
@@ -352,7 +1008,6 @@ class MooringAggregator(Aggregator):
                 for col in numeric_cols:
                     result_row[col] = averaged_data[col]
 
-                # Add standard deviation values (New Block)
                 for col in numeric_cols:
                     # Name the new column with the "_std_dev" suffix
                     result_row[f'{col}_std_dev'] = std_dev_data[col]
@@ -373,18 +1028,16 @@ class MooringAggregator(Aggregator):
                 result_row['moor_count_avg'] = 0
                 results.append(result_row)
 
-            # Convert results to DataFrame
-            result_df = pd.DataFrame(results)
+        # Convert results to DataFrame (once, the output is the same as building it inside the loop)
+        result_df = pd.DataFrame(results)
 
         return result_df
 
-    def merge_pps_ocean_model_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
+    def reference_merge_pps_ocean_model_by_utc_timeframe_average_and_station(self, pps_df: pd.DataFrame) -> pd.DataFrame:
         """
-        Merges the PPS dataframe with the ocean model df by averaging all columns 
-        that fall between the start and end time plus half the average time interval for
-        pps recordings. Merges also by station. pps_df is an input because the pps may 
-        have already been merged with other data. This uses utc time because ocean model
-        data is in UTC time.
+        The original (reference engine) pps/ocean model window merge: for each pps row, filters the ocean_model_df
+        to the station and the whole utc days of the expanded window and averages the matched rows. Kept to check
+        the fast engine against (see utils/engine_verifier.py).
         """
         ocean_model_time_col = f"model_{self.ocean_model_time_dim_name}" # col name has model prepended now.
 
@@ -396,7 +1049,8 @@ class MooringAggregator(Aggregator):
 
         pps_df[self.PPS_UTC_START_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_START_TIME_COL])
         pps_df[self.PPS_UTC_END_TIME_COL] = pd.to_datetime(pps_df[self.PPS_UTC_END_TIME_COL])
-        ocean_model_df[ocean_model_time_col] = pd.to_datetime(ocean_model_df[ocean_model_time_col]).dt.tz_localize('UTC')
+        # (the ocean_model_df times are made time zone aware UTC at load time now)
+        ocean_model_df[ocean_model_time_col] = pd.to_datetime(ocean_model_df[ocean_model_time_col], utc=True)
 
         # Calculate the expanded time window for mooring data
         pps_df['pps_expanded_start'] = pd.to_datetime(pps_df[self.PPS_UTC_START_TIME_COL] - pps_time_buffer)
@@ -408,8 +1062,6 @@ class MooringAggregator(Aggregator):
 
         ocean_model_df['ocean_model_merge_dt'] = ocean_model_df[ocean_model_time_col].dt.date
 
-
-        # ... (numeric_cols definition remains the same)
         numeric_cols = ocean_model_df.select_dtypes(include=[np.number]).columns.tolist()
 
         results = []
@@ -418,7 +1070,6 @@ class MooringAggregator(Aggregator):
             # Find matching moor_df rows by station
             station_match = ocean_model_df[ocean_model_df[self.OCEAN_MODEL_STATION_COL] == pps_row[self.PPS_STATION_ID_COL]]
 
-            # FIX 2: Use the correct, distinct column names for comparison.
             date_match = station_match[
                 (station_match['ocean_model_merge_dt'] >= pps_row['pps_expanded_start_date']) &
                 (station_match['ocean_model_merge_dt'] <= pps_row['pps_expanded_end_date'])
@@ -439,7 +1090,6 @@ class MooringAggregator(Aggregator):
                 for col in numeric_cols:
                     result_row[col] = averaged_data[col]
 
-                # Add standard deviation values (New Block)
                 for col in numeric_cols:
                     # Name the new column with the "_std_dev" suffix
                     result_row[f'{col}_std_dev'] = std_dev_data[col]
@@ -460,11 +1110,39 @@ class MooringAggregator(Aggregator):
                 result_row['ocean_model_count_avg'] = 0
                 results.append(result_row)
 
-            # Convert results to DataFrame
-            result_df = pd.DataFrame(results)
+        # Convert results to DataFrame (once, the output is the same as building it inside the loop)
+        result_df = pd.DataFrame(results)
 
         return result_df
-    
+
+    def add_pps_utc_times(self, quag_pps_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the utc start and end times of the pps samples, converted from their local times with the quagmire time
+        zone of each sample. The fast engine converts all the samples of a time zone at once (localize_to_utc), the
+        reference engine one row at a time (convert_local_time_to_utc).
+        """
+        for local_col, utc_col in [(self.PPS_LOCAL_START_DATE_COL, self.PPS_UTC_START_TIME_COL),
+                                   (self.PPS_LOCAL_END_DATE_COL, self.PPS_UTC_END_TIME_COL)]:
+            if self.engine == 'reference':
+                quag_pps_df[utc_col] = quag_pps_df.apply(lambda row: self.convert_local_time_to_utc(local_dt=row[local_col], timezone=row[self.quag_local_time_zone_col], sample_name=row[self.quag_sample_name_col]), axis=1)
+            else:
+                quag_pps_df[utc_col] = self.localize_to_utc(local_times=quag_pps_df[local_col], timezones=quag_pps_df[self.quag_local_time_zone_col])
+        return quag_pps_df
+
+    def localize_to_utc(self, local_times: pd.Series, timezones: pd.Series) -> pd.Series:
+        """
+        Converts naive local times to UTC, one time zone at a time. Matches convert_local_time_to_utc (pytz localize):
+        ambiguous times (clocks going back) are taken as standard time, and non-existent times (clocks going forward)
+        are shifted forward by an hour. Times with no time zone stay NaT.
+        """
+        local_times = pd.to_datetime(local_times)
+        utc_times = pd.Series(pd.NaT, index=local_times.index, dtype='datetime64[ns, UTC]')
+        for timezone, rows in local_times.groupby(timezones).groups.items():
+            zone_times = pd.DatetimeIndex(local_times.loc[rows])
+            utc_times.loc[rows] = (zone_times.tz_localize(timezone, ambiguous=np.zeros(len(zone_times), dtype=bool), nonexistent=pd.Timedelta('1h'))
+                                   .tz_convert('UTC'))
+        return utc_times
+
     def convert_local_time_to_utc(self, local_dt: str, timezone: str, sample_name: str) -> str:
         """
         Converts a time to utc based on timezone. This is used for the PPS data (already
@@ -472,6 +1150,8 @@ class MooringAggregator(Aggregator):
         calculated in for the Quag to convert PPS times to UTC. So that PPS data can be 
         merged with other data on UTC time if needed (e.g. ocean model data.)
         """
+        import pytz # deferred (slow to import)
+
         try:
             local_tz = pytz.timezone(timezone) # get the timezone object using pytz
            
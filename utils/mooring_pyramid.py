@@ -0,0 +1,209 @@
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from utils.streaming_joiner import NAT_NS, group_moments, pool_moments, range_rows
+
+
+class MooringPyramid:
+    """
+    Multi-resolution pre-aggregates of a MooringSeries: for each level (1 min, 10 min, 1 h and 1 day blocks aligned
+    to UTC) the count, mean, M2 (sum of the squared offsets from the mean), min and max of each variable in every
+    non-empty block. Built once when the series is written to the MooringStore and kept next to it
+    (series_dir/pyramid/<level>/):
+
+    block_start.npy  int64 UTC ns start of each non-empty block (sorted)
+    count.npy, mean.npy, m2.npy, min.npy, max.npy  (n blocks, n variables) float64 aggregates
+
+    A window query pools the 1 day blocks inside the window, then the 1 h blocks at its edges, and so on down to the
+    raw records within a minute of the window's ends, so its cost doesn't depend on the sampling rate. Means and M2s
+    are pooled with the parallel Welford formula (see utils/streaming_joiner.pool_moments), so large valued variables
+    (the datenum time, pressures) keep their standard deviations.
+    """
+
+    PYRAMID_DIR = 'pyramid'
+    META_FILE = 'pyramid.json'
+    # name: block width (coarser widths must be multiples of the finer ones)
+    LEVELS = {
+        '1min': pd.Timedelta('1min').value,
+        '10min': pd.Timedelta('10min').value,
+        '1h': pd.Timedelta('1h').value,
+        '1d': pd.Timedelta('1D').value,
+    }
+    STATS = ['count', 'mean', 'm2', 'min', 'max']
+
+    def __init__(self, series):
+        """
+        series: the MooringSeries the pyramid was built from
+        """
+        self.series = series
+        self.pyramid_dir = Path(series.series_dir) / self.PYRAMID_DIR
+        with open(self.pyramid_dir / self.META_FILE, 'r') as f:
+            self.meta = json.load(f)
+        self.variables = self.meta['variables']
+        self.columns = {variable: series.column(variable) for variable in self.variables}
+
+        # Finest to coarsest: (block width, block starts, {stat: memory-mapped (n blocks, n variables) array})
+        self.levels = []
+        for level_name in self.LEVELS:
+            level_dir = self.pyramid_dir / level_name
+            block_starts = np.load(level_dir / 'block_start.npy', mmap_mode='r')
+            stats = {stat: np.load(level_dir / f"{stat}.npy", mmap_mode='r') for stat in self.STATS}
+            self.levels.append((self.LEVELS[level_name], block_starts, stats))
+
+    @classmethod
+    def exists(cls, series) -> bool:
+        """
+        True if the series has a pyramid with the current stats (pyramids of sums and sums of squares are rebuilt)
+        """
+        meta_path = Path(series.series_dir) / cls.PYRAMID_DIR / cls.META_FILE
+        if not meta_path.exists():
+            return False
+        with open(meta_path, 'r') as f:
+            return json.load(f).get('stats', None) == cls.STATS
+
+    @classmethod
+    def build(cls, series) -> 'MooringPyramid':
+        """
+        Builds the pyramid of a series. The finest level is aggregated from the raw records one variable at a time,
+        and each coarser level from the level below it.
+        """
+        pyramid_dir = Path(series.series_dir) / cls.PYRAMID_DIR
+        shutil.rmtree(pyramid_dir, ignore_errors=True)
+        times = np.asarray(series.times)
+
+        # (block starts, stats) of the level below
+        finer = None
+        for level_name, width in cls.LEVELS.items():
+            level_dir = pyramid_dir / level_name
+            level_dir.mkdir(parents=True)
+
+            # Block of each record (finest level) or of each finer block, and the first row of each block
+            block_ids = (times if finer is None else finer[0]) // width
+            offsets = np.flatnonzero(np.diff(block_ids)) + 1
+            offsets = np.concatenate(([0], offsets)).astype(np.int64) if len(block_ids) else offsets
+            block_starts = block_ids[offsets] * width
+            np.save(level_dir / 'block_start.npy', block_starts)
+            # Block number (0, 1, ...) of each record or finer block
+            block_numbers = np.repeat(np.arange(len(offsets)), np.diff(np.append(offsets, len(block_ids))))
+
+            stats = {stat: np.lib.format.open_memmap(level_dir / f"{stat}.npy", mode='w+', dtype=np.float64,
+                                                     shape=(len(block_starts), len(series.variables)))
+                     for stat in cls.STATS}
+            for i, variable in enumerate(series.variables):
+                if len(block_starts) == 0:
+                    continue
+                if finer is None:
+                    values = np.asarray(series.column(variable), dtype=float)
+                    counts, means, m2 = group_moments(group_ids=block_numbers, values=values, n_groups=len(block_starts))
+                    stats['min'][:, i] = np.fmin.reduceat(values, offsets)
+                    stats['max'][:, i] = np.fmax.reduceat(values, offsets)
+                else:
+                    finer_stats = finer[1]
+                    counts, means, m2 = pool_moments(group_ids=block_numbers, counts=finer_stats['count'][:, i],
+                                                     means=finer_stats['mean'][:, i], m2=finer_stats['m2'][:, i],
+                                                     n_groups=len(block_starts))
+                    stats['min'][:, i] = np.fmin.reduceat(finer_stats['min'][:, i], offsets)
+                    stats['max'][:, i] = np.fmax.reduceat(finer_stats['max'][:, i], offsets)
+                stats['count'][:, i] = counts
+                stats['mean'][:, i] = means
+                stats['m2'][:, i] = m2
+
+            for stat_values in stats.values():
+                stat_values.flush()
+            finer = (block_starts, stats)
+
+        with open(pyramid_dir / cls.META_FILE, 'w') as f:
+            json.dump({'variables': series.variables, 'levels': list(cls.LEVELS), 'stats': cls.STATS}, f, indent=2)
+
+        return cls(series=series)
+
+    def window_stats(self, starts_ns: np.ndarray, ends_ns: np.ndarray) -> dict:
+        """
+        Statistics of the records with start <= time <= end of each window (all windows at once): the number of
+        records and their min/max times (NAT_NS without records) per window, and per window and variable (in
+        self.variables order, (n windows, n variables) arrays) the count of non-NaN values, mean, M2, min and max.
+        """
+        starts_ns = np.asarray(starts_ns, dtype=np.int64)
+        ends_ns = np.asarray(ends_ns, dtype=np.int64)
+        n_windows = len(starts_ns)
+        n_variables = len(self.variables)
+        times = self.series.times
+        firsts = np.searchsorted(times, starts_ns, side='left')
+        lasts = np.searchsorted(times, ends_ns, side='right')
+        has_rows = lasts > firsts
+
+        totals = {
+            'count': np.zeros((n_windows, n_variables)),
+            'mean': np.full((n_windows, n_variables), np.nan),
+            'm2': np.zeros((n_windows, n_variables)),
+            'min': np.full((n_windows, n_variables), np.nan),
+            'max': np.full((n_windows, n_variables), np.nan),
+            'rows': np.where(has_rows, lasts - firsts, 0),
+            'min_time': np.where(has_rows, times[np.minimum(firsts, len(times) - 1)] if len(times) else NAT_NS, NAT_NS),
+            'max_time': np.where(has_rows, times[np.maximum(lasts - 1, 0)] if len(times) else NAT_NS, NAT_NS),
+        }
+
+        # Parts of the windows still to add: window id, start and end. Each level adds the blocks entirely inside
+        # each part and leaves the parts before and after them to the next finer level (the raw records after the
+        # finest level).
+        window_ids = np.flatnonzero(has_rows)
+        part_starts, part_ends = starts_ns[window_ids], ends_ns[window_ids]
+        for width, block_starts, stats in reversed(self.levels):
+            if len(window_ids) == 0:
+                break
+            first_blocks = np.searchsorted(block_starts, part_starts, side='left')
+            last_blocks = np.searchsorted(block_starts, part_ends - width + 1, side='right')
+            has_blocks = last_blocks > first_blocks
+
+            part_ids, block_rows = range_rows(lows=first_blocks[has_blocks], highs=last_blocks[has_blocks])
+            self._pool(totals=totals, window_ids=window_ids[has_blocks][part_ids], stats={stat: stats[stat][block_rows] for stat in self.STATS})
+
+            # The parts before the first block and after the last block, or the whole part if no block fits
+            before_ends = np.where(has_blocks, block_starts[np.minimum(first_blocks, len(block_starts) - 1)] - 1, part_ends) if len(block_starts) else part_ends
+            after_starts = block_starts[np.maximum(last_blocks - 1, 0)] + width if len(block_starts) else part_ends
+            window_ids = np.concatenate((window_ids, window_ids[has_blocks]))
+            part_starts, part_ends = (np.concatenate((part_starts, after_starts[has_blocks])),
+                                      np.concatenate((before_ends, part_ends[has_blocks])))
+            non_empty = part_starts <= part_ends
+            window_ids, part_starts, part_ends = window_ids[non_empty], part_starts[non_empty], part_ends[non_empty]
+
+        # The raw records of the remaining parts
+        part_ids, record_rows = range_rows(lows=np.searchsorted(times, part_starts, side='left'),
+                                           highs=np.searchsorted(times, part_ends, side='right'))
+        record_window_ids = window_ids[part_ids]
+        for i, variable in enumerate(self.variables):
+            values = np.asarray(self.columns[variable][record_rows], dtype=float)
+            counts, means, m2 = group_moments(group_ids=record_window_ids, values=values, n_groups=n_windows)
+            self._pool_variable(totals=totals, i=i, window_ids=np.arange(n_windows), counts=counts, means=means, m2=m2)
+            np.fmin.at(totals['min'][:, i], record_window_ids, values)
+            np.fmax.at(totals['max'][:, i], record_window_ids, values)
+
+        return totals
+
+    def _pool(self, totals: dict, window_ids: np.ndarray, stats: dict):
+        """
+        Pools the stats of blocks (rows of stats) into the totals of their windows
+        """
+        if len(window_ids) == 0:
+            return
+        for i in range(len(self.variables)):
+            self._pool_variable(totals=totals, i=i, window_ids=window_ids, counts=stats['count'][:, i],
+                                means=stats['mean'][:, i], m2=stats['m2'][:, i])
+            # fmin/fmax ignore NaNs (blocks where a variable has no values)
+            np.fmin.at(totals['min'][:, i], window_ids, stats['min'][:, i])
+            np.fmax.at(totals['max'][:, i], window_ids, stats['max'][:, i])
+
+    @staticmethod
+    def _pool_variable(totals: dict, i: int, window_ids: np.ndarray, counts: np.ndarray, means: np.ndarray, m2: np.ndarray):
+        """
+        Pools partial moments of variable i into the totals of their windows
+        """
+        n_windows = len(totals['rows'])
+        totals['count'][:, i], totals['mean'][:, i], totals['m2'][:, i] = pool_moments(
+            group_ids=np.concatenate((np.arange(n_windows), window_ids)),
+            counts=np.concatenate((totals['count'][:, i], counts)),
+            means=np.concatenate((totals['mean'][:, i], means)),
+            m2=np.concatenate((totals['m2'][:, i], m2)),
+            n_groups=n_windows)
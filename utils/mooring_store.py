@@ -0,0 +1,385 @@
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from utils.mat_file_processor import MatFileProcessor
+from utils.mooring_pyramid import MooringPyramid
+from utils.variable_selection import select_names
+from utils.streaming_joiner import NAT_NS, SampleTimeIndex, from_utc_ns, pool_moments, std_devs_from_moments, to_utc_ns
+
+# Converts the mooring .mat files once into a memory-mapped columnar store, so runs don't re-extract
+# the nested .mat structs every time. E.g.:
+# python -m utils.mooring_store /path/to/mooring_data/ /path/to/mooring_store --sites TH042 CE042 --sensors CTPO
+
+
+class MooringSeries:
+    """
+    One station/sensor time series of a MooringStore (all deployments of the sensor at the station, in time order).
+    The time array (int64 UTC ns, sorted) and the one array per variable are opened memory-mapped, so a query only
+    reads the pages it touches from disk.
+    """
+
+    def __init__(self, series_dir: Path):
+
+        self.series_dir = Path(series_dir)
+        with open(self.series_dir / MooringStore.META_FILE, 'r') as f:
+            self.meta = json.load(f)
+        self.station = self.meta['station']
+        self.sensor = self.meta['sensor']
+        self.variables = self.meta['variables']
+        self.deployments = self.meta['deployments']
+        self.times = np.load(self.series_dir / MooringStore.TIME_FILE, mmap_mode='r')
+        self._pyramid = None
+
+    def __getstate__(self):
+        # Pickled (e.g. to a spawned station worker) without the memory-mapped arrays, which are reopened on unpickling
+        return {'series_dir': self.series_dir}
+
+    def __setstate__(self, state):
+        self.__init__(series_dir=state['series_dir'])
+
+    @property
+    def pyramid(self) -> MooringPyramid:
+        """
+        The pre-aggregated pyramid of the series (built here if the store was made before pyramids existed)
+        """
+        if self._pyramid is None:
+            if not MooringPyramid.exists(series=self):
+                print(f"Building mooring pyramid for {self.station}/{self.sensor}")
+                MooringPyramid.build(series=self)
+            self._pyramid = MooringPyramid(series=self)
+        return self._pyramid
+
+    def __len__(self):
+        return len(self.times)
+
+    def column(self, variable: str) -> np.ndarray:
+        """
+        The memory-mapped array of a variable
+        """
+        return np.load(self.series_dir / f"{variable}.npy", mmap_mode='r')
+
+    def range_indices(self, start_ns: int, end_ns: int) -> tuple:
+        """
+        Binary search for the rows [first, last) of the records with start_ns <= time <= end_ns
+        """
+        first = int(np.searchsorted(self.times, start_ns, side='left'))
+        last = int(np.searchsorted(self.times, end_ns, side='right'))
+        return first, last
+
+    def nearest_indices(self, times_ns: np.ndarray, tolerance: str) -> np.ndarray:
+        """
+        Binary search for the row of the nearest record to each of times_ns. Returns -1 where there is no
+        record within the tolerance. Ties go to the earlier record.
+        """
+        times_ns = np.asarray(times_ns, dtype=np.int64)
+        if len(self.times) == 0:
+            return np.full(len(times_ns), -1, dtype=np.int64)
+
+        after = np.clip(np.searchsorted(self.times, times_ns, side='left'), 0, len(self.times) - 1)
+        before = np.clip(after - 1, 0, len(self.times) - 1)
+        after_diffs = np.abs(self.times[after] - times_ns)
+        before_diffs = np.abs(times_ns - self.times[before])
+
+        use_after = after_diffs < before_diffs
+        nearest_rows = np.where(use_after, after, before)
+        diffs = np.where(use_after, after_diffs, before_diffs)
+
+        within_tolerance = (diffs <= pd.Timedelta(tolerance).value) & (times_ns != NAT_NS)
+        return np.where(within_tolerance, nearest_rows, -1)
+
+    def to_df(self, rows, variables: list = None) -> pd.DataFrame:
+        """
+        Data frame (same columns as the MatFileProcessor output) of the records at rows (a slice or an array of rows).
+        Only the requested variables are read.
+        """
+        variables = self.variables if variables is None else variables
+        df = pd.DataFrame({variable: np.asarray(self.column(variable)[rows]) for variable in variables})
+        df['station_id'] = self.station
+        df['datetime'] = from_utc_ns(self.times[rows])
+        return df
+
+    def range(self, start, end, variables: list = None) -> pd.DataFrame:
+        """
+        Data frame of the records with start <= time <= end
+        """
+        first, last = self.range_indices(start_ns=to_utc_ns([start])[0], end_ns=to_utc_ns([end])[0])
+        return self.to_df(rows=slice(first, last), variables=variables)
+
+
+class MooringStore:
+    """
+    Memory-mapped columnar store of mooring data converted from the .mat files. The layout is
+    store_dir/<station>/<sensor>/ with time.npy (int64 UTC ns), one <variable>.npy (float64) per variable and a
+    meta.json with the variables and the deployments (.mat variable, .mat file, original data file, time range and
+    row count) that make up the series. store_dir/store.json lists the series and the source files the store was
+    built from.
+    """
+
+    STORE_META_FILE = 'store.json'
+    META_FILE = 'meta.json'
+    TIME_FILE = 'time.npy'
+
+    def __init__(self, store_dir: str):
+
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / self.STORE_META_FILE, 'r') as f:
+            self.meta = json.load(f)
+        self.series = {
+            (series['station'], series['sensor']): MooringSeries(series_dir=self.store_dir / series['station'] / series['sensor'])
+            for series in self.meta['series']
+        }
+
+    @classmethod
+    def open_or_create(cls, store_dir: str, mat_files: list, sites: list, sensors: list) -> 'MooringStore':
+        """
+        Opens the store if it is up to date with the .mat files and has the sites and sensors, otherwise (re)builds it.
+        When rebuilding, the sites and sensors already in the store are kept.
+        """
+        store_dir = Path(store_dir)
+        store_meta_path = store_dir / cls.STORE_META_FILE
+        if store_meta_path.exists():
+            with open(store_meta_path, 'r') as f:
+                store_meta = json.load(f)
+            if (store_meta['source_files'] == cls.get_file_stats(mat_files)
+                    and set(sites) <= set(store_meta['sites']) and set(sensors) <= set(store_meta['sensors'])):
+                return cls(store_dir=store_dir)
+            sites = sorted(set(sites) | set(store_meta['sites']))
+            sensors = sorted(set(sensors) | set(store_meta['sensors']))
+
+        print(f"Building mooring store in {store_dir}")
+        return cls.from_mat_files(mat_files=mat_files, store_dir=store_dir, sites=sites, sensors=sensors)
+
+    @classmethod
+    def from_mat_files(cls, mat_files: list, store_dir: str, sites: list, sensors: list) -> 'MooringStore':
+        """
+        Converts the .mat files into a store. Each .mat variable (a sensor deployment at a station) is first written to
+        a staging directory, then the deployments of each station/sensor are combined into one time ordered series.
+        The store is built next to store_dir and swapped in at the end, so a failed build never leaves a broken store.
+        """
+        store_dir = Path(store_dir)
+        if store_dir.exists() and any(store_dir.iterdir()) and not (store_dir / cls.STORE_META_FILE).exists():
+            raise ValueError(f"{store_dir} is not empty and is not a mooring store. Please choose another store_dir.")
+
+        build_dir = store_dir.with_name(f"{store_dir.name}.building")
+        shutil.rmtree(build_dir, ignore_errors=True)
+        staging_dir = build_dir / '_staging'
+        staging_dir.mkdir(parents=True)
+
+        # Stage each deployment
+        deployments = {}
+        n_staged = 0
+        for mat_file in sorted(mat_files):
+            mat_processor = MatFileProcessor(sites=sites, mat_file=mat_file, sensors=sensors)
+            for mat_variable in mat_processor.iter_ocnms_variables_from_mat_file():
+                deployment = cls._stage_deployment(mat_variable=mat_variable, deployment_dir=staging_dir / str(n_staged))
+                n_staged += 1
+                if deployment['rows'] == 0:
+                    print(f"Skipping {mat_variable['var_name']} in {mat_file}: no records with a valid time")
+                    continue
+                deployment['mat_file'] = str(mat_file)
+                deployments.setdefault((mat_variable['site'], mat_variable['sensor']), []).append(deployment)
+
+        # Combine the deployments of each station/sensor into one series, with its pyramid of pre-aggregates
+        for (station, sensor), series_deployments in deployments.items():
+            cls._write_series(series_dir=build_dir / station / sensor, station=station, sensor=sensor, deployments=series_deployments)
+            MooringPyramid.build(series=MooringSeries(series_dir=build_dir / station / sensor))
+        shutil.rmtree(staging_dir)
+
+        store_meta = {
+            'sites': sorted(sites),
+            'sensors': sorted(sensors),
+            'source_files': cls.get_file_stats(mat_files),
+            'series': [{'station': station, 'sensor': sensor} for station, sensor in sorted(deployments)],
+        }
+        with open(build_dir / cls.STORE_META_FILE, 'w') as f:
+            json.dump(store_meta, f, indent=2)
+
+        # Swap the new store in
+        old_dir = store_dir.with_name(f"{store_dir.name}.old")
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if store_dir.exists():
+            os.replace(store_dir, old_dir)
+        os.replace(build_dir, store_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+        return cls(store_dir=store_dir)
+
+    @classmethod
+    def _stage_deployment(cls, mat_variable: dict, deployment_dir: Path) -> dict:
+        """
+        Writes a single .mat variable's time and numeric columns (sorted by time) to the staging directory
+        """
+        deployment_dir.mkdir(parents=True)
+        df = mat_variable['df']
+
+        times = to_utc_ns(df['datetime'])
+        rows = np.argsort(times, kind='stable')
+        rows = rows[times[rows] != NAT_NS] # drop records without a valid time
+        np.save(deployment_dir / cls.TIME_FILE, times[rows])
+
+        variables = df.select_dtypes(include=[np.number]).columns.tolist()
+        for variable in variables:
+            np.save(deployment_dir / f"{variable}.npy", df[variable].to_numpy(dtype=float, na_value=np.nan)[rows])
+
+        start_end = from_utc_ns(times[rows][[0, -1]]) if len(rows) else [None, None]
+        return {
+            'var_name': mat_variable['var_name'],
+            'file': mat_variable['file'],
+            'start': start_end[0].isoformat() if len(rows) else None,
+            'end': start_end[1].isoformat() if len(rows) else None,
+            'rows': int(len(rows)),
+            'variables': variables,
+            'staging_dir': str(deployment_dir),
+        }
+
+    @classmethod
+    def _write_series(cls, series_dir: Path, station: str, sensor: str, deployments: list):
+        """
+        Concatenates the staged deployments of a station/sensor into memory-mapped arrays. Deployments normally
+        don't overlap in time; if they do, the records are put in time order.
+        """
+        series_dir.mkdir(parents=True)
+        deployments = sorted(deployments, key=lambda d: d['start'])
+        n_rows = sum(d['rows'] for d in deployments)
+        offsets = np.concatenate(([0], np.cumsum([d['rows'] for d in deployments])))
+
+        times = np.lib.format.open_memmap(series_dir / cls.TIME_FILE, mode='w+', dtype=np.int64, shape=(n_rows,))
+        for deployment, offset in zip(deployments, offsets):
+            times[offset:offset + deployment['rows']] = np.load(Path(deployment['staging_dir']) / cls.TIME_FILE, mmap_mode='r')
+        order = None
+        if n_rows > 1 and np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='stable')
+            times[:] = times[order]
+        times.flush()
+        del times
+
+        # Variables in the order they are first seen. A deployment without a variable gets NaNs for it.
+        variables = list(dict.fromkeys(variable for deployment in deployments for variable in deployment['variables']))
+        for variable in variables:
+            values = np.lib.format.open_memmap(series_dir / f"{variable}.npy", mode='w+', dtype=np.float64, shape=(n_rows,))
+            for deployment, offset in zip(deployments, offsets):
+                if variable in deployment['variables']:
+                    values[offset:offset + deployment['rows']] = np.load(Path(deployment['staging_dir']) / f"{variable}.npy", mmap_mode='r')
+                else:
+                    values[offset:offset + deployment['rows']] = np.nan
+            if order is not None:
+                values[:] = values[order]
+            values.flush()
+            del values
+
+        meta = {
+            'station': station,
+            'sensor': sensor,
+            'variables': variables,
+            'rows': int(n_rows),
+            'deployments': [{k: v for k, v in d.items() if k != 'staging_dir'} for d in deployments],
+        }
+        with open(series_dir / cls.META_FILE, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @staticmethod
+    def get_file_stats(files: list) -> list:
+        """
+        [path, size, modification time] of the files, to tell if the store is out of date
+        """
+        file_stats = []
+        for file in sorted(str(f) for f in files):
+            stat = os.stat(file)
+            file_stats.append([file, stat.st_size, stat.st_mtime_ns])
+        return file_stats
+
+    def station_series(self, station: str) -> list:
+        """
+        All the sensor series of a station
+        """
+        return [series for (series_station, _), series in self.series.items() if series_station == station]
+
+    def iter_window_chunks(self, sample_index: SampleTimeIndex, chunk_size: int, variables: list = None):
+        """
+        Yields data frames (same columns as the MatFileProcessor output) of the records inside the sample windows,
+        in chunks of at most chunk_size rows. The windows of each station are merged first so every record is read
+        (and yielded) once, which is what StreamingJoiner expects. Only the selected variables are read (all if None).
+        """
+        for station in sample_index.stations:
+            for series in self.station_series(station=station):
+                series_variables = select_names(names=series.variables, variables=variables, required=MatFileProcessor.REQUIRED_FIELDS)
+                for start_ns, end_ns in sample_index.merged_windows(station=station):
+                    first, last = series.range_indices(start_ns=start_ns, end_ns=end_ns)
+                    for chunk_start in range(first, last, chunk_size):
+                        yield series.to_df(rows=slice(chunk_start, min(chunk_start + chunk_size, last)), variables=series_variables)
+
+
+    def window_stats(self, sample_index: SampleTimeIndex, column_prefix: str, count_col: str,
+                     min_date_col: str, max_date_col: str, variables: list = None) -> pd.DataFrame:
+        """
+        Same output as StreamingJoiner.window_stats over the store's records (with column_prefix added to the variable
+        names), but computed from the pyramids of the station's series instead of reading the records: one row per
+        sample with the mean and {col}_std_dev of each (selected, all if None) variable, the min and max record times
+        and the record count.
+        """
+        n_samples = sample_index.n_samples
+        record_counts = np.zeros(n_samples, dtype=np.int64)
+        min_times = np.full(n_samples, NAT_NS, dtype=np.int64)
+        max_times = np.full(n_samples, NAT_NS, dtype=np.int64)
+        # variable: [non-NaN count, mean, M2] per sample
+        accumulators = {}
+
+        for station, (positions, _, _, _) in sample_index.stations.items():
+            for series in self.station_series(station=station):
+                pyramid = series.pyramid
+                # All the windows of the station at once
+                totals = pyramid.window_stats(starts_ns=sample_index.window_starts[positions], ends_ns=sample_index.window_ends[positions])
+                record_counts[positions] += totals['rows']
+                earlier = (totals['rows'] > 0) & ((min_times[positions] == NAT_NS) | (totals['min_time'] < min_times[positions]))
+                min_times[positions] = np.where(earlier, totals['min_time'], min_times[positions])
+                max_times[positions] = np.maximum(max_times[positions], totals['max_time'])
+
+                selected = select_names(names=pyramid.variables, variables=variables, required=MatFileProcessor.REQUIRED_FIELDS)
+                for i, variable in enumerate(pyramid.variables):
+                    if variable not in selected:
+                        continue
+                    if variable not in accumulators:
+                        accumulators[variable] = [np.zeros(n_samples), np.full(n_samples, np.nan), np.zeros(n_samples)]
+                    counts, means, m2 = accumulators[variable]
+                    # A station can have several series (sensors) with the same variable
+                    counts[positions], means[positions], m2[positions] = pool_moments(
+                        group_ids=np.tile(np.arange(len(positions)), 2),
+                        counts=np.concatenate((counts[positions], totals['count'][:, i])),
+                        means=np.concatenate((means[positions], totals['mean'][:, i])),
+                        m2=np.concatenate((m2[positions], totals['m2'][:, i])),
+                        n_groups=len(positions))
+
+        result = {}
+        std_devs = {}
+        for variable, (counts, means, m2) in accumulators.items():
+            result[f"{column_prefix}{variable}"] = means
+            std_devs[f"{column_prefix}{variable}_std_dev"] = std_devs_from_moments(counts=counts, m2=m2)
+        result.update(std_devs)
+
+        result[min_date_col] = from_utc_ns(min_times)
+        result[max_date_col] = from_utc_ns(max_times)
+        result[count_col] = record_counts
+
+        return pd.DataFrame(result, index=pd.RangeIndex(n_samples))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Convert mooring .mat files into a memory-mapped columnar store.')
+    parser.add_argument('mooring_data_dir', help='Directory with the .mat files (searched recursively)')
+    parser.add_argument('store_dir', help='Directory to write the store to')
+    parser.add_argument('--sites', nargs='+', required=True, help='The sites (stations) to convert')
+    parser.add_argument('--sensors', nargs='+', required=True, help='The sensors to convert')
+    args = parser.parse_args(argv)
+
+    mat_files = sorted(Path(args.mooring_data_dir).rglob('*.mat'))
+    store = MooringStore.from_mat_files(mat_files=mat_files, store_dir=args.store_dir, sites=args.sites, sensors=args.sensors)
+    for (station, sensor), series in store.series.items():
+        print(f"{station}/{sensor}: {len(series)} records, {len(series.deployments)} deployments, variables: {series.variables}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from utils.streaming_joiner import NAT_NS, to_utc_ns
+
+
+class MultiwayAsofJoin:
+    """
+    Nearest as-of join of several sources to the same samples, by station. The samples are sorted (by time then
+    station, the order of the merge_asof output) and their keys converted once. For each source only an array of
+    matched source rows is computed (-1 where there is no match), its columns are gathered with one take, and the
+    samples and all the matches are concatenated once at the end, instead of every merge_asof in a chain sorting and
+    copying the ever wider output of the previous one. Same matches as merge_asof(direction='nearest') by station:
+    ties go to the earlier record, and to the last of several records at the same time.
+    """
+
+    def __init__(self, sample_df: pd.DataFrame, time_col: str, station_col: str):
+        """
+        sample_df: the samples (e.g. the quagmire). A sorted copy is kept as self.sample_df, with the time column as
+        datetimes and the station column as str (like sort_quag_for_utc_merge)
+        """
+        self.sample_df = sample_df.sort_values([time_col, station_col]).reset_index(drop=True)
+        self.sample_df[time_col] = pd.to_datetime(self.sample_df[time_col])
+        self.sample_df[station_col] = self.sample_df[station_col].astype(str)
+        self.time_col = time_col
+        self.station_col = station_col
+
+        sample_times = to_utc_ns(self.sample_df[time_col])
+        sample_stations = self.sample_df[station_col].to_numpy()
+        # {station: (sample positions, their times)}. Positions are time sorted as the samples are sorted by time first
+        self.stations = {}
+        for station in pd.unique(sample_stations):
+            positions = np.flatnonzero((sample_stations == station) & (sample_times != NAT_NS))
+            self.stations[station] = (positions, sample_times[positions])
+
+    def match_rows(self, source_df: pd.DataFrame, time_col: str, station_col: str, tolerance: str) -> np.ndarray:
+        """
+        Row position in source_df of the nearest record (within the tolerance) of each sample's station, for each
+        sample in self.sample_df order. -1 where there is no match.
+        """
+        tolerance_ns = pd.Timedelta(tolerance).value
+        matched_rows = np.full(len(self.sample_df), -1, dtype=np.int64)
+
+        source_times = to_utc_ns(source_df[time_col])
+        source_stations = np.asarray(source_df[station_col].astype(str))
+        for station in pd.unique(source_stations):
+            if station not in self.stations:
+                continue
+            rows = np.flatnonzero((source_stations == station) & (source_times != NAT_NS))
+            if len(rows) == 0:
+                continue
+            rows = rows[np.argsort(source_times[rows], kind='stable')]
+            times = source_times[rows]
+            positions, targets = self.stations[station]
+
+            # Last record at or before the sample time, and first record at or after it
+            before = np.searchsorted(times, targets, side='right') - 1
+            after = np.searchsorted(times, targets, side='left')
+            before_diffs = np.where(before >= 0, targets - times[np.clip(before, 0, None)], np.iinfo(np.int64).max)
+            after_diffs = np.where(after < len(times), times[np.clip(after, None, len(times) - 1)] - targets, np.iinfo(np.int64).max)
+
+            use_after = after_diffs < before_diffs
+            nearest = np.where(use_after, after, before)
+            diffs = np.where(use_after, after_diffs, before_diffs)
+            is_match = diffs <= tolerance_ns
+            matched_rows[positions[is_match]] = rows[nearest[is_match]]
+
+        return matched_rows
+
+    def nearest(self, source_df: pd.DataFrame, time_col: str, station_col: str, tolerance: str) -> pd.DataFrame:
+        """
+        The columns of the nearest record of source_df (within the tolerance, by station) for each sample, aligned to
+        self.sample_df (NaN where there was no match, so int columns become float like in merge_asof)
+        """
+        matched_rows = self.match_rows(source_df=source_df, time_col=time_col, station_col=station_col, tolerance=tolerance)
+        if not isinstance(source_df.index, pd.RangeIndex) or source_df.index.start != 0 or source_df.index.step != 1:
+            source_df = source_df.reset_index(drop=True)
+
+        # Reindexing by row position is a take that fills -1 (no match) with NaN
+        return source_df.reindex(matched_rows).set_axis(self.sample_df.index)
+
+    def join(self, match_dfs: list) -> pd.DataFrame:
+        """
+        The samples with the columns of each source's matches (outputs of nearest, or any df aligned to self.sample_df)
+        """
+        return pd.concat([self.sample_df] + list(match_dfs), axis=1)
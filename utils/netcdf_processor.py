@@ -1,24 +1,49 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
 import pandas as pd
-import xarray as xr
+import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import math
+from utils.variable_selection import is_selected
+from utils.streaming_joiner import NAT_NS, to_utc_ns
+
+if TYPE_CHECKING:
+    import xarray as xr # imported where used (slow to import)
 
 
 class NetcdfProcessor:
 
-    def __init__(self, nc_file: Path):
+    CTD_FILE_DATE_FORMAT = "%Y%m%dT%H%M%S" # format of the date in the CTD .nc file names (e.g. TH042_20230512T151500_...)
 
+    def __init__(self, nc_file: Path, variables: list = None):
+        """
+        variables: optional list of the data variables to read (e.g. temp, salt). All of them if None
+        """
         self.nc_file = Path(nc_file)
+        self.variables = variables
+
+    @staticmethod
+    def select_variables(ds: xr.Dataset, variables: list, required: list = None) -> xr.Dataset:
+        """
+        Drops the data variables that aren't selected (see utils/variable_selection.py) from a lazily opened dataset,
+        so they are never read or decoded. Coordinates are kept.
+        """
+        if variables is None:
+            return ds
+        return ds.drop_vars([var for var in ds.data_vars if not is_selected(name=var, variables=variables, required=required)])
 
     def convert_ctd_nc_to_df(self):
         """
         Concerts a CTD netCDF file to a dataframe. Extracts the date/time and station_id from the file name
         """
+        import xarray as xr
+
         with xr.open_dataset(self.nc_file) as nc_file:
+            nc_file = self.select_variables(ds=nc_file, variables=self.variables)
 
             # Get units
-            new_col_name_dict = self.get_units_from_nc_vars(
-                avg_xr_ds=nc_file, original_xr_ds=nc_file)
+            new_col_name_dict = self.get_units_from_nc_vars(original_xr_ds=nc_file)
 
             ds_final = nc_file.rename(new_col_name_dict)
 
@@ -31,35 +56,328 @@ class NetcdfProcessor:
             station_id = parts[0]
 
             date = pd.to_datetime(
-                parts[1], format="%Y%m%dT%H%M%S", utc=True)
+                parts[1], format=self.CTD_FILE_DATE_FORMAT, utc=True)
 
             nc_df.loc[:, 'station_id'] = station_id
             nc_df.loc[:, 'date'] = date
 
             return nc_df
 
+    @classmethod
+    def convert_ctd_nc_files_to_df(cls, nc_files: list, max_workers: int = 8, variables: list = None) -> pd.DataFrame:
+        """
+        Batched version of convert_ctd_nc_to_df for many CTD profile files: returns one data frame of all the files
+        (same columns as convert_ctd_nc_to_df). The files are opened and flattened in parallel threads, concatenated
+        once, the units rename map is built and applied once for all of them, and the station and date columns are
+        parsed from all the file names at once.
+        """
+        nc_files = [Path(nc_file) for nc_file in nc_files]
+        if not nc_files:
+            return pd.DataFrame()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            profiles = list(executor.map(lambda nc_file: cls._read_ctd_nc_profile(nc_file=nc_file, variables=variables), nc_files))
+        profile_dfs = [profile_df for profile_df, _ in profiles]
+
+        # Units of each variable (the same variable must have the same units in every file)
+        var_units = {}
+        for nc_file, (_, file_units) in zip(nc_files, profiles):
+            for var, units in file_units.items():
+                if var_units.setdefault(var, units) != units:
+                    raise ValueError(f"Variable {var} has units {units} in {nc_file} but {var_units[var]} in other files")
+
+        nc_df = pd.concat(profile_dfs, ignore_index=True)
+        nc_df.rename(columns={var: f"{var}.{units.replace(' ', '_')}" for var, units in var_units.items()}, inplace=True)
+
+        # Extract the station and date from the file names. Hopefully this is consistent across projects.
+        file_name_parts = pd.Series([nc_file.name for nc_file in nc_files]).str.split('_')
+        station_ids = file_name_parts.str[0].to_numpy()
+        dates = pd.DatetimeIndex(pd.to_datetime(file_name_parts.str[1], format=cls.CTD_FILE_DATE_FORMAT, utc=True))
+        rows_per_file = [len(profile_df) for profile_df in profile_dfs]
+
+        nc_df['station_id'] = np.repeat(station_ids, rows_per_file)
+        nc_df['date'] = dates.repeat(rows_per_file)
+
+        return nc_df
+
+    @staticmethod
+    def _read_ctd_nc_profile(nc_file: Path, variables: list = None) -> tuple:
+        """
+        Reads one CTD profile .nc file (only the selected variables). Returns its flattened data frame (original
+        variable names) and a dictionary of the units of its variables.
+        """
+        import xarray as xr
+
+        with xr.open_dataset(nc_file) as ds:
+            ds = NetcdfProcessor.select_variables(ds=ds, variables=variables)
+            var_units = {str(var): ds[var].attrs['units'] for var in ds.variables if 'units' in ds[var].attrs}
+            return ds.to_dataframe().reset_index(), var_units
+
     def convert_rom_ocean_model_to_df(self, min_depth: float, max_depth: float,
                                       depth_var_name: str,
                                       time_dim_name: str,
                                       start_time: str,
                                       end_time: str, 
-                                      station: str) -> pd.DataFrame:
+                                      station: str,
+                                      grid_cell: dict = None) -> pd.DataFrame:
         """
-        Extracts time and depth-averages data from a NetCDF file, returning a pandas DataFrame
+        Extracts time and depth-averages data from a NetCDF file, returning a pandas DataFrame. For full-domain
+        files grid_cell is the station's rho grid cell (see open_rom_dataset).
         """
-        ds = xr.open_dataset(self.nc_file)
+        ds = self.open_rom_dataset(grid_cell=grid_cell, depth_var_name=depth_var_name)
 
         # 1. Filter by the specified time range, if provided
         ds = ds.sel({time_dim_name: slice(start_time, end_time)})
-      
-        df = ds.to_dataframe().reset_index()
-        
-        # round depth to nearest 5's (min_depth down and max_depth  up) and make negative since ocean model data is negative
-        min_depth = (math.floor(min_depth / 5) * 5) *-1
-        max_depth = (math.ceil(max_depth / 5) * 5) * -1
+
+        min_depth, max_depth = self.get_rom_depth_range(min_depth=min_depth, max_depth=max_depth)
         print(f"Minimum depth filtered in ocean model .NC file {max_depth}") # min and max depth switched because negative sign added, switches them.
         print(f"Maximum depth filtered in ocean model .NC file {min_depth}")
-       
+
+        final_df = self.depth_average_rom_ds(ds=ds, min_depth=min_depth, max_depth=max_depth,
+                                             depth_var_name=depth_var_name, time_dim_name=time_dim_name)
+        final_df['station'] = station
+
+        return final_df
+
+    def iter_rom_ocean_model_chunks(self, min_depth: float, max_depth: float,
+                                    depth_var_name: str,
+                                    time_dim_name: str,
+                                    station: str,
+                                    time_mask_func,
+                                    chunk_size: int,
+                                    grid_cell: dict = None):
+        """
+        Yields depth-averaged data frames (same columns as convert_rom_ocean_model_to_df) in time ordered chunks
+        of about chunk_size rows of the flattened model grid. time_mask_func takes the model times (UTC ns) and
+        returns a boolean mask of the times that are needed, so only those time steps are read from disk.
+        """
+        with self.open_rom_dataset(grid_cell=grid_cell, depth_var_name=depth_var_name) as ds:
+            model_times = pd.DatetimeIndex(pd.to_datetime(ds[time_dim_name].values, utc=True)).as_unit('ns').asi8
+            needed_time_indices = np.flatnonzero(time_mask_func(model_times))
+            if len(needed_time_indices) == 0:
+                return
+
+            min_depth, max_depth = self.get_rom_depth_range(min_depth=min_depth, max_depth=max_depth)
+
+            # Number of time steps per chunk, from the number of flattened rows in a single time step
+            # (a static depth variable, e.g. a computed z_rho, is the same for every time step)
+            depth_var = ds[depth_var_name]
+            rows_per_time = int(depth_var.size / ds.sizes[time_dim_name]) if time_dim_name in depth_var.dims else depth_var.size
+            rows_per_time = max(1, rows_per_time)
+            times_per_chunk = max(1, chunk_size // rows_per_time)
+
+            for start in range(0, len(needed_time_indices), times_per_chunk):
+                chunk_ds = ds.isel({time_dim_name: needed_time_indices[start:start + times_per_chunk]})
+                chunk_df = self.depth_average_rom_ds(ds=chunk_ds, min_depth=min_depth, max_depth=max_depth,
+                                                     depth_var_name=depth_var_name, time_dim_name=time_dim_name)
+                chunk_df['station'] = station
+                yield chunk_df
+
+    @staticmethod
+    def nearest_time_indices(time_index: pd.DatetimeIndex, query_times, tolerance: str) -> np.ndarray:
+        """
+        Position in the (sorted) model time_index of the time step nearest to each of query_times, -1 where there is no
+        time step within the tolerance. Same matches as merge_asof(direction='nearest') on the model frame: ties go to
+        the earlier time step (get_indexer(method='nearest') gives them to the later one).
+        """
+        model_times = to_utc_ns(time_index)
+        query_ns = to_utc_ns(query_times)
+        if len(model_times) == 0:
+            return np.full(len(query_ns), -1, dtype=np.int64)
+
+        # Last time step at or before each query time, and first time step at or after it
+        before = np.searchsorted(model_times, query_ns, side='right') - 1
+        after = np.searchsorted(model_times, query_ns, side='left')
+        before_diffs = np.where(before >= 0, query_ns - model_times[np.clip(before, 0, None)], np.iinfo(np.int64).max)
+        after_diffs = np.where(after < len(model_times), model_times[np.clip(after, None, len(model_times) - 1)] - query_ns, np.iinfo(np.int64).max)
+
+        use_after = after_diffs < before_diffs
+        nearest = np.where(use_after, after, before)
+        diffs = np.where(use_after, after_diffs, before_diffs)
+        is_match = (diffs <= pd.Timedelta(tolerance).value) & (query_ns != NAT_NS)
+        return np.where(is_match, nearest, -1).astype(np.int64)
+
+    def select_rom_ocean_model_at_times(self, times, tolerance: str,
+                                        min_depth: float, max_depth: float,
+                                        depth_var_name: str,
+                                        time_dim_name: str,
+                                        grid_cell: dict = None) -> pd.DataFrame:
+        """
+        Point query of the model: the depth-averaged values (same columns as convert_rom_ocean_model_to_df, without
+        station) of the model time step nearest to each of times, within the tolerance. The nearest time steps are
+        looked up for all times at once (see nearest_time_indices, ties go to the earlier time step like the frame
+        merge) and only those time steps are read from disk.
+        Returns one row per time, in the same order, with NaNs where there was no match.
+        """
+        with self.open_rom_dataset(grid_cell=grid_cell, depth_var_name=depth_var_name) as ds:
+            time_index = ds.indexes[time_dim_name]
+            # Model times are in UTC (but naive)
+            query_times = pd.DatetimeIndex(pd.to_datetime(times, utc=True)).tz_convert(None)
+            time_indices = self.nearest_time_indices(time_index=time_index, query_times=query_times, tolerance=tolerance)
+
+            needed_time_indices = np.unique(time_indices[time_indices >= 0])
+            if len(needed_time_indices) == 0:
+                return pd.DataFrame(index=pd.RangeIndex(len(query_times)))
+
+            min_depth, max_depth = self.get_rom_depth_range(min_depth=min_depth, max_depth=max_depth)
+            averaged_df = self.depth_average_rom_ds(ds=ds.isel({time_dim_name: needed_time_indices}),
+                                                    min_depth=min_depth, max_depth=max_depth,
+                                                    depth_var_name=depth_var_name, time_dim_name=time_dim_name)
+
+        # One row per query time: the row of its matched model time step (NaN if no match)
+        matched_model_times = pd.DatetimeIndex(np.where(time_indices >= 0,
+                                                        time_index.values[np.maximum(time_indices, 0)],
+                                                        np.datetime64('NaT')))
+        averaged_df.index = pd.DatetimeIndex(averaged_df[time_dim_name])
+        return averaged_df.reindex(matched_model_times).reset_index(drop=True)
+
+    def select_rom_ocean_model_at_times_and_depths(self, times, depths, tolerance: str,
+                                                   depth_var_name: str,
+                                                   time_dim_name: str,
+                                                   grid_cell: dict = None) -> pd.DataFrame:
+        """
+        Depth-resolved point query of the model: the values of the model time step nearest to each of times (within
+        the tolerance, like select_rom_ocean_model_at_times) linearly interpolated to each of depths (m, positive
+        down) between the depth_var_name (z_rho) levels of that time step. Only the matched time steps of the water
+        column are read, and the interpolation is done for all samples at once with numpy gathers (the grid is never
+        flattened to a data frame). Samples above the top or below the bottom level get the values of that level.
+        Variables without a vertical dimension (e.g. zeta) are taken as they are. Returns one row per time, in the
+        same order, with the matched time, the model depth used and the variables (units in the column names), and
+        NaNs where there was no match.
+        """
+        with self.open_rom_dataset(grid_cell=grid_cell, depth_var_name=depth_var_name) as ds:
+            time_index = ds.indexes[time_dim_name]
+            # Model times are in UTC (but naive)
+            query_times = pd.DatetimeIndex(pd.to_datetime(times, utc=True)).tz_convert(None)
+            time_indices = self.nearest_time_indices(time_index=time_index, query_times=query_times, tolerance=tolerance)
+            target_depths = -np.asarray(depths, dtype=float) # model depths are negative
+
+            needed_time_indices, sample_time_rows = np.unique(time_indices, return_inverse=True)
+            matched = time_indices >= 0
+            if not matched.any():
+                return pd.DataFrame(index=pd.RangeIndex(len(query_times)))
+            # Drop the no match (-1) entry, so sample_time_rows are rows of the needed time steps
+            if needed_time_indices[0] < 0:
+                needed_time_indices = needed_time_indices[1:]
+                sample_time_rows = sample_time_rows - 1
+            sample_time_rows = np.maximum(sample_time_rows, 0)
+            needed_ds = ds.isel({time_dim_name: needed_time_indices})
+
+            # The vertical (s_rho) dimension is the dimension of the depth variable that isn't time
+            vertical_dims = [dim for dim in needed_ds[depth_var_name].dims if dim != time_dim_name and needed_ds.sizes[dim] > 1]
+            if len(vertical_dims) != 1:
+                raise ValueError(f"Can't find the vertical dimension of {depth_var_name} in {self.nc_file} (dims: {needed_ds[depth_var_name].dims})")
+            vertical_dim = vertical_dims[0]
+
+            # Levels of each sample's time step, sorted from the bottom up
+            z_levels = self.get_rom_column_values(var=needed_ds[depth_var_name], time_dim_name=time_dim_name,
+                                                  vertical_dim=vertical_dim, n_times=len(needed_time_indices))
+            level_order = np.argsort(z_levels, axis=1)
+            sample_levels = np.take_along_axis(z_levels, level_order, axis=1)[sample_time_rows]
+
+            # The levels below/above each sample's depth and the interpolation weight of the upper one
+            upper = np.clip((sample_levels < target_depths[:, None]).sum(axis=1), 1, sample_levels.shape[1] - 1)
+            lower = upper - 1
+            lower_z = np.take_along_axis(sample_levels, lower[:, None], axis=1)[:, 0]
+            upper_z = np.take_along_axis(sample_levels, upper[:, None], axis=1)[:, 0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weights = np.clip((target_depths - lower_z) / (upper_z - lower_z), 0, 1)
+
+            result = {time_dim_name: np.where(matched, time_index.values[np.maximum(time_indices, 0)], np.datetime64('NaT'))}
+            for var in needed_ds.data_vars:
+                # Single size spatial dimensions (e.g. the eta/xi of the grid cell) are ignored, but not the time or
+                # vertical dimension (the time dimension has size 1 when all the samples match one time step)
+                var_dims = {dim for dim in needed_ds[var].dims if dim in (time_dim_name, vertical_dim) or needed_ds.sizes[dim] > 1}
+                if var_dims == {time_dim_name, vertical_dim} or str(var) == depth_var_name:
+                    column_values = self.get_rom_column_values(var=needed_ds[var], time_dim_name=time_dim_name,
+                                                               vertical_dim=vertical_dim, n_times=len(needed_time_indices))
+                    column_values = np.take_along_axis(column_values, level_order, axis=1)[sample_time_rows]
+                    lower_values = np.take_along_axis(column_values, lower[:, None], axis=1)[:, 0]
+                    upper_values = np.take_along_axis(column_values, upper[:, None], axis=1)[:, 0]
+                    values = lower_values + weights * (upper_values - lower_values)
+                elif var_dims == {time_dim_name} and np.issubdtype(needed_ds[var].dtype, np.number):
+                    time_values = needed_ds[var].isel({dim: 0 for dim in needed_ds[var].dims if dim != time_dim_name})
+                    values = time_values.values[sample_time_rows]
+                else:
+                    continue
+                result[str(var)] = np.where(matched, values, np.nan)
+
+            units_dict = self.get_units_from_nc_vars(original_xr_ds=needed_ds)
+
+        depth_df = pd.DataFrame(result, index=pd.RangeIndex(len(query_times)))
+        return depth_df.rename(columns={col: units_dict.get(col, col) for col in depth_df.columns})
+
+    @staticmethod
+    def get_rom_column_values(var: xr.DataArray, time_dim_name: str, vertical_dim: str, n_times: int) -> np.ndarray:
+        """
+        Reads a water column variable as a (n_times, n levels) float array. Single size dimensions (e.g. the
+        eta/xi of a station file) are dropped, and a variable that doesn't change with time (e.g. z_rho without
+        zeta) is repeated for each time.
+        """
+        var = var.isel({dim: 0 for dim in var.dims if dim not in (time_dim_name, vertical_dim)})
+        if time_dim_name in var.dims:
+            return var.transpose(time_dim_name, vertical_dim).values.astype(float)
+        return np.broadcast_to(var.transpose(vertical_dim).values.astype(float), (n_times, var.sizes[vertical_dim]))
+
+    def open_rom_dataset(self, grid_cell: dict = None, depth_var_name: str = None) -> xr.Dataset:
+        """
+        Opens the ROMS file (lazily, nothing is read until needed). Files pre-extracted for a station are opened
+        as they are. For full-domain files grid_cell ({eta_rho: i, xi_rho: j}, see utils/geo_index.RomsGridLocator)
+        selects the water column of a single rho grid cell: variables on the u, v, psi and w grids are dropped, and
+        the depth variable is computed from the ROMS vertical coordinates if it's not in the file. Only the selected
+        data variables (self.variables, plus the depth variable) are kept.
+        """
+        import xarray as xr
+
+        ds = xr.open_dataset(self.nc_file)
+        if grid_cell is None:
+            return self.select_variables(ds=ds, variables=self.variables, required=[depth_var_name])
+
+        ds = ds.isel(grid_cell)
+        other_grid_dims = {'eta_u', 'xi_u', 'eta_v', 'xi_v', 'eta_psi', 'xi_psi', 's_w'}
+        ds = ds.drop_vars([var for var in ds.variables if other_grid_dims & set(ds[var].dims)])
+        if depth_var_name and depth_var_name not in ds:
+            ds[depth_var_name] = self.compute_rom_z_rho(ds=ds)
+        # After the depths are computed (from h, zeta, etc.), which may not be selected
+        return self.select_variables(ds=ds, variables=self.variables, required=[depth_var_name])
+
+    @staticmethod
+    def compute_rom_z_rho(ds: xr.Dataset) -> xr.DataArray:
+        """
+        Depths (m, negative down) of the rho points from the ROMS vertical coordinate variables (h, hc, s_rho, Cs_r
+        and zeta if present). Uses Vtransform 2 unless the file says Vtransform 1.
+        """
+        h = ds['h']
+        hc = ds['hc']
+        zeta = ds['zeta'] if 'zeta' in ds else 0
+        vtransform = int(ds['Vtransform'].values) if 'Vtransform' in ds else 2
+
+        if vtransform == 1:
+            z0 = hc * ds['s_rho'] + (h - hc) * ds['Cs_r']
+            z_rho = z0 + zeta * (1 + z0 / h)
+        else:
+            z0 = (hc * ds['s_rho'] + h * ds['Cs_r']) / (hc + h)
+            z_rho = zeta + (zeta + h) * z0
+
+        return z_rho.assign_attrs(units='m')
+
+    def get_rom_depth_range(self, min_depth: float, max_depth: float) -> tuple:
+        """
+        round depth to nearest 5's (min_depth down and max_depth  up) and make negative since ocean model data is negative.
+        Note the returned min is the shallower (less negative) depth, and the max the deeper (more negative) depth.
+        """
+        min_depth = (math.floor(min_depth / 5) * 5) *-1
+        max_depth = (math.ceil(max_depth / 5) * 5) * -1
+        return min_depth, max_depth
+
+    def depth_average_rom_ds(self, ds: xr.Dataset, min_depth: float, max_depth: float,
+                             depth_var_name: str, time_dim_name: str) -> pd.DataFrame:
+        """
+        Flattens the ROMS dataset to a data frame, filters to the depth range (min_depth and max_depth from
+        get_rom_depth_range) and averages over depth for each time. Column names get the units appended.
+        """
+        df = ds.to_dataframe().reset_index()
+
         # filter by depth range (switch min and max because the -1 makes the min_Depth the max, and vice versa, but still the range we need)
         depth_filtered_df = df[df[depth_var_name].between(max_depth, min_depth)]
    
@@ -72,7 +390,6 @@ class NetcdfProcessor:
             for col in final_df.columns
         }
         final_df.rename(columns=column_unit_dict, inplace=True)
-        final_df['station'] = station
 
         return final_df
 
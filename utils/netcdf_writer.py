@@ -0,0 +1,160 @@
+from __future__ import annotations
+import re
+import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+    import xarray as xr # imported where used (slow to import)
+
+
+class NetcdfWriter:
+    """
+    Writes a merged data frame (one row per sample) to a CF-NetCDF file with a sample dimension. The units the
+    processors embed in the column names (name.units) are moved to the units attribute of each variable, and each
+    variable gets a source attribute (and the file a provenance attribute per source) from its column prefix
+    (ctd_, moor_, model_, pps_, ...). Numeric and time variables are chunked along the sample dimension and
+    compressed, so reading a single variable for all samples only reads that variable's chunks.
+    """
+
+    SAMPLE_DIM = 'sample'
+    STD_DEV_SUFFIX = '_std_dev'
+    # column prefix: the source the column comes from (columns with no prefix come from the quagmire)
+    SOURCE_PREFIXES = {
+        'ctd_': 'CTD',
+        'moor_': 'mooring',
+        'model_': 'ocean model',
+        'pps_': 'PPS',
+        'btl_': 'bottle',
+        'nutr_': 'nutrient',
+    }
+
+    def __init__(self, df: pd.DataFrame, source_provenance: dict = None, chunk_size: int = 4096, complevel: int = 4):
+        """
+        df: the merged data frame
+        source_provenance: column prefix ('' for the quagmire): description of the input files of that source (see Aggregator.get_source_provenance)
+        chunk_size: number of samples per chunk
+        complevel: zlib compression level (1-9)
+        """
+        self.df = df
+        self.source_provenance = source_provenance or {}
+        self.chunk_size = chunk_size
+        self.complevel = complevel
+
+    def write(self, nc_file: str):
+        """
+        Writes the data frame to the nc_file
+        """
+        ds = self.to_dataset()
+        encoding = {var: self.get_var_encoding(ds[var]) for var in ds.data_vars}
+        ds.to_netcdf(Path(nc_file), engine='netcdf4', encoding=encoding)
+        print(f"Wrote {ds.sizes[self.SAMPLE_DIM]} samples and {len(ds.data_vars)} variables to {nc_file}")
+
+    def to_dataset(self) -> xr.Dataset:
+        """
+        Converts the data frame to an xarray Dataset with a sample dimension, a variable per column and the
+        units, source and provenance attributes.
+        """
+        import xarray as xr
+
+        data_vars = {}
+        for col in self.df.columns:
+            var_name, units = self.split_units(col=str(col))
+            var_name = self.get_unique_var_name(var_name=var_name, existing=data_vars)
+            values, attrs = self.get_var_values(self.df[col])
+
+            attrs['original_column'] = str(col)
+            if units:
+                attrs['units'] = units
+            source = self.get_source(col=str(col))
+            attrs['source'] = source or 'quagmire'
+
+            data_vars[var_name] = xr.Variable(self.SAMPLE_DIM, values, attrs=attrs)
+
+        ds = xr.Dataset(data_vars, coords={self.SAMPLE_DIM: np.arange(len(self.df))})
+        ds.attrs['Conventions'] = 'CF-1.8'
+        ds.attrs['history'] = f"{datetime.datetime.now(datetime.timezone.utc):%Y-%m-%dT%H:%M:%SZ} created by utils.netcdf_writer"
+        for prefix, provenance in self.source_provenance.items():
+            # An empty prefix is the quagmire
+            ds.attrs[f"source_{prefix.rstrip('_') or 'quagmire'}"] = provenance
+
+        return ds
+
+    def split_units(self, col: str) -> tuple:
+        """
+        Splits a column name into the variable name and the units embedded by the processors (name.units).
+        Standard deviation columns (name.units_std_dev) keep the _std_dev suffix on the name. Returns (name, None)
+        if the column has no units.
+        """
+        std_dev = col.endswith(self.STD_DEV_SUFFIX)
+        if std_dev:
+            col = col[:-len(self.STD_DEV_SUFFIX)]
+
+        name, _, units = col.partition('.')
+        if std_dev:
+            name = f"{name}{self.STD_DEV_SUFFIX}"
+
+        return name, units or None
+
+    def get_source(self, col: str) -> str:
+        """
+        The source of a column from its prefix (None if the column has no source prefix)
+        """
+        for prefix, source in self.SOURCE_PREFIXES.items():
+            if col.startswith(prefix):
+                return source
+        return None
+
+    def get_unique_var_name(self, var_name: str, existing: dict) -> str:
+        """
+        Makes a valid NetCDF variable name (no slashes or spaces), unique among the existing variables
+        """
+        var_name = re.sub(r'[^A-Za-z0-9_.@+-]', '_', var_name)
+        if not var_name or var_name[0].isdigit() or var_name[0] in '_.@+-':
+            var_name = f"v{var_name}"
+
+        unique_name = var_name
+        n = 1
+        while unique_name in existing or unique_name == self.SAMPLE_DIM:
+            unique_name = f"{var_name}_{n}"
+            n += 1
+        return unique_name
+
+    def get_var_values(self, col_values: pd.Series) -> tuple:
+        """
+        Converts a column to values NetCDF can store. Returns the values and any attributes added in the
+        conversion. Time zone aware times are stored as UTC, python dates/datetimes as times, and other non
+        numeric values as strings (empty string for missing values).
+        """
+        attrs = {}
+        if isinstance(col_values.dtype, pd.DatetimeTZDtype):
+            attrs['time_zone'] = 'UTC'
+            return col_values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(), attrs
+
+        if col_values.dtype == object:
+            inferred_type = pd.api.types.infer_dtype(col_values, skipna=True)
+            if inferred_type in ('date', 'datetime', 'datetime64'):
+                attrs['time_zone'] = 'UTC'
+                return pd.to_datetime(col_values, utc=True).dt.tz_localize(None).to_numpy(), attrs
+            if inferred_type in ('floating', 'integer', 'mixed-integer-float'):
+                return col_values.astype(float).to_numpy(), attrs
+            if inferred_type == 'boolean' and col_values.notna().all():
+                return col_values.astype(bool).to_numpy(), attrs
+            return col_values.where(col_values.notna(), '').astype(str).to_numpy(dtype=object), attrs
+
+        return col_values.to_numpy(), attrs
+
+    def get_var_encoding(self, var: xr.DataArray) -> dict:
+        """
+        Chunked, compressed encoding for numeric and time variables. Strings are stored as variable length strings,
+        which NetCDF4 can't compress.
+        """
+        if var.dtype == object:
+            return {}
+        return {
+            'zlib': True,
+            'complevel': self.complevel,
+            'chunksizes': (max(1, min(self.chunk_size, var.size)),),
+        }
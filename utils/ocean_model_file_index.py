@@ -0,0 +1,146 @@
+import glob
+import json
+import os
+from pathlib import Path
+import pandas as pd
+from utils.atomic_write import atomic_write
+from utils.streaming_joiner import to_utc_ns
+
+# Ocean model output delivered as many files per station (e.g. one LiveOcean file per day or year) is listed with
+# globs in the ocean_model_data section of the config.yaml, instead of being concatenated into one file first:
+#
+# ocean_model_data:
+#   model_nc_files:
+#     - /path/to/LiveOcean/TH042/TH042_*.nc # the station is still matched in the file name
+#   time_index_cache_dir: /path/to/time_index_cache # optional (default: .model_time_index next to the files)
+#
+# The files of a station are used as one time series: the first and last time step of each file are indexed once
+# (cached on disk), and only the files overlapping the times a merge needs are opened.
+
+
+def expand_file_patterns(patterns: list) -> list:
+    """
+    The files of a list of paths and glob patterns, in the order listed (the matches of each pattern sorted). Paths
+    without glob characters are kept as they are, even if they are missing (so a missing file still fails when read).
+    """
+    files = []
+    for pattern in patterns or []:
+        pattern = str(pattern)
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(os.path.expanduser(pattern), recursive=True))
+            if not matches:
+                print(f"No ocean model files match {pattern}")
+            files.extend(matches)
+        else:
+            files.append(pattern)
+    return files
+
+
+class OceanModelFileIndex:
+    """
+    Time coverage (first and last time step, UTC ns) of ocean model .nc files. Each file's coverage is read from its
+    time dimension once and cached on disk (keyed by the file's path, size and modification time, like the KD-tree
+    of utils/geo_index.RomsGridLocator), so later runs don't open files that aren't needed.
+    """
+
+    CACHE_FILE = 'time_index.json' # {path: [size, mtime_ns, first_ns, last_ns, n_times]}
+
+    def __init__(self, nc_files: list, time_dim_name: str, cache_dir: str = None):
+        """
+        nc_files: the ocean model files (globs already expanded, see expand_file_patterns)
+        cache_dir: where to keep the time index (default: a .model_time_index directory next to each file)
+        """
+        self.time_dim_name = time_dim_name
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.time_ranges = self.load_or_build_index(nc_files=[str(f) for f in nc_files])
+
+    def get_cache_path(self, nc_file: str) -> Path:
+        cache_dir = self.cache_dir if self.cache_dir else Path(nc_file).parent / '.model_time_index'
+        return cache_dir / self.CACHE_FILE
+
+    def load_or_build_index(self, nc_files: list) -> dict:
+        """
+        {file: (first_ns, last_ns, n_times)} of the files, from the cache, or read from the files that are new or
+        changed (and added to the cache)
+        """
+        cached = {}
+        new_entries = {}
+        time_ranges = {}
+        for nc_file in nc_files:
+            cache_path = self.get_cache_path(nc_file=nc_file)
+            if cache_path not in cached:
+                cached[cache_path] = self.read_cache(cache_path=cache_path)
+
+            key = str(Path(nc_file).resolve())
+            stat = os.stat(nc_file)
+            known = cached[cache_path].get(key)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                time_ranges[nc_file] = tuple(known[2:])
+                continue
+
+            time_ranges[nc_file] = self.read_time_range(nc_file=nc_file)
+            new_entries.setdefault(cache_path, {})[key] = [stat.st_size, stat.st_mtime_ns, *time_ranges[nc_file]]
+
+        for cache_path, entries in new_entries.items():
+            self.write_cache(cache_path=cache_path, new_entries=entries)
+
+        return time_ranges
+
+    def read_time_range(self, nc_file: str) -> tuple:
+        """
+        (first_ns, last_ns, n_times) of the time dimension of the file. Only the time coordinate is read.
+        """
+        import xarray as xr # deferred (slow to import)
+
+        with xr.open_dataset(nc_file) as ds:
+            times_ns = to_utc_ns(ds.indexes[self.time_dim_name])
+        if len(times_ns) == 0:
+            return None, None, 0
+        return int(times_ns.min()), int(times_ns.max()), len(times_ns)
+
+    @staticmethod
+    def read_cache(cache_path: Path) -> dict:
+        if not cache_path.exists():
+            return {}
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+
+    def write_cache(self, cache_path: Path, new_entries: dict):
+        """
+        Adds the new entries to the cache file, merged with the entries other runs added since it was read
+        """
+        entries = self.read_cache(cache_path=cache_path)
+        entries.update(new_entries)
+
+        with atomic_write(cache_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+
+    def time_range(self, nc_file: str) -> tuple:
+        """
+        (first_ns, last_ns) of the file, (None, None) if it has no time steps
+        """
+        first_ns, last_ns, _ = self.time_ranges[str(nc_file)]
+        return first_ns, last_ns
+
+    def overlaps(self, nc_file: str, start_ns: int, end_ns: int) -> bool:
+        """
+        True if the file has time steps in [start_ns, end_ns]
+        """
+        first_ns, last_ns = self.time_range(nc_file=nc_file)
+        return first_ns is not None and first_ns <= end_ns and last_ns >= start_ns
+
+    def sort_by_time(self, nc_files: list) -> list:
+        """
+        The files in order of their first time step (files without time steps last), so the files of a station
+        are read as one time ordered series
+        """
+        first_times = {f: self.time_range(nc_file=f)[0] for f in nc_files}
+        return sorted(nc_files, key=lambda f: (first_times[f] is None, first_times[f] or 0))
+
+    @staticmethod
+    def to_ns(time) -> int:
+        """
+        A date string or timestamp as UTC ns (naive times are UTC)
+        """
+        return int(to_utc_ns(pd.DatetimeIndex([pd.Timestamp(time)]))[0])
@@ -0,0 +1,101 @@
+import pandas as pd
+import yaml
+from pathlib import Path
+
+
+class PostMergeTransformer:
+    """
+    Applies the post_merge_transforms declared in a config.yaml to a merged data frame. Every transform
+    works on whole columns (vectorized map/replace/eval) instead of row by row. Steps run in the order
+    they are listed in the config:
+
+    post_merge_transforms:
+      strict: true # raise if a map step has values that are not in its lookup table (lists all of them at once)
+      steps:
+        - map: # map the values of source_column through a lookup table into column
+            column: Cruise_ID_long
+            source_column: Cruise_ID_short
+            lookup_file: ../ocnms_short_long_cruises.yaml # .yaml dictionary or .csv (relative paths are relative to the config.yaml)
+        - rename:
+            old_col_name: new_col_name
+        - derive: # new column from an expression of other columns (uses DataFrame.eval)
+            column: depth_difference
+            expression: Depth_m - ctd_depth
+        - drop:
+            - col_to_drop
+    """
+
+    def __init__(self, transforms_info: dict, config_dir: Path):
+        """
+        transforms_info: the post_merge_transforms section of the config.yaml
+        config_dir: the directory of the config.yaml (relative lookup files are found from here)
+        """
+        self.steps = transforms_info.get('steps', None) or []
+        self.strict = transforms_info.get('strict', True)
+        self.config_dir = Path(config_dir)
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Runs all the transform steps on the df. The df is updated in place (no copy of the merged df is made)
+        and returned.
+        """
+        for step in self.steps:
+            if len(step) != 1:
+                raise ValueError(f"Each post merge transform step needs exactly one of map, rename, derive or drop. Got: {step}")
+            step_type, step_info = next(iter(step.items()))
+
+            if step_type == 'map':
+                self.map_column(df=df, map_info=step_info)
+            elif step_type == 'rename':
+                df.rename(columns=step_info, inplace=True)
+            elif step_type == 'derive':
+                df[step_info['column']] = df.eval(step_info['expression'])
+            elif step_type == 'drop':
+                df.drop(columns=step_info, inplace=True, errors='ignore')
+            else:
+                raise ValueError(f"Unknown post merge transform: {step_type}. Must be map, rename, derive or drop.")
+
+        return df
+
+    def map_column(self, df: pd.DataFrame, map_info: dict):
+        """
+        Maps the source_column through the lookup table into column. In strict mode all the values
+        missing from the lookup table are reported together. If keep_unmapped is true, values that
+        are not in the lookup table are kept as they are (replace instead of map).
+        """
+        source_col = map_info.get('source_column', map_info['column'])
+        lookup = self.get_lookup(map_info=map_info)
+        source_values = df[source_col]
+
+        if map_info.get('strict', self.strict):
+            unmapped = source_values[~source_values.isin(list(lookup))].unique()
+            if len(unmapped) > 0:
+                raise ValueError(f"{len(unmapped)} value(s) of {source_col} are not in the lookup table for {map_info['column']}: {list(unmapped)}")
+
+        if map_info.get('keep_unmapped', False):
+            df[map_info['column']] = source_values.replace(lookup)
+        else:
+            df[map_info['column']] = source_values.map(lookup)
+
+    def get_lookup(self, map_info: dict) -> dict:
+        """
+        Gets the lookup dictionary of a map step from either the lookup (a dictionary in the config) or
+        the lookup_file (a .yaml dictionary or a .csv with key_column and value_column columns).
+        """
+        if 'lookup' in map_info:
+            return map_info['lookup']
+
+        lookup_file = Path(map_info['lookup_file'])
+        if not lookup_file.is_absolute():
+            lookup_file = self.config_dir / lookup_file
+
+        if lookup_file.suffix in ('.yaml', '.yml'):
+            with open(lookup_file, 'r') as f:
+                return yaml.safe_load(f)
+        elif lookup_file.suffix == '.csv':
+            lookup_df = pd.read_csv(lookup_file)
+            key_col = map_info.get('key_column', lookup_df.columns[0])
+            value_col = map_info.get('value_column', lookup_df.columns[1])
+            return dict(zip(lookup_df[key_col], lookup_df[value_col]))
+        else:
+            raise ValueError(f"Lookup file {lookup_file} must be a .yaml or .csv file")
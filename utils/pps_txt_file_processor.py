@@ -1,17 +1,28 @@
 import pandas as pd
+import numpy as np
+import re
 from pathlib import Path
 
 
 class PpsTextFileProcessor:
     """
     Processes a PPS text file and converts a specific data section into a pandas DataFrame.
-    The file is expected to have a 'DEPLOYMENT DATA' section with a specific 3-line format per event.
+    The file is expected to have a 'DEPLOYMENT DATA' section with a specific 3-line format per event
+    (flush, sample, fixative flush rows).
     """
 
     SAMPLE_START_DATE_COL = 'sample_start_date'
     SAMPLE_DURATION_COL = 'sample_duration'
     SAMPLE_END_DATE_COL = 'sample_end_date'
 
+    # An event row in the 'DEPLOYMENT DATA' section starts with the event number followed by a pipe
+    EVENT_ROW_PATTERN = re.compile(r'^\s*\d+\s*\|')
+    FIELD_SEPARATOR_PATTERN = re.compile(r'\s*\|\s*')
+    # Lines of the section that aren't event rows: the column headers and separator lines (e.g. '-----')
+    HEADER_LINE_PREFIXES = ('Event', '|', 'Number')
+    SEPARATOR_LINE_PATTERN = re.compile(r'^[\s\-=_*+|]*$')
+    EVENT_BLOCK_ROWS = 3 # flush, sample, fixative flush
+
     def __init__(self, pps_txt_file: str, sites: list):
         self.pps_txt_file = Path(pps_txt_file)
         # The list of sites applicable to project. Will pull out of file name and add to df
@@ -20,7 +31,68 @@ class PpsTextFileProcessor:
     def convert_pps_txt_to_df(self):
         """
         Parses the PPS text file to extract 'DEPLOYMENT DATA' and converts it into a pandas DataFrame.
-        This method is more robust than the original and handles inconsistent file headers.
+        The file is streamed line by line in a single pass (stopping at 'PUMPING DATA'). Each event is a
+        block of 3 rows (flush, sample, fixative flush) that all start with the event number. Rows are
+        parsed with a precompiled pattern into column arrays and the DataFrame is built once at the end.
+        Raises a ValueError if a block doesn't have that shape (see _iter_event_blocks), instead of reading the
+        sample and fixative values from the wrong rows.
+        """
+        columns = {
+            'event_number': [],
+            'sample_vol_pumped': [],
+            'sample_duration': [],
+            'sample_start_date': [],
+            'fixative_flush_vol_pumped': [],
+        }
+
+        for event_block in self._iter_event_blocks():
+            if len(event_block) != self.EVENT_BLOCK_ROWS:
+                raise ValueError(f"Event {event_block[0][0]} in {self.pps_txt_file.name} has {len(event_block)} rows, expected "
+                                 f"{self.EVENT_BLOCK_ROWS} (flush, sample, fixative flush) all starting with the event number")
+
+            sample_parts = event_block[1]
+            fixative_flush_parts = event_block[2]
+            try:
+                event_number = int(sample_parts[0])
+                sample_vol_pumped = int(sample_parts[5])
+                sample_duration = int(sample_parts[6]) # This is actually column 7
+                fixative_flush_vol_pumped = int(fixative_flush_parts[5])
+            except (ValueError, IndexError) as e:
+                print(f"Error parsing event {sample_parts[0]} in {self.pps_txt_file.name}: {e}")
+                print(f"Problematic rows: \n2: {' | '.join(sample_parts)}\n3: {' | '.join(fixative_flush_parts)}")
+                continue
+
+            columns['event_number'].append(event_number)
+            columns['sample_vol_pumped'].append(sample_vol_pumped)
+            columns['sample_duration'].append(sample_duration)
+            columns['sample_start_date'].append(sample_parts[2])
+            columns['fixative_flush_vol_pumped'].append(fixative_flush_vol_pumped)
+
+        # Create the final DataFrame once from the column arrays, with typed columns
+        df = pd.DataFrame({
+            'event_number': np.array(columns['event_number'], dtype=np.int64),
+            'sample_vol_pumped': np.array(columns['sample_vol_pumped'], dtype=np.int64),
+            'sample_duration': np.array(columns['sample_duration'], dtype=np.int64),
+            'sample_start_date': pd.to_datetime(columns['sample_start_date'], format='%m/%d/%Y %H:%M:%S'),
+            'fixative_flush_vol_pumped': np.array(columns['fixative_flush_vol_pumped'], dtype=np.int64),
+        })
+
+        # Add station_id if a match is found in the filename
+        for site in self.sites:
+            if site in self.pps_txt_file.name:
+                df['station_id'] = site
+                break  # Exit loop once a match is found
+
+        # Calculate sample_end_date
+        final_df = self.get_sample_end_date(pps_df=df)
+
+        return final_df
+
+    def reference_convert_pps_txt_to_df(self):
+        """
+        The original (reference engine) parser of the 'DEPLOYMENT DATA' section: reads the whole file, collects the
+        data lines, then parses them in groups of 3 lines. Kept to check convert_pps_txt_to_df against
+        (see utils/engine_verifier.py).
         """
         with open(self.pps_txt_file, 'r', encoding='utf-8') as file:
             lines = file.readlines()
@@ -109,6 +181,45 @@ class PpsTextFileProcessor:
 
         return final_df
 
+    def _iter_event_blocks(self):
+        """
+        Lazily reads the 'DEPLOYMENT DATA' section of the file and yields the rows of each event
+        (lists of the pipe separated fields), grouped by event number. Header, blank and separator
+        lines do not match the event row pattern and are skipped. Any other line after the first event row
+        raises a ValueError: it would be a row of an event without the event number, which would shift the
+        sample and fixative rows of the block.
+        """
+        event_block = []
+        data_section_started = False
+
+        with open(self.pps_txt_file, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not data_section_started:
+                    # Found the start of the data section
+                    data_section_started = "DEPLOYMENT DATA" in line
+                    continue
+
+                if "PUMPING DATA" in line:
+                    # Found the end of the section, stop processing
+                    break
+
+                if not self.EVENT_ROW_PATTERN.match(line):
+                    line_stripped = line.strip()
+                    if (event_block and not line_stripped.startswith(self.HEADER_LINE_PREFIXES)
+                            and not self.SEPARATOR_LINE_PATTERN.match(line_stripped)):
+                        raise ValueError(f"Unexpected row in the DEPLOYMENT DATA of {self.pps_txt_file.name} after event "
+                                         f"{event_block[0][0]} (event rows start with the event number): {line_stripped}")
+                    continue
+
+                parts = [part for part in self.FIELD_SEPARATOR_PATTERN.split(line.strip()) if part]
+                if event_block and parts[0] != event_block[0][0]:
+                    yield event_block
+                    event_block = []
+                event_block.append(parts)
+
+        if event_block:
+            yield event_block
+
     def get_sample_end_date(self, pps_df: pd.DataFrame) -> pd.DataFrame:
         """
         Calculate the sample end date based on the sample_start_date and the sample_duration.
@@ -1,7 +1,5 @@
 import pandas as pd
 import re
-import pytz
-from timezonefinder import TimezoneFinder
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import numpy as np
@@ -31,13 +29,25 @@ class QuagmireCreator:
     NEW_LAT_DEC_DEG_COL = 'Lat_dec'
     NEW_LON_DEC_DEG_COL = 'Lon_dec'
 
-    def __init__(self, machine_readable_files: list, station_col: str, lat_dir: str = None, lon_dir: str = None):
+    def __init__(self, machine_readable_files: list, station_col: str, lat_dir: str = None, lon_dir: str = None, source_cache=None,
+                 station_registry=None):
+        """
+        source_cache: optional SourceCache the processed machine readable files are taken from (or stored in)
+        station_registry: optional StationRegistry the samples are assigned to by position (see utils/station_registry.py)
+        """
 
         self.station_col = station_col
         self.lat_dir = lat_dir
         self.lon_dir = lon_dir
         self.machine_readable_files = machine_readable_files
-        self.quagmire_df = self.process_mr_file()
+        self.station_registry = station_registry
+        if source_cache is None:
+            self.quagmire_df = self.process_mr_file()
+        else:
+            self.quagmire_df = source_cache.get_or_create(source_name='quagmire', files=machine_readable_files,
+                                                          params={'station_col': station_col, 'lat_dir': lat_dir, 'lon_dir': lon_dir,
+                                                                  'station_registry': station_registry.to_params() if station_registry else None},
+                                                          create_func=self.process_mr_file)
         self.quag_min_date, self.quag_max_date = self.get_quag_min_and_max_dates()
         self.quag_min_depth, self.quag_max_depth = self.get_quag_min_and_max_depths()
         self.quag_station_sites = self.quagmire_df[self.station_col].unique().tolist()
@@ -61,6 +71,11 @@ class QuagmireCreator:
 
         # get lat/lon in decimal degrees
         mr_df_lat_lon_updated = self.convert_lat_lon_coords(mr_df=mr_df)
+
+        # Assign the samples to the nearest station of the registry (if there is one), instead of trusting the station labels
+        if self.station_registry is not None:
+            mr_df_lat_lon_updated = self.station_registry.assign_station_col(df=mr_df_lat_lon_updated, station_col=self.station_col,
+                                                                             lat_col=self.NEW_LAT_DEC_DEG_COL, lon_col=self.NEW_LON_DEC_DEG_COL)
     
         # Edit dates - calculating local time or UTC time, and adding combined date/time columns for both local and UTC
         mr_df_dates_updated = self.edit_dates(mr_df=mr_df_lat_lon_updated)
@@ -162,6 +177,8 @@ class QuagmireCreator:
         if pd.isna(lat) or pd.isna(lon) or not lat or not lon:
             return None
         
+        from timezonefinder import TimezoneFinder # deferred (slow to import)
+
         tf = TimezoneFinder()
         tz = tf.timezone_at(lng=lon, lat=lat)
         if tz is None:
@@ -199,6 +216,8 @@ class QuagmireCreator:
         if pd.isna(local_date_time_combined) or not local_date_time_combined:
             return np.nan # Must return nan for get_quag_min_max_dates to work.
         
+        import pytz # deferred (slow to import)
+
         local_tz = pytz.timezone(timezone)
         local_dt_naive = datetime.fromisoformat(local_date_time_combined)
 
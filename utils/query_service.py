@@ -0,0 +1,359 @@
+import argparse
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+import numpy as np
+import pandas as pd
+from utils.mooring_aggregator import MooringAggregator
+from utils.mat_file_processor import MatFileProcessor
+from utils.mooring_store import MooringStore
+from utils.streaming_joiner import NAT_NS, to_utc_ns
+from utils.variable_selection import select_names
+
+# Long-lived query service for the environmental context (nearest CTD, mooring and ocean model records) of single
+# samples. The sources of a MooringAggregator config are loaded and indexed once, and each query is a binary search
+# per source instead of a full FINALmerge_* run. Sources whose files changed are reloaded on the next query.
+#
+# Examples:
+# python -m utils.query_service projects/OCNMS/OCNMS_CTD/config.yaml --sample E1857.OC0723
+# python -m utils.query_service projects/OCNMS/OCNMS_CTD/config.yaml --serve --port 8765
+# curl 'http://localhost:8765/sample/E1857.OC0723'
+# curl 'http://localhost:8765/context?station=TH042&time=2023-05-12T15:15:00Z&depth=40'
+
+
+class StationTimeIndex:
+    """
+    Per station sorted times (int64 UTC ns) of a source data frame, for nearest time lookups by binary search.
+    """
+
+    def __init__(self, df: pd.DataFrame, time_col: str, station_col: str):
+        self.df = df
+        times = to_utc_ns(df[time_col])
+        stations = np.asarray(df[station_col].astype(str))
+        valid = times != NAT_NS
+
+        # station: (rows of the df sorted by time, their times)
+        self.stations = {}
+        for station in pd.unique(stations[valid]):
+            rows = np.flatnonzero(valid & (stations == station))
+            rows = rows[np.argsort(times[rows], kind='stable')]
+            self.stations[station] = (rows, times[rows])
+
+    def nearest(self, station: str, time_ns: int, tolerance: str) -> pd.Series:
+        """
+        The record of the station nearest to time_ns within the tolerance (ties go to the earlier record, like
+        merge_asof with direction='nearest'), or None
+        """
+        if station not in self.stations or time_ns == NAT_NS:
+            return None
+        rows, times = self.stations[station]
+
+        after = min(int(np.searchsorted(times, time_ns, side='left')), len(times) - 1)
+        before = max(after - 1, 0)
+        nearest = after if abs(times[after] - time_ns) < abs(time_ns - times[before]) else before
+        if abs(times[nearest] - time_ns) > pd.Timedelta(tolerance).value:
+            return None
+        return self.df.iloc[rows[nearest]]
+
+
+class QueryService:
+    """
+    Keeps a MooringAggregator and indices of its sources warm to answer per sample (by quagmire sample name) or per
+    (station, time, depth) queries. The file stats of each source are checked at most every reload_check_seconds,
+    and only the sources whose files changed are reloaded (all of them if the config or the quagmire files changed).
+    """
+
+    SOURCES = ['quagmire', 'ctd', 'mooring', 'ocean_model']
+
+    def __init__(self, config_yaml: str, source_cache_dir: str = None, reload_check_seconds: float = 2.0):
+        self.config_yaml = str(config_yaml)
+        self.source_cache_dir = source_cache_dir
+        self.reload_check_seconds = reload_check_seconds
+        self.last_reload_check = 0.0
+        self.aggregator = None
+        self.indices = {}
+        self.file_stats = {}
+        self.load_all()
+
+    def load_all(self):
+        """
+        (Re)builds the aggregator and loads and indexes all its sources
+        """
+        start = time.perf_counter()
+        self.aggregator = MooringAggregator(config_yaml=self.config_yaml, source_cache_dir=self.source_cache_dir)
+        self.indices = {}
+        self.file_stats = {}
+        for source in self.SOURCES:
+            self.load_source(source=source, reuse_loaded=True)
+        self.last_reload_check = time.monotonic()
+        print(f"Query service loaded {self.config_yaml} in {time.perf_counter() - start:.1f}s")
+
+    def load_source(self, source: str, reuse_loaded: bool = False):
+        """
+        Loads (or reloads) a source into the aggregator (sources a streaming config doesn't load up front too)
+        and indexes it by station and time. With reuse_loaded, a source the aggregator already loaded is only indexed.
+        """
+        aggregator = self.aggregator
+        loaded = reuse_loaded and hasattr(aggregator, {'ctd': 'ctd_df', 'mooring': 'mooring_df', 'ocean_model': 'ocean_model_df'}.get(source, ''))
+        if source == 'ocean_model' and not reuse_loaded:
+            # Globs are expanded again and the time index rebuilt (from its cache), so new or changed model files are used
+            aggregator.model_data_files = aggregator.get_ocean_model_data_files()
+            aggregator.model_time_index = None
+        if source == 'quagmire':
+            quag_df = aggregator.quagmire_df
+            self.indices[source] = {str(name): row for row, name in enumerate(quag_df[aggregator.quag_sample_name_col])}
+        elif source == 'ctd' and aggregator.config_file.get('ctd_data', None):
+            loaders = {'nc': aggregator.convert_ctd_nc_files_to_df,
+                       'cnv': aggregator.convert_ctd_cnv_files_to_df,
+                       'ros': aggregator.convert_ctd_ros_files_to_df}
+            if not loaded:
+                aggregator.ctd_df = loaders[aggregator.ctd_file_type]()
+            self.indices[source] = StationTimeIndex(df=aggregator.ctd_df, time_col=aggregator.CTD_DATE_COL,
+                                                    station_col=aggregator.CTD_STATION_COL)
+        elif source == 'mooring' and aggregator.moor_series['nearest'] == 'lpdata':
+            if not (reuse_loaded and hasattr(aggregator, 'mooring_lowpass_df')):
+                aggregator.mooring_lowpass_df = aggregator.convert_mat_files_to_df(series='lpdata')
+            self.indices[source] = StationTimeIndex(df=aggregator.mooring_lowpass_df, time_col=aggregator.MOORING_DATE_COL,
+                                                    station_col=aggregator.MOORING_STATION_ID_COL)
+        elif source == 'mooring':
+            if aggregator.mooring_store_dir and not reuse_loaded:
+                aggregator.mooring_store = MooringStore.open_or_create(store_dir=aggregator.mooring_store_dir,
+                                                                       mat_files=self.get_source_files(source=source),
+                                                                       sites=aggregator.quag_station_sites,
+                                                                       sensors=aggregator.moor_sensors)
+            elif not aggregator.mooring_store_dir:
+                if not loaded:
+                    aggregator.mooring_df = aggregator.convert_mat_files_to_df()
+                self.indices[source] = StationTimeIndex(df=aggregator.mooring_df, time_col=aggregator.MOORING_DATE_COL,
+                                                        station_col=aggregator.MOORING_STATION_ID_COL)
+        elif source == 'ocean_model' and aggregator.ocean_model_extraction == 'frame':
+            if not loaded:
+                aggregator.ocean_model_df = aggregator.convert_ocean_model_nc_to_df()
+            self.indices[source] = StationTimeIndex(df=aggregator.ocean_model_df,
+                                                    time_col=f"model_{aggregator.ocean_model_time_dim_name}",
+                                                    station_col=aggregator.OCEAN_MODEL_STATION_COL)
+
+        self.file_stats[source] = self.get_file_stats(files=self.get_source_files(source=source))
+
+    def get_source_files(self, source: str) -> list:
+        """
+        The input files of a source (the config itself counts as a quagmire file, since everything depends on it)
+        """
+        aggregator = self.aggregator
+        if source == 'quagmire':
+            return [self.config_yaml, *aggregator.config_file['machine_readable_info']['machine_readable_files']]
+        if source == 'ctd' and aggregator.config_file.get('ctd_data', None):
+            if aggregator.ctd_file_type == 'nc':
+                return aggregator.get_ctd_nc_files_needed()
+            if aggregator.ctd_file_type == 'cnv':
+                return sorted(aggregator.ctd_cnv_file_directory.rglob('*.cnv'))
+            return sorted(aggregator.ctd_ros_file_directory.rglob('*.ros'))
+        if source == 'mooring':
+            return sorted(aggregator.mooring_mat_dir.rglob('*.mat'))
+        if source == 'ocean_model':
+            # Globs expanded again, so a new model file (e.g. the next daily file) counts as a change
+            return [*aggregator.get_ocean_model_data_files(), *aggregator.model_grid_files]
+        return []
+
+    @staticmethod
+    def get_file_stats(files: list) -> list:
+        """
+        (path, size, modification time) of each file, (path, None, None) if it is missing
+        """
+        stats = []
+        for file in files:
+            try:
+                stat = os.stat(file)
+                stats.append((str(file), stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append((str(file), None, None))
+        return stats
+
+    def reload_changed_sources(self):
+        """
+        Reloads the sources whose files changed since they were loaded (at most every reload_check_seconds)
+        """
+        if time.monotonic() - self.last_reload_check < self.reload_check_seconds:
+            return
+        self.last_reload_check = time.monotonic()
+
+        if self.get_file_stats(files=self.get_source_files(source='quagmire')) != self.file_stats['quagmire']:
+            print("Quagmire files changed, reloading all sources")
+            self.load_all()
+            return
+        for source in self.SOURCES[1:]:
+            if self.get_file_stats(files=self.get_source_files(source=source)) != self.file_stats[source]:
+                print(f"{source} files changed, reloading")
+                self.load_source(source=source)
+
+    def query_sample(self, sample_name: str) -> dict:
+        """
+        The quagmire row of a sample with the nearest CTD, mooring and ocean model records at its station,
+        utc time and depth. Raises KeyError if the sample isn't in the quagmire.
+        """
+        self.reload_changed_sources()
+        row = self.indices['quagmire'].get(str(sample_name))
+        if row is None:
+            raise KeyError(f"Sample {sample_name} not found in the quagmire")
+
+        aggregator = self.aggregator
+        quag_row = aggregator.quagmire_df.iloc[row]
+        context = self.query_context(station=quag_row[aggregator.quag_site_col_name],
+                                     utc_time=quag_row[aggregator.quag_utc_date_time_col],
+                                     depth=pd.to_numeric(quag_row[aggregator.quag_depth_col], errors='coerce'),
+                                     reload=False)
+        return {**quag_row.to_dict(), **context}
+
+    def query_context(self, station: str, utc_time, depth: float = None, reload: bool = True) -> dict:
+        """
+        The nearest CTD (within the ctd_quag_merge_tolerance), mooring and ocean model (within one hour) records at
+        the station and utc time (naive times are UTC), with the same columns as the merged output. depth (m) is
+        used by the depth_resolved ocean model extraction.
+        """
+        if reload:
+            self.reload_changed_sources()
+        aggregator = self.aggregator
+        station = str(station)
+        time_ns = int(to_utc_ns([utc_time])[0])
+
+        context = {}
+        if 'ctd' in self.indices:
+            ctd_tolerance = aggregator.ctd_quag_merge_tolerance or '1h'
+            ctd_record = self.indices['ctd'].nearest(station=station, time_ns=time_ns, tolerance=ctd_tolerance)
+            if ctd_record is not None:
+                context.update(ctd_record.to_dict())
+                context['ctd_quag_time_difference'] = pd.Timedelta(abs(time_ns - int(to_utc_ns([ctd_record[aggregator.CTD_DATE_COL]])[0])))
+
+        context.update(self.query_mooring(station=station, time_ns=time_ns))
+        context.update(self.query_ocean_model(station=station, time_ns=time_ns, depth=depth))
+        return context
+
+    def query_mooring(self, station: str, time_ns: int) -> dict:
+        """
+        The nearest mooring record within one hour (from the mooring store if the config uses one, or the low-passed
+        series if the nearest merge uses it)
+        """
+        aggregator = self.aggregator
+        if 'mooring' in self.indices:
+            record = self.indices['mooring'].nearest(station=station, time_ns=time_ns, tolerance='1h')
+            return record.to_dict() if record is not None else {}
+
+        # Nearest record over all the sensor series of the station
+        best = None
+        for series in aggregator.mooring_store.station_series(station=station):
+            row = int(series.nearest_indices(times_ns=[time_ns], tolerance='1h')[0])
+            if row >= 0 and (best is None or abs(series.times[row] - time_ns) < best[0]):
+                best = (abs(series.times[row] - time_ns), series, row)
+        if best is None:
+            return {}
+        _, series, row = best
+        mooring_df = aggregator.prefix_columns(df=series.to_df(rows=[row], variables=select_names(names=series.variables, variables=aggregator.moor_variables, required=MatFileProcessor.REQUIRED_FIELDS)), prefix='moor_')
+        return mooring_df.iloc[0].to_dict()
+
+    def query_ocean_model(self, station: str, time_ns: int, depth: float) -> dict:
+        """
+        The nearest ocean model time step within one hour (from the model .nc files for the point_query and
+        depth_resolved extractions)
+        """
+        aggregator = self.aggregator
+        if 'ocean_model' in self.indices:
+            record = self.indices['ocean_model'].nearest(station=station, time_ns=time_ns, tolerance='1h')
+            return record.to_dict() if record is not None else {}
+
+        query_df = pd.DataFrame({aggregator.quag_site_col_name: [station],
+                                 aggregator.quag_utc_date_time_col: pd.DatetimeIndex([time_ns]).tz_localize('UTC'),
+                                 aggregator.quag_depth_col: [depth]})
+        model_matches = aggregator.point_query_ocean_model_at_quag_times(quag_df_sorted=query_df, tolerance='1h')
+        return model_matches.iloc[0].dropna().to_dict()
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8765):
+        """
+        Serves the queries over HTTP (JSON responses) until interrupted:
+        GET /sample/<sample name>
+        GET /context?station=<station>&time=<utc time>[&depth=<m>]
+        """
+        service = self
+
+        class QueryHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                start = time.perf_counter()
+                try:
+                    if url.path.startswith('/sample/'):
+                        result = service.query_sample(sample_name=unquote(url.path[len('/sample/'):]))
+                    elif url.path == '/context':
+                        depth = float(params['depth']) if params.get('depth') else None
+                        result = service.query_context(station=params['station'], utc_time=params['time'], depth=depth)
+                    else:
+                        return self.send_json(status=404, body={'error': f"Unknown path {url.path}. Use /sample/<name> or /context?station=&time=&depth="})
+                except KeyError as e:
+                    return self.send_json(status=404, body={'error': str(e)})
+                except ValueError as e:
+                    return self.send_json(status=400, body={'error': str(e)})
+
+                self.send_json(status=200, body={'result': to_json_values(result), 'ms': (time.perf_counter() - start) * 1000})
+
+            def send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = HTTPServer((host, port), QueryHandler)
+        print(f"Query service listening on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def to_json_values(record: dict) -> dict:
+    """
+    Converts the values of a query result to JSON values (NaN/NaT to null, times to ISO strings)
+    """
+    json_record = {}
+    for key, value in record.items():
+        if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+            value = None
+        elif isinstance(value, (pd.Timestamp, pd.Timedelta)):
+            value = value.isoformat()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        json_record[str(key)] = value
+    return json_record
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Query the environmental context of single samples from warm sources.')
+    parser.add_argument('config_yaml', help='A MooringAggregator config.yaml')
+    parser.add_argument('--sample', action='append', default=[], help='Sample name(s) to query and print (can be repeated)')
+    parser.add_argument('--serve', action='store_true', help='Serve queries over HTTP on localhost')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to serve on (default: localhost only)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to serve on')
+    parser.add_argument('--source-cache-dir', default=None, help='Directory to cache parsed sources in')
+    args = parser.parse_args(argv)
+
+    service = QueryService(config_yaml=Path(args.config_yaml), source_cache_dir=args.source_cache_dir)
+    for sample_name in args.sample:
+        start = time.perf_counter()
+        result = service.query_sample(sample_name=sample_name)
+        print(json.dumps(to_json_values(result), indent=2))
+        print(f"({(time.perf_counter() - start) * 1000:.1f} ms)")
+
+    if args.serve:
+        service.serve(host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,22 @@
-import ctd
 import pandas as pd
 import re
 from datetime import datetime
+from utils.station_registry import parse_nmea_lat_lon
+from utils.variable_selection import select_names
 
 # TODO: Add time zone conversion in check_time_zone. Right now it just makes sure local time == utc which means they are the same
 
 class RosProcessor:
-    def __init__(self, ros_file: str, sites: list, day_convention: str):
+
+    REQUIRED_COLS = ['timeJ_Julian_Days'] # columns always kept (the time column is made from it)
+
+    def __init__(self, ros_file: str, sites: list, day_convention: str, variables: list = None, station_registry=None):
 
         self.ros_file = ros_file
         self.sites = sites
         self.day_convention = day_convention # specifies julian day 0 or 1. 
+        self.variables = variables # optional list of the columns to keep. All of them if None
+        self.station_registry = station_registry # optional StationRegistry to assign the cast to a station by its NMEA position
         self.start_time = self.get_the_start_time()
         self.ros_df = self.convert_ros_to_df()
 
@@ -50,6 +56,13 @@ class RosProcessor:
             if line.startswith('* System UpLoad Time'):
                 self.get_system_time(line=line)
 
+        # Positions of the selected columns, so only their values are kept from each line
+        selected_positions = None
+        if self.variables is not None and column_names:
+            selected_names = set(select_names(names=column_names, variables=self.variables, required=self.REQUIRED_COLS))
+            selected_positions = [i for i, col in enumerate(column_names) if col in selected_names]
+            column_names = [column_names[i] for i in selected_positions]
+
         # Read the data portion
         data_lines = lines[header_end:]
         data = []
@@ -57,6 +70,8 @@ class RosProcessor:
             line = line.strip()
             if line and not line.startswith('*'):
                 values = line.split()
+                if selected_positions is not None:
+                    values = [values[i] for i in selected_positions]
                 data.append(values)
 
         df = pd.DataFrame(data, columns=column_names if column_names else None)
@@ -147,8 +162,18 @@ class RosProcessor:
 
     def get_site(self, ros_df: pd.DataFrame) -> pd.DataFrame:
         """
-        Add the site to the df
+        Add the site to the df. With a station registry the cast is assigned to the station nearest to the NMEA
+        position in its header (if it has one and a station is close enough), otherwise the file is searched for the site names.
         """
+        if self.station_registry is not None:
+            with open(self.ros_file, 'r', encoding='latin-1') as header_file:
+                lat, lon = parse_nmea_lat_lon(header_lines=header_file)
+            if lat is not None and lon is not None:
+                stations, _ = self.station_registry.assign(lats=[lat], lons=[lon])
+                if stations[0] is not None:
+                    ros_df['station_id'] = stations[0]
+                    return ros_df
+
         with open(self.ros_file, 'r') as cnv_file:
             file_content = cnv_file.read()
 
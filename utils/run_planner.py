@@ -0,0 +1,359 @@
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import yaml
+from utils.quagmire_creator import QuagmireCreator
+from utils.station_registry import StationRegistry
+from utils.ocean_model_file_index import OceanModelFileIndex, expand_file_patterns
+
+# Dry run of a project: estimates the rows, memory and runtime of each stage of its merge from the config.yaml, the
+# quagmire, the sizes of the source files and their headers (no source is parsed), and flags the stages likely to go
+# over a memory budget or fan out into many-to-many rows. E.g.:
+# python -m utils.run_planner projects/OCNMS/*/config.yaml --memory-budget-mb 8000
+# (or python -m utils.batch_runner ... --plan)
+
+# Rough throughputs (rows per second) used for the runtime estimates
+ROWS_PER_SECOND = {
+    'mat': 2e6, # .mat files are loaded whole by scipy, then converted to data frames
+    'ctd_nc': 5e5,
+    'text': 2e5, # .cnv, .ros and PPS .txt files are parsed line by line
+    'csv': 1e6,
+    'ocean_model': 3e6, # flattened to a data frame and depth averaged
+    'merge': 5e6, # merge_asof / index range joins on sorted sources
+}
+BYTES_PER_VALUE = 8 # float64 / datetime64 columns
+CSV_MEMORY_FACTOR = 2.0 # data frame size / csv file size (object columns are bigger than their text)
+
+
+class RunPlanner:
+    """
+    Plans the merge of a project without running it. Each stage of the plan is a dictionary with the stage name,
+    the estimated input rows, output rows, peak memory (MB) and runtime (s), and notes (warnings).
+    """
+
+    def __init__(self, config_yaml: str, memory_budget_mb: float = 4000):
+        self.config_yaml = Path(config_yaml)
+        with open(self.config_yaml, 'r') as f:
+            self.config_file = yaml.safe_load(f)
+        self.memory_budget_mb = memory_budget_mb
+        self.run_info = self.config_file.get('run_info', None) or {}
+        execution_info = self.config_file.get('execution', None) or {}
+        self.execution_mode = execution_info.get('mode', 'in_memory')
+        self.stream_chunk_size = execution_info.get('chunk_size', 100000)
+
+        # The samples are assigned to stations like the aggregator does (so the per station estimates match the run)
+        self.station_registry = StationRegistry.from_config(machine_readable_info=self.config_file['machine_readable_info'],
+                                                            config_dir=self.config_yaml.parent)
+        self.quagmire_creator = QuagmireCreator(machine_readable_files=self.config_file['machine_readable_info']['machine_readable_files'],
+                                                station_col=self.config_file['machine_readable_info']['station_col'],
+                                                lat_dir=self.config_file['machine_readable_info'].get('lat_dir', None),
+                                                lon_dir=self.config_file['machine_readable_info'].get('lon_dir', None),
+                                                station_registry=self.station_registry)
+        self.quagmire_df = self.quagmire_creator.quagmire_df
+        self.quag_rows = len(self.quagmire_df)
+        self.quag_station_sites = self.quagmire_creator.quag_station_sites
+
+    def plan(self) -> list:
+        """
+        The stages of the project's merge (from the aggregator in run_info) with their estimates
+        """
+        stages = [self.stage(name='quagmire', input_rows=self.quag_rows, output_rows=self.quag_rows,
+                             memory_mb=self.quagmire_df.memory_usage(deep=True).sum() / 1e6, seconds=0)]
+        if self.run_info.get('aggregator') == 'CtdBottleAggregator':
+            stages.extend(self.plan_ctd_bottle())
+        else:
+            stages.extend(self.plan_mooring())
+
+        for stage in stages:
+            if stage['memory_mb'] > self.memory_budget_mb:
+                stage['notes'].append(f"over the {self.memory_budget_mb:.0f} MB memory budget")
+        return stages
+
+    def stage(self, name: str, input_rows: float, output_rows: float, memory_mb: float, seconds: float, notes: list = None) -> dict:
+        return {'stage': name, 'input_rows': int(input_rows), 'output_rows': int(output_rows),
+                'memory_mb': float(memory_mb), 'seconds': float(seconds), 'notes': notes or []}
+
+    def plan_mooring(self) -> list:
+        """
+        Stages of a MooringAggregator merge: loading the pps (if used), mooring, ctd (if used) and ocean model sources,
+        then the nearest time (ctd workflow) or window average (pps workflow) merge of each onto the samples.
+        """
+        stages = []
+        streaming = self.execution_mode == 'streaming'
+        merge_method = self.run_info.get('merge_method', '')
+        sample_rows = self.quag_rows
+
+        if self.config_file.get('pps_data', None):
+            pps_files = sorted(Path(self.config_file['pps_data']['pps_txt_files_dir']).rglob('*PPS*.txt'))
+            pps_rows = sum(self.count_lines(file) for file in pps_files)
+            stages.append(self.stage(name=f"load pps ({len(pps_files)} files)", input_rows=pps_rows, output_rows=pps_rows,
+                                     memory_mb=pps_rows * 20 * BYTES_PER_VALUE / 1e6, seconds=pps_rows / ROWS_PER_SECOND['text']))
+            if 'pps' in merge_method:
+                # The pps rows of each sample's station and rosette position
+                sample_rows = max(self.quag_rows, pps_rows)
+                stages.append(self.stage(name='merge pps', input_rows=self.quag_rows + pps_rows, output_rows=sample_rows,
+                                         memory_mb=sample_rows * 60 * BYTES_PER_VALUE / 1e6, seconds=(self.quag_rows + pps_rows) / ROWS_PER_SECOND['merge']))
+
+        # source: load stage
+        source_stages = {'mooring': self.plan_mooring_source(streaming=streaming)}
+        if self.config_file.get('ctd_data', None) and 'ctd' in merge_method:
+            source_stages['ctd'] = self.plan_ctd_source(streaming=streaming)
+        source_stages['ocean model'] = self.plan_ocean_model_source(streaming=streaming)
+        stages.extend(source_stages.values())
+
+        for source, source_stage in source_stages.items():
+            merge_rows = sample_rows + source_stage['output_rows']
+            stages.append(self.stage(name=f"merge {source}", input_rows=merge_rows, output_rows=sample_rows,
+                                     memory_mb=sample_rows * 100 * BYTES_PER_VALUE / 1e6,
+                                     seconds=merge_rows / ROWS_PER_SECOND['merge']))
+
+        return stages
+
+    def plan_mooring_source(self, streaming: bool) -> dict:
+        """
+        The mooring source: exact rows from the mooring store if there is one, otherwise an estimate from the size of
+        the .mat files and the share of their variables that match the quagmire sites and the sensors
+        """
+        mooring_info = self.config_file['mooring_info']
+        mat_files = sorted(Path(mooring_info['mooring_data_dir']).rglob('*.mat'))
+        store_dir = mooring_info.get('store_dir', None)
+        from utils.mooring_store import MooringStore
+
+        if store_dir and (Path(store_dir) / MooringStore.STORE_META_FILE).exists():
+            store = MooringStore(store_dir=store_dir)
+            rows = sum(len(series) for series in store.series.values())
+            n_vars = max((len(series.variables) for series in store.series.values()), default=1)
+            # Memory mapped, only the records near the samples are read
+            return self.stage(name=f"load mooring (store, {len(store.series)} series)", input_rows=rows, output_rows=rows,
+                              memory_mb=min(rows, self.stream_chunk_size) * (n_vars + 2) * BYTES_PER_VALUE / 1e6, seconds=0)
+
+        from scipy.io import whosmat # deferred (slow to import)
+
+        sensors = mooring_info.get('sensors', None) or []
+        matching_bytes = 0
+        for mat_file in mat_files:
+            variables = [name for name, _, _ in whosmat(mat_file) if not name.startswith('_')]
+            matching = [name for name in variables
+                        if any(site in name for site in self.quag_station_sites) and any(sensor in name for sensor in sensors)]
+            matching_bytes += os.path.getsize(mat_file) * len(matching) / max(len(variables), 1)
+
+        # About 10 float64 values (time and the sensor variables) per record
+        rows = matching_bytes / (10 * BYTES_PER_VALUE)
+        memory_mb = (min(rows, self.stream_chunk_size) if streaming else rows) * 12 * BYTES_PER_VALUE / 1e6
+        notes = ['the mooring store will be built on the first run'] if store_dir else []
+        return self.stage(name=f"load mooring ({len(mat_files)} .mat files)", input_rows=rows, output_rows=rows,
+                          memory_mb=memory_mb, seconds=rows / ROWS_PER_SECOND['mat'], notes=notes)
+
+    def plan_ctd_source(self, streaming: bool) -> dict:
+        """
+        The ctd source: rows from the dimensions in the .nc file headers, or from the line counts of the .cnv/.ros files
+        """
+        ctd_info = self.config_file['ctd_data']
+        notes = []
+        if ctd_info.get('net_cdf_dir', None):
+            import xarray as xr # deferred (slow to import)
+
+            nc_files = [f for f in sorted(Path(ctd_info['net_cdf_dir']).rglob('*.nc'))
+                        if any(station in str(f) for station in self.quag_station_sites)]
+            rows = 0
+            n_vars = 1
+            for nc_file in nc_files:
+                with xr.open_dataset(nc_file) as ds:
+                    rows += int(np.prod(list(ds.sizes.values()))) if ds.sizes else 1
+                    n_vars = max(n_vars, len(ds.variables))
+            files_str, seconds = f"{len(nc_files)} .nc files", rows / ROWS_PER_SECOND['ctd_nc']
+        else:
+            suffix = 'cnv' if ctd_info.get('cnv_dir', None) else 'ros'
+            ctd_files = sorted(Path(ctd_info.get(f"{suffix}_dir")).rglob(f"*.{suffix}"))
+            rows = sum(self.count_lines(file) for file in ctd_files)
+            n_vars = 20
+            files_str, seconds = f"{len(ctd_files)} .{suffix} files", rows / ROWS_PER_SECOND['text']
+            if ctd_info.get('profile_binning', None):
+                # Binned as they are read, the output rows depend on the cast depths (the scan count is an upper bound)
+                notes.append(f"casts binned every {ctd_info['profile_binning'].get('bin_size')} (output rows are an upper bound)")
+
+        memory_mb = (min(rows, self.stream_chunk_size) if streaming else rows) * n_vars * BYTES_PER_VALUE / 1e6
+        return self.stage(name=f"load ctd ({files_str})", input_rows=rows, output_rows=rows, memory_mb=memory_mb, seconds=seconds, notes=notes)
+
+    def plan_ocean_model_source(self, streaming: bool) -> dict:
+        """
+        The ocean model source, from the dimensions of the .nc file headers: the model time steps in the quagmire
+        date range, times the grid points per time step (the water column of one cell for full-domain files)
+        """
+        import xarray as xr # deferred (slow to import)
+
+        model_info = self.config_file['ocean_model_data']
+        time_dim = model_info['time_dim_name']
+        extraction = model_info.get('extraction', 'frame')
+        # The quagmire dates are YYYY-MM-DD (UTC), the whole max date is included (like the .sel in convert_rom_ocean_model_to_df)
+        min_date = pd.Timestamp(self.quagmire_creator.quag_min_date)
+        end_date = pd.Timestamp(self.quagmire_creator.quag_max_date) + pd.Timedelta('1D')
+
+        station_files = [f for f in expand_file_patterns(patterns=model_info.get('model_nc_files', None))
+                         if any(station in f for station in self.quag_station_sites)]
+        # Station files outside the quagmire date range aren't opened (e.g. the other daily files of a glob)
+        time_index = OceanModelFileIndex(nc_files=station_files, time_dim_name=time_dim, cache_dir=model_info.get('time_index_cache_dir', None))
+        start_ns = OceanModelFileIndex.to_ns(min_date)
+        end_ns = OceanModelFileIndex.to_ns(end_date) - 1
+        station_files = [(f, None) for f in station_files if time_index.overlaps(nc_file=f, start_ns=start_ns, end_ns=end_ns)]
+        grid_files = [(f, 's_rho') for f in model_info.get('grid_nc_files', None) or []]
+        flattened_rows = 0
+        time_steps = 0
+        n_vars = 1
+        notes = []
+        for nc_file, column_dim in [*station_files, *grid_files]:
+            with xr.open_dataset(nc_file) as ds:
+                times = ds.indexes[time_dim]
+                n_times = int(((times >= min_date) & (times < end_date)).sum())
+                n_stations = len(self.quag_station_sites) if column_dim else 1
+                if column_dim:
+                    rows_per_time = ds.sizes.get(column_dim, 1)
+                else:
+                    depth_var = ds[model_info['depth_variable_name']]
+                    rows_per_time = int(depth_var.size / ds.sizes[time_dim]) if time_dim in depth_var.dims else depth_var.size
+                flattened_rows += n_times * rows_per_time * n_stations
+                time_steps += n_times * n_stations
+                n_vars = max(n_vars, len(ds.data_vars))
+                if n_times > 24 * 366 * 2:
+                    notes.append(f"{Path(nc_file).name}: {n_times} time steps in the quagmire date range")
+
+        if extraction != 'frame':
+            # Only the time steps near the samples are read at merge time
+            point_rows = min(time_steps, self.quag_rows)
+            return self.stage(name=f"load ocean model ({extraction})", input_rows=point_rows, output_rows=point_rows,
+                              memory_mb=point_rows * n_vars * BYTES_PER_VALUE / 1e6,
+                              seconds=point_rows * 40 / ROWS_PER_SECOND['ocean_model'], notes=notes)
+
+        memory_rows = min(flattened_rows, self.stream_chunk_size) if streaming else flattened_rows
+        return self.stage(name=f"load ocean model ({len(station_files) + len(grid_files)} files)", input_rows=flattened_rows,
+                          output_rows=time_steps, memory_mb=memory_rows * (n_vars + 2) * BYTES_PER_VALUE / 1e6,
+                          seconds=flattened_rows / ROWS_PER_SECOND['ocean_model'], notes=notes)
+
+    def plan_ctd_bottle(self) -> list:
+        """
+        Stages of a CtdBottleAggregator merge: loading the csvs, and the bottle/ctd merge, whose output rows are
+        counted exactly from the cast and pressure columns (duplicate ctd pressures fan out into many-to-many rows).
+        """
+        stages = []
+        csv_rows = {}
+        for data_key, csv_key, prefix in [('ctd_data', 'ctd_csv', 'ctd'), ('bottle_data', 'bottle_csv', 'bottle'), ('nutrient_data', 'nutrient_csv', 'nutrient')]:
+            file_info = self.config_file.get(data_key, None)
+            if not file_info:
+                continue
+            csv_file = file_info[csv_key]
+            csv_rows[prefix] = max(self.count_lines(csv_file) - 1 - (1 if file_info.get('unit_row', None) else 0), 0)
+            stages.append(self.stage(name=f"load {prefix} csv", input_rows=csv_rows[prefix], output_rows=csv_rows[prefix],
+                                     memory_mb=os.path.getsize(csv_file) * CSV_MEMORY_FACTOR / 1e6,
+                                     seconds=csv_rows[prefix] / ROWS_PER_SECOND['csv']))
+
+        sample_rows = self.quag_rows
+        if 'ctd' in csv_rows and 'bottle' in csv_rows and 'missing_btlNumbers' in self.run_info.get('merge_method', ''):
+            ctd_info = self.config_file['ctd_data']
+            btl_info = self.config_file['bottle_data']
+            notes = []
+            if ctd_info.get('pressure_tolerance', None) is not None:
+                # Nearest pressure merge: one ctd record per bottle
+                merged_rows = csv_rows['bottle']
+            else:
+                ctd_keys = self.read_cast_pressure_keys(file_info=ctd_info, csv_file=ctd_info['ctd_csv'])
+                btl_keys = self.read_cast_pressure_keys(file_info=btl_info, csv_file=btl_info['bottle_csv'])
+                ctd_key_counts = ctd_keys.value_counts()
+                # Each bottle row matches every ctd row with its cast and rounded pressure (at least itself, for a left merge)
+                merged_rows = int(btl_keys.map(ctd_key_counts).fillna(1).clip(lower=1).sum())
+                if merged_rows > len(btl_keys):
+                    notes.append(f"many-to-many: {merged_rows / max(len(btl_keys), 1):.1f}x bottle rows "
+                                 f"(set ctd_data pressure_tolerance or group_by_cols_to_average)")
+            stages.append(self.stage(name='merge bottle ctd', input_rows=csv_rows['bottle'] + csv_rows['ctd'], output_rows=merged_rows,
+                                     memory_mb=merged_rows * 80 * BYTES_PER_VALUE / 1e6,
+                                     seconds=(csv_rows['bottle'] + csv_rows['ctd']) / ROWS_PER_SECOND['merge'], notes=notes))
+            sample_rows = max(self.quag_rows, int(self.quag_rows * merged_rows / max(csv_rows['bottle'], 1)))
+
+        if 'bottle' in csv_rows:
+            stages.append(self.stage(name='merge quagmire bottle', input_rows=self.quag_rows + csv_rows['bottle'], output_rows=sample_rows,
+                                     memory_mb=sample_rows * 100 * BYTES_PER_VALUE / 1e6,
+                                     seconds=(self.quag_rows + csv_rows['bottle']) / ROWS_PER_SECOND['merge']))
+        if 'nutrient' in csv_rows:
+            stages.append(self.stage(name='merge nutrient', input_rows=sample_rows + csv_rows['nutrient'], output_rows=sample_rows,
+                                     memory_mb=sample_rows * 120 * BYTES_PER_VALUE / 1e6,
+                                     seconds=(sample_rows + csv_rows['nutrient']) / ROWS_PER_SECOND['merge']))
+        return stages
+
+    def read_cast_pressure_keys(self, file_info: dict, csv_file: str) -> pd.Series:
+        """
+        Reads only the cast and pressure columns of a ctd/bottle csv and returns the (cast, rounded pressure) key of
+        each row, like merge_bottle_ctd_on_cast_pressure builds them
+        """
+        header = file_info.get('header_row', 0) or 0
+        unit_row = file_info.get('unit_row', None)
+        header_names = pd.read_csv(csv_file, header=None, nrows=max(header, unit_row or 0) + 1).iloc[header].astype(str).tolist()
+        cast_idx = next(i for i, name in enumerate(header_names) if name.startswith(file_info['cast_num_col_name']))
+        pressure_idx = next(i for i, name in enumerate(header_names) if name.startswith(file_info['pressure_col_name']))
+
+        df = pd.read_csv(csv_file, header=None, skiprows=max(header, unit_row or 0) + 1, usecols=[cast_idx, pressure_idx])
+        casts = df[cast_idx].astype(str)
+        for str_to_remove in file_info.get('cast_val_str_to_remove', None) or []:
+            casts = casts.str.replace(str_to_remove, '', regex=False)
+        casts = pd.to_numeric(casts, errors='coerce')
+        pressures = pd.to_numeric(df[pressure_idx], errors='coerce').round()
+        return pd.Series(list(zip(casts, pressures)))
+
+    @staticmethod
+    def count_lines(file) -> int:
+        """
+        Number of lines of a text file (read in binary blocks, without parsing)
+        """
+        lines = 0
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                lines += block.count(b'\n')
+        return lines
+
+
+def print_plan(project: str, stages: list):
+    """
+    Prints the stages of a plan and their estimates
+    """
+    print(f"\n{project}")
+    print(f"  {'stage':<42}{'input rows':>14}{'output rows':>14}{'memory (MB)':>13}{'time (s)':>10}  notes")
+    for stage in stages:
+        print(f"  {stage['stage']:<42}{stage['input_rows']:>14,}{stage['output_rows']:>14,}{stage['memory_mb']:>13.1f}"
+              f"{stage['seconds']:>10.1f}  {'; '.join(stage['notes'])}")
+
+
+def plan_projects(config_yamls: list, memory_budget_mb: float = 4000) -> bool:
+    """
+    Prints the plan of each project. Returns False if a stage of any plan goes over the memory budget or fans out
+    (or a plan couldn't be made).
+    """
+    ok = True
+    for config_yaml in config_yamls:
+        start = time.perf_counter()
+        project = Path(config_yaml).parent.name
+        try:
+            stages = RunPlanner(config_yaml=config_yaml, memory_budget_mb=memory_budget_mb).plan()
+        except Exception as e:
+            print(f"\n{project}\n  plan FAILED: {e!r}")
+            ok = False
+            continue
+        print_plan(project=f"{project} (planned in {time.perf_counter() - start:.1f}s)", stages=stages)
+        flagged = [stage for stage in stages
+                   if stage['memory_mb'] > memory_budget_mb or any(note.startswith('many-to-many') for note in stage['notes'])]
+        ok = ok and not flagged
+    return ok
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Estimate the rows, memory and runtime of each stage of project merges without running them.')
+    parser.add_argument('config_yamls', nargs='+', help='The config.yaml files of the projects to plan')
+    parser.add_argument('--memory-budget-mb', type=float, default=4000, help='Flag the stages estimated to need more memory than this')
+    args = parser.parse_args(argv)
+
+    return 0 if plan_projects(config_yamls=args.config_yamls, memory_budget_mb=args.memory_budget_mb) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+from utils.atomic_write import atomic_write
+
+
+class SourceCache:
+    """
+    On-disk cache of parsed source data frames (mooring, ctd, ocean model, pps, csv, quagmire). Used so
+    that projects run together (e.g. through the batch_runner) or one after the other parse sources they
+    have in common only once. Entries are content addressed: keyed by the source name, the SHA-256 of
+    the input files (so the same file under two project directories is one entry, and a touched but
+    unchanged file is still a hit) and the parser parameters (sites, sensors, day convention, header rows, etc.).
+    Entries are stored as Parquet (or pickle if pyarrow isn't installed or the frame can't be written as
+    Parquet, e.g. mixed type object columns). If max_size_mb is set, the least recently used entries are
+    evicted once the cache grows past it.
+    """
+
+    HASH_INDEX_FILE = 'file_hashes.json' # {path: [size, mtime_ns, sha256]} so unchanged files aren't hashed again
+    HASH_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, cache_dir: str, max_size_mb: float = None):
+
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = int(max_size_mb * 1024 ** 2) if max_size_mb else None
+        self.hash_index_path = self.cache_dir / self.HASH_INDEX_FILE
+        self.hash_index = self.load_hash_index()
+
+    def get_or_create(self, source_name: str, files: list, params: dict, create_func) -> pd.DataFrame:
+        """
+        Returns the cached data frame for the source if it exists, otherwise calls create_func()
+        to parse the source and stores the result. Readers hold a shared lock on the entry, and the
+        process creating it an exclusive one, so other processes asking for the same entry wait for
+        the first one to finish parsing instead of parsing it again (and eviction never removes an
+        entry that is being read).
+        """
+        key = self.make_key(source_name=source_name, files=files, params=params)
+        entry_stem = self.cache_dir / f"{source_name}_{key}"
+
+        with self._entry_lock(entry_stem, exclusive=False):
+            df = self.read_entry(entry_stem)
+        if df is not None:
+            print(f"Using cached {source_name} data from {entry_stem}")
+            return df
+
+        with self._entry_lock(entry_stem, exclusive=True):
+            # Another process may have created it while we were waiting for the lock
+            df = self.read_entry(entry_stem)
+            if df is not None:
+                print(f"Using cached {source_name} data from {entry_stem}")
+                return df
+
+            df = create_func()
+            self.write_entry(entry_stem, df=df)
+
+        if self.max_size_bytes:
+            self.evict()
+
+        return df
+
+    def make_key(self, source_name: str, files: list, params: dict) -> str:
+        """
+        Makes the cache key from the source name, the content hashes of the files (in the order given,
+        which is the order they are parsed and concatenated in) and the parser parameters.
+        """
+        file_hashes = self.hash_files(files=files)
+
+        key_info = {'source': source_name, 'files': file_hashes, 'params': params}
+        key_str = json.dumps(key_info, sort_keys=True, default=str)
+
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()[:32]
+
+    def hash_files(self, files: list) -> list:
+        """
+        SHA-256 of the contents of each file. Hashes are remembered by path, size and modification time
+        in the hash index of the cache, so a file is only read again after it changed.
+        """
+        file_hashes = []
+        new_hashes = {}
+        for file in files:
+            file = str(Path(file).resolve())
+            stat = os.stat(file)
+            known = self.hash_index.get(file)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                file_hashes.append(known[2])
+                continue
+
+            sha = hashlib.sha256()
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b''):
+                    sha.update(block)
+            new_hashes[file] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+            file_hashes.append(sha.hexdigest())
+
+        if new_hashes:
+            self.save_hash_index(new_hashes=new_hashes)
+
+        return file_hashes
+
+    def load_hash_index(self) -> dict:
+        """
+        The remembered file hashes ({} if there are none yet)
+        """
+        if not self.hash_index_path.exists():
+            return {}
+        with self._entry_lock(self.hash_index_path, exclusive=False):
+            with open(self.hash_index_path, 'r') as f:
+                return json.load(f)
+
+    def save_hash_index(self, new_hashes: dict):
+        """
+        Adds new file hashes to the hash index, merged with the hashes other processes added since it was loaded
+        """
+        with self._entry_lock(self.hash_index_path, exclusive=True):
+            if self.hash_index_path.exists():
+                with open(self.hash_index_path, 'r') as f:
+                    self.hash_index = json.load(f)
+            self.hash_index.update(new_hashes)
+
+            with atomic_write(self.hash_index_path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.hash_index, f)
+
+    def read_entry(self, entry_stem: Path):
+        """
+        Reads the entry (Parquet or pickle). Returns None if it isn't in the cache. The entry's modification time
+        is updated on every read so eviction removes the least recently used entries first.
+        """
+        for suffix, read_func in [('.parquet', pd.read_parquet), ('.pkl', pd.read_pickle)]:
+            entry_path = entry_stem.with_suffix(suffix)
+            if entry_path.exists():
+                df = read_func(entry_path)
+                os.utime(entry_path)
+                return df
+        return None
+
+    def write_entry(self, entry_stem: Path, df: pd.DataFrame):
+        """
+        Writes the entry as Parquet, or as pickle if the data frame can't be written as Parquet (see atomic_write).
+        """
+        try:
+            with atomic_write(entry_stem.with_suffix('.parquet')) as tmp_path:
+                df.to_parquet(tmp_path)
+        except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+            # No pyarrow, or columns Parquet can't hold (mixed types, non string column names)
+            print(f"Caching {entry_stem.name} as pickle ({type(e).__name__}: {e})")
+            with atomic_write(entry_stem.with_suffix('.pkl')) as tmp_path:
+                df.to_pickle(tmp_path)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is under max_size_bytes. Entries that are
+        locked (being read or created by another process) are skipped.
+        """
+        entries = [path for path in self.cache_dir.iterdir() if path.suffix in ('.parquet', '.pkl')]
+        entry_stats = {path: path.stat() for path in entries}
+        total_size = sum(stat.st_size for stat in entry_stats.values())
+
+        for path in sorted(entries, key=lambda p: entry_stats[p].st_mtime_ns):
+            if total_size <= self.max_size_bytes:
+                break
+            entry_stem = path.with_suffix('')
+            with self._entry_lock(entry_stem, exclusive=True, blocking=False) as locked:
+                if not locked or not path.exists():
+                    continue
+                path.unlink()
+                total_size -= entry_stats[path].st_size
+                print(f"Evicted {path.name} from the source cache")
+
+    @contextmanager
+    def _entry_lock(self, entry_path: Path, exclusive: bool = True, blocking: bool = True):
+        """
+        Lock on a cache entry (shared for reading, exclusive for writing), shared across processes.
+        Yields False if not blocking and the lock is held by another process.
+        """
+        lock_path = entry_path.with_suffix('.lock')
+        with open(lock_path, 'w') as lock_file:
+            operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,127 @@
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import yaml
+from utils.geo_index import GeoIndex
+
+# A registry of station names and coordinates, used to assign samples and CTD casts to the nearest station by
+# position instead of by matching station labels (which differ between cruises, e.g. TH042 vs TH42 vs Teahwhit 42).
+# Declared in the machine_readable_info section of the config.yaml:
+#
+# machine_readable_info:
+#   station_registry: ../ocnms_stations.yaml # .yaml or .csv (relative paths are relative to the config.yaml)
+#   station_max_distance_km: 5 # samples/casts further than this from every station keep their own label
+#
+# The .yaml is a dictionary of station: {lat: 47.87, lon: -124.73} (decimal degrees), the .csv has station, lat
+# and lon columns.
+
+
+class StationRegistry:
+    """
+    Station coordinates with a KD-tree over them (see utils/geo_index.py), assigning positions to the nearest station
+    within max_distance_km, for all rows at once.
+    """
+
+    DEFAULT_MAX_DISTANCE_KM = 5.0
+
+    def __init__(self, stations: dict, max_distance_km: float = None):
+        """
+        stations: {station name: (lat, lon)} in decimal degrees
+        """
+        if not stations:
+            raise ValueError("The station registry has no stations")
+        self.station_names = np.array(list(stations), dtype=object)
+        self.station_lats = np.array([float(lat) for lat, _ in stations.values()])
+        self.station_lons = np.array([float(lon) for _, lon in stations.values()])
+        self.max_distance_km = float(max_distance_km) if max_distance_km is not None else self.DEFAULT_MAX_DISTANCE_KM
+        self.geo_index = GeoIndex(lats=self.station_lats, lons=self.station_lons)
+
+    @classmethod
+    def from_file(cls, registry_file: str, max_distance_km: float = None) -> 'StationRegistry':
+        """
+        Loads the registry from a .yaml dictionary (station: {lat, lon}) or a .csv with station, lat and lon columns
+        """
+        registry_file = Path(registry_file)
+        if registry_file.suffix in ('.yaml', '.yml'):
+            with open(registry_file, 'r') as f:
+                stations = {str(station): (coords['lat'], coords['lon']) for station, coords in yaml.safe_load(f).items()}
+        elif registry_file.suffix == '.csv':
+            registry_df = pd.read_csv(registry_file)
+            stations = {str(station): (lat, lon) for station, lat, lon in zip(registry_df['station'], registry_df['lat'], registry_df['lon'])}
+        else:
+            raise ValueError(f"Station registry {registry_file} must be a .yaml or .csv file")
+
+        return cls(stations=stations, max_distance_km=max_distance_km)
+
+    @classmethod
+    def from_config(cls, machine_readable_info: dict, config_dir: Path):
+        """
+        The registry declared in the machine_readable_info section of a config.yaml, or None if there isn't one
+        """
+        registry_file = machine_readable_info.get('station_registry', None)
+        if not registry_file:
+            return None
+        registry_file = Path(registry_file)
+        if not registry_file.is_absolute():
+            registry_file = Path(config_dir) / registry_file
+        return cls.from_file(registry_file=registry_file, max_distance_km=machine_readable_info.get('station_max_distance_km', None))
+
+    def assign(self, lats, lons) -> tuple:
+        """
+        The nearest station to each lat/lon and its distance in km. The station is None where it is further than
+        max_distance_km or the position is missing (distance NaN).
+        """
+        lats = pd.to_numeric(pd.Series(np.asarray(lats, dtype=object)), errors='coerce').to_numpy(dtype=float)
+        lons = pd.to_numeric(pd.Series(np.asarray(lons, dtype=object)), errors='coerce').to_numpy(dtype=float)
+        stations = np.full(len(lats), None, dtype=object)
+        distances_km = np.full(len(lats), np.nan)
+
+        has_position = ~np.isnan(lats) & ~np.isnan(lons)
+        if has_position.any():
+            positions, distances_km[has_position] = self.geo_index.nearest(lats=lats[has_position], lons=lons[has_position])
+            within = distances_km[has_position] <= self.max_distance_km
+            stations[np.flatnonzero(has_position)[within]] = self.station_names[positions[within]]
+
+        return stations, distances_km
+
+    def assign_station_col(self, df: pd.DataFrame, station_col: str, lat_col: str, lon_col: str) -> pd.DataFrame:
+        """
+        Replaces the station labels of the rows of df within max_distance_km of a registry station with that station.
+        Rows without a position or too far from every station keep their label. Prints how many labels changed.
+        """
+        stations, _ = self.assign(lats=df[lat_col], lons=df[lon_col])
+        assigned = pd.Series(stations, index=df.index)
+        original = df[station_col] if station_col in df else pd.Series(None, index=df.index, dtype=object)
+
+        n_changed = int((assigned.notna() & (assigned != original.astype(str))).sum())
+        n_unassigned = int(assigned.isna().sum())
+        if n_changed or n_unassigned:
+            print(f"Station registry: {n_changed} station labels changed, {n_unassigned} rows not within {self.max_distance_km} km of a station (label kept)")
+
+        df[station_col] = assigned.where(assigned.notna(), original)
+        return df
+
+    def to_params(self) -> dict:
+        """
+        The registry as source cache parameters
+        """
+        return {'stations': {str(name): [float(lat), float(lon)] for name, lat, lon in zip(self.station_names, self.station_lats, self.station_lons)},
+                'max_distance_km': self.max_distance_km}
+
+
+def parse_nmea_lat_lon(header_lines) -> tuple:
+    """
+    Latitude and longitude (decimal degrees) from the '* NMEA Latitude = 47 52.47 N' and '* NMEA Longitude =
+    124 43.67 W' header lines of a Sea-Bird .cnv/.ros file. (None, None) if the file doesn't have them.
+    """
+    coords = {}
+    pattern = r"\*\s*NMEA (Latitude|Longitude)\s*=\s*(\d+)\s+(\d+\.?\d*)\s*([NSEW])"
+    for line in header_lines:
+        match = re.match(pattern, line.strip())
+        if match:
+            decimal = float(match.group(2)) + float(match.group(3)) / 60
+            coords[match.group(1)] = -decimal if match.group(4) in ('S', 'W') else decimal
+        if '*END*' in line:
+            break
+    return coords.get('Latitude', None), coords.get('Longitude', None)
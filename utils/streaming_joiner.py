@@ -0,0 +1,322 @@
+import numpy as np
+import pandas as pd
+
+# int64 value of NaT
+NAT_NS = np.iinfo(np.int64).min
+
+
+def to_utc_ns(times) -> np.ndarray:
+    """
+    Converts datetimes to int64 nanoseconds since the Unix epoch (UTC). Naive datetimes are assumed to
+    be in UTC. NaT becomes NAT_NS.
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+    return times.as_unit('ns').asi8
+
+
+def from_utc_ns(times_ns: np.ndarray) -> pd.DatetimeIndex:
+    """
+    Converts int64 nanoseconds since the Unix epoch back to UTC datetimes. NAT_NS becomes NaT.
+    """
+    return pd.DatetimeIndex(np.asarray(times_ns, dtype=np.int64).view('datetime64[ns]')).tz_localize('UTC')
+
+
+def pool_moments(group_ids: np.ndarray, counts: np.ndarray, means: np.ndarray, m2: np.ndarray, n_groups: int) -> tuple:
+    """
+    Pools partial moments by group: (count, mean, M2) of each group, where M2 is the sum of the squared offsets of the
+    values from the mean. The pooled M2 is the sum of the partial M2s plus each partial's count times the squared
+    offset of its mean from the pooled mean (the parallel form of Welford's algorithm), so no large sums of squares
+    are subtracted from each other. Partials without values (count 0) are left out. The mean is NaN for groups
+    without values.
+    """
+    has_values = np.asarray(counts) > 0
+    group_ids = np.asarray(group_ids)[has_values]
+    counts = np.asarray(counts, dtype=float)[has_values]
+    means = np.asarray(means, dtype=float)[has_values]
+    m2 = np.asarray(m2, dtype=float)[has_values]
+
+    pooled_counts = np.bincount(group_ids, weights=counts, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled_means = np.bincount(group_ids, weights=counts * means, minlength=n_groups) / pooled_counts
+    pooled_m2 = np.bincount(group_ids, weights=m2 + counts * (means - pooled_means[group_ids]) ** 2, minlength=n_groups)
+    return pooled_counts, pooled_means, pooled_m2
+
+
+def group_moments(group_ids: np.ndarray, values: np.ndarray, n_groups: int) -> tuple:
+    """
+    (count, mean, M2) of the non-NaN values of each group (see pool_moments), in two passes: the means, then the
+    squared offsets from them
+    """
+    values = np.asarray(values, dtype=float)
+    is_valid = ~np.isnan(values)
+    n_valid = int(is_valid.sum())
+    return pool_moments(group_ids=np.asarray(group_ids)[is_valid], counts=np.ones(n_valid), means=values[is_valid],
+                        m2=np.zeros(n_valid), n_groups=n_groups)
+
+
+def std_devs_from_moments(counts: np.ndarray, m2: np.ndarray) -> np.ndarray:
+    """
+    Sample standard deviations (ddof=1) from the count and M2 of each group. NaN where a group has fewer than 2 values.
+    """
+    counts = np.asarray(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 1, np.sqrt(np.maximum(m2, 0) / (counts - 1)), np.nan)
+
+
+def range_rows(lows: np.ndarray, highs: np.ndarray) -> tuple:
+    """
+    (range_ids, rows): the rows of each [low, high) range one after the other, and the range each row belongs to.
+    Used to reduce many (possibly overlapping) row ranges at once with bincounts.
+    """
+    lengths = np.asarray(highs, dtype=np.int64) - np.asarray(lows, dtype=np.int64)
+    range_ids = np.repeat(np.arange(len(lengths)), lengths)
+    range_firsts = np.cumsum(lengths) - lengths
+    rows = np.arange(len(range_ids), dtype=np.int64) - range_firsts[range_ids] + np.asarray(lows, dtype=np.int64)[range_ids]
+    return range_ids, rows
+
+
+class SampleTimeIndex:
+    """
+    Compact per station index of the time windows of the quagmire samples. Each sample has a window
+    (start/end in UTC ns) and, for nearest matches, a target time. Used to find which samples overlap a
+    chunk of source data without holding the source in memory.
+    """
+
+    def __init__(self, stations, window_starts: np.ndarray, window_ends: np.ndarray, target_times: np.ndarray = None):
+        """
+        stations: station of each sample (compared as strings to the source station column)
+        window_starts/window_ends: the start and end (inclusive) of the window of each sample in UTC ns
+        target_times: the time of each sample to find the nearest source record to (for nearest matches)
+        """
+        stations = np.asarray(pd.Series(stations).astype(str))
+        self.n_samples = len(stations)
+        self.window_starts = np.asarray(window_starts, dtype=np.int64)
+        self.window_ends = np.asarray(window_ends, dtype=np.int64)
+        self.target_times = None if target_times is None else np.asarray(target_times, dtype=np.int64)
+
+        # Per station: sample positions sorted by window start, their starts, ends, and the running max of the ends
+        self.stations = {}
+        valid = (self.window_starts != NAT_NS) & (self.window_ends != NAT_NS)
+        for station in pd.unique(stations[valid]):
+            positions = np.flatnonzero(valid & (stations == station))
+            positions = positions[np.argsort(self.window_starts[positions], kind='stable')]
+            starts = self.window_starts[positions]
+            ends = self.window_ends[positions]
+            self.stations[station] = (positions, starts, ends, np.maximum.accumulate(ends))
+
+    @classmethod
+    def from_target_times(cls, stations, times, tolerance: str):
+        """
+        Index for nearest matches: each sample's window is its time plus or minus the tolerance.
+        """
+        target_times = to_utc_ns(times)
+        tolerance_ns = pd.Timedelta(tolerance).value
+        missing = target_times == NAT_NS
+        window_starts = np.where(missing, NAT_NS, target_times - tolerance_ns)
+        window_ends = np.where(missing, NAT_NS, target_times + tolerance_ns)
+        return cls(stations=stations, window_starts=window_starts, window_ends=window_ends, target_times=target_times)
+
+    @classmethod
+    def from_windows(cls, stations, window_starts, window_ends):
+        """
+        Index for window statistics: each sample's window is given by a start and end time.
+        """
+        return cls(stations=stations, window_starts=to_utc_ns(window_starts), window_ends=to_utc_ns(window_ends))
+
+    def overlapping(self, station: str, start_ns: int, end_ns: int) -> np.ndarray:
+        """
+        Returns the positions of the samples of the station whose windows overlap [start_ns, end_ns]
+        """
+        if station not in self.stations:
+            return np.array([], dtype=np.int64)
+        positions, starts, ends, running_max_ends = self.stations[station]
+
+        # Samples starting at or before the end of the range, that do not end before the range starts
+        last = np.searchsorted(starts, end_ns, side='right')
+        first = np.searchsorted(running_max_ends[:last], start_ns, side='left')
+        candidates = slice(first, last)
+        return positions[candidates][ends[candidates] >= start_ns]
+
+    def merged_windows(self, station: str) -> list:
+        """
+        Returns the union of the windows of the samples of the station as a list of disjoint (start_ns, end_ns)
+        intervals in time order. Reading a source over these intervals reads every needed record exactly once.
+        """
+        if station not in self.stations:
+            return []
+        _, starts, _, running_max_ends = self.stations[station]
+
+        # A new interval starts wherever a window starts after all the previous windows have ended
+        breaks = np.flatnonzero(starts[1:] > running_max_ends[:-1]) + 1
+        interval_starts = starts[np.concatenate(([0], breaks))]
+        interval_ends = running_max_ends[np.concatenate((breaks - 1, [len(starts) - 1]))]
+        return list(zip(interval_starts.tolist(), interval_ends.tolist()))
+
+    def covers(self, station: str, times_ns: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean mask of the times that fall in the window of at least one sample of the station.
+        Used to read only the needed records of a source.
+        """
+        if station not in self.stations:
+            return np.zeros(len(times_ns), dtype=bool)
+        _, starts, _, running_max_ends = self.stations[station]
+
+        n_started = np.searchsorted(starts, times_ns, side='right')
+        covered = np.zeros(len(times_ns), dtype=bool)
+        has_started = n_started > 0
+        covered[has_started] = running_max_ends[n_started[has_started] - 1] >= times_ns[has_started]
+        return covered
+
+
+class StreamingJoiner:
+    """
+    Joins source data to the samples of a SampleTimeIndex one chunk at a time, so only one chunk of the
+    source is ever in memory. Chunks can come in any order (time ordered chunks just mean fewer samples are
+    touched per chunk). For each chunk only the samples whose windows overlap it are updated.
+    """
+
+    # Most rows of a chunk gathered at once for the window statistics (overlapping windows gather a row once per window)
+    MAX_WINDOW_ROWS = 1_000_000
+
+    def __init__(self, sample_index: SampleTimeIndex):
+        self.sample_index = sample_index
+
+    def _iter_station_rows(self, chunk: pd.DataFrame, time_col: str, station_col: str):
+        """
+        Yields (station, rows sorted by time, sorted times) for each station of the chunk that has samples
+        """
+        chunk_times = to_utc_ns(chunk[time_col])
+        chunk_stations = np.asarray(chunk[station_col].astype(str))
+        for station in pd.unique(chunk_stations):
+            if station not in self.sample_index.stations:
+                continue
+            rows = np.flatnonzero((chunk_stations == station) & (chunk_times != NAT_NS))
+            if len(rows) == 0:
+                continue
+            rows = rows[np.argsort(chunk_times[rows], kind='stable')]
+            yield station, rows, chunk_times[rows]
+
+    def nearest(self, chunks, time_col: str, station_col: str) -> pd.DataFrame:
+        """
+        Nearest as-of match (within each sample's window) of the chunks' records to the sample target times, by
+        station. Returns a df with one row per sample (in sample position order) with the columns of the matched
+        records (NaN where there was no match).
+        """
+        n_samples = self.sample_index.n_samples
+        best_diffs = np.full(n_samples, np.iinfo(np.int64).max, dtype=np.int64)
+        matched = []
+
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            for station, rows, times in self._iter_station_rows(chunk=chunk, time_col=time_col, station_col=station_col):
+                positions = self.sample_index.overlapping(station=station, start_ns=times[0], end_ns=times[-1])
+                if len(positions) == 0:
+                    continue
+
+                targets = self.sample_index.target_times[positions]
+                # The last record at or before the target (the last of duplicate times, like merge_asof) and the
+                # first record at or after it
+                before = np.clip(np.searchsorted(times, targets, side='right') - 1, 0, len(times) - 1)
+                after = np.clip(np.searchsorted(times, targets, side='left'), 0, len(times) - 1)
+                after_diffs = np.abs(times[after] - targets)
+                before_diffs = np.abs(targets - times[before])
+
+                # Ties go to the earlier record (like merge_asof with direction='nearest')
+                use_after = after_diffs < before_diffs
+                nearest_rows = np.where(use_after, after, before)
+                diffs = np.where(use_after, after_diffs, before_diffs)
+
+                tolerance = targets - self.sample_index.window_starts[positions]
+                better = (diffs <= tolerance) & (diffs < best_diffs[positions])
+                if not better.any():
+                    continue
+
+                best_diffs[positions[better]] = diffs[better]
+                match_df = chunk.iloc[rows[nearest_rows[better]]].copy()
+                match_df['_sample_position'] = positions[better]
+                match_df['_time_diff'] = diffs[better]
+                matched.append(match_df)
+
+        if not matched:
+            return pd.DataFrame(index=pd.RangeIndex(n_samples))
+
+        matched_df = pd.concat(matched, ignore_index=True)
+        matched_df = matched_df.sort_values('_time_diff', kind='stable').drop_duplicates('_sample_position', keep='first')
+        matched_df = matched_df.set_index('_sample_position').drop(columns='_time_diff')
+
+        return matched_df.reindex(pd.RangeIndex(n_samples))
+
+    def window_stats(self, chunks, time_col: str, station_col: str, count_col: str,
+                     min_date_col: str, max_date_col: str) -> pd.DataFrame:
+        """
+        Mean and standard deviation of the numeric columns of the records that fall in each sample's window, by
+        station. The count, mean and M2 of each window's records are computed chunk by chunk (from the offsets of the
+        values from the window mean, so large values with a small spread, like MATLAB datenums, keep their standard
+        deviation) and pooled across chunks (see pool_moments). Returns a df with one row per sample (in sample
+        position order) with the mean of each numeric column, a {col}_std_dev column for each, the min and max
+        record times in the window, and the count of records in the window.
+        """
+        n_samples = self.sample_index.n_samples
+        record_counts = np.zeros(n_samples, dtype=np.int64)
+        min_times = np.full(n_samples, np.iinfo(np.int64).max, dtype=np.int64)
+        max_times = np.full(n_samples, NAT_NS, dtype=np.int64)
+        # col: [non-NaN count, mean, M2] per sample
+        accumulators = {}
+
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            numeric_cols = chunk.select_dtypes(include=[np.number]).columns.tolist()
+            for col in numeric_cols:
+                if col not in accumulators:
+                    accumulators[col] = [np.zeros(n_samples), np.full(n_samples, np.nan), np.zeros(n_samples)]
+
+            for station, rows, times in self._iter_station_rows(chunk=chunk, time_col=time_col, station_col=station_col):
+                positions = self.sample_index.overlapping(station=station, start_ns=times[0], end_ns=times[-1])
+                if len(positions) == 0:
+                    continue
+
+                # Row range of each sample's window in the sorted chunk rows
+                lows = np.searchsorted(times, self.sample_index.window_starts[positions], side='left')
+                highs = np.searchsorted(times, self.sample_index.window_ends[positions], side='right')
+                has_rows = highs > lows
+                positions, lows, highs = positions[has_rows], lows[has_rows], highs[has_rows]
+                if len(positions) == 0:
+                    continue
+
+                record_counts[positions] += highs - lows
+                min_times[positions] = np.minimum(min_times[positions], times[lows])
+                max_times[positions] = np.maximum(max_times[positions], times[highs - 1])
+
+                chunk_values = {col: chunk[col].to_numpy(dtype=float, na_value=np.nan)[rows] for col in numeric_cols}
+                # Windows in batches of about MAX_WINDOW_ROWS gathered rows
+                batches = (np.cumsum(highs - lows) - 1) // max(self.MAX_WINDOW_ROWS, len(rows))
+                for batch in np.unique(batches):
+                    in_batch = batches == batch
+                    batch_positions = positions[in_batch]
+                    window_ids, window_rows = range_rows(lows=lows[in_batch], highs=highs[in_batch])
+                    n_windows = len(batch_positions)
+                    for col, values in chunk_values.items():
+                        window_moments = group_moments(group_ids=window_ids, values=values[window_rows], n_groups=n_windows)
+                        counts, means, m2 = accumulators[col]
+                        pooled = pool_moments(group_ids=np.tile(np.arange(n_windows), 2),
+                                              counts=np.concatenate((counts[batch_positions], window_moments[0])),
+                                              means=np.concatenate((means[batch_positions], window_moments[1])),
+                                              m2=np.concatenate((m2[batch_positions], window_moments[2])),
+                                              n_groups=n_windows)
+                        counts[batch_positions], means[batch_positions], m2[batch_positions] = pooled
+
+        result = {}
+        std_devs = {}
+        for col, (counts, means, m2) in accumulators.items():
+            result[col] = means
+            std_devs[f'{col}_std_dev'] = std_devs_from_moments(counts=counts, m2=m2)
+        result.update(std_devs)
+
+        has_records = record_counts > 0
+        result[min_date_col] = from_utc_ns(np.where(has_records, min_times, NAT_NS))
+        result[max_date_col] = from_utc_ns(np.where(has_records, max_times, NAT_NS))
+        result[count_col] = record_counts
+
+        return pd.DataFrame(result, index=pd.RangeIndex(n_samples))
@@ -0,0 +1,37 @@
+import re
+
+# Selection of the variables a source section of the config.yaml asks for, e.g.:
+#
+# mooring_info:
+#   variables: [temperature, salinity, oxygen]
+#
+# The readers only decode the selected variables (plus the ones they need themselves, like the time). A variable
+# selects a column with exactly its name, or its name followed by units (e.g. 'temp' selects 'temp.Celsius',
+# 'temp [ITS-90]', 'temp_[ITS-90]' or 'Pressure' selects 'Pressure,_Digiquartz_[db]'), but not other columns that
+# start with its name (e.g. 'temp' doesn't select 'temp_flag' or 'temp_std_dev'). No variables (None) selects everything.
+
+# Units after a name: '.units', ',units' or ':units', or bracketed units (optionally after a space or underscore)
+UNIT_SUFFIX_PATTERN = re.compile(r'[.,:]|[ _]?[\[(]')
+
+
+def is_selected(name, variables: list, required: list = None) -> bool:
+    """
+    True if the column or variable name is one of the variables or required columns (exactly or followed by units)
+    """
+    if variables is None:
+        return True
+    name = str(name)
+    for variable in list(variables) + list(required or []):
+        if variable is None:
+            continue
+        variable = str(variable)
+        if name == variable or (name.startswith(variable) and UNIT_SUFFIX_PATTERN.match(name, len(variable))):
+            return True
+    return False
+
+
+def select_names(names, variables: list, required: list = None) -> list:
+    """
+    The names (in their order) selected by the variables
+    """
+    return [name for name in names if is_selected(name=name, variables=variables, required=required)]